@@ -0,0 +1,156 @@
+"""async variants of the hot read paths
+
+plain Django async views for book list/retrieve, category list and book
+downloads. Under ASGI they run on the event loop with the async ORM and
+stream files with async iterators, so slow clients hold a suspended coroutine
+instead of a worker thread. Responses match the DRF endpoints, list pages
+follow a forward-only keyset cursor.
+
+the WSGI workers serve these paths too, one thread per request; the asgi
+service of docker-compose (uvicorn workers under gunicorn) is where the front
+proxy should send /api/async/.
+"""
+import base64
+import binascii
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.http import Http404, JsonResponse
+from django.utils.http import urlencode
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+
+from core.models import BookData, Category, PurchaseBook
+from core.search import aprepare_search
+from core.serializers import BookDataSerializer, CategorySerializer
+from .authentication import CachedJWTAuthentication
+from .downloads import aiter_range, deliver_file
+from .filters import BookFilterBackend
+from .pagination import KeysetPagination
+
+
+def error(detail, status):
+    return JsonResponse({"error": detail}, status=status)
+
+
+def unauthorized():
+    return JsonResponse(
+        {"detail": "Authentication credentials were not provided."}, status=401
+    )
+
+
+async def authenticate(request):
+    """the SnapshotUser of the request, None when unauthenticated"""
+    try:
+        result = await CachedJWTAuthentication().aauthenticate(request)
+    except APIException:
+        return None
+    return result[0] if result else None
+
+
+def encode_cursor(pk):
+    return base64.urlsafe_b64encode(str(pk).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return uuid.UUID(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, ValueError, UnicodeDecodeError):
+        return None
+
+
+async def keyset_page(request, queryset, serializer_class):
+    """
+    one page of queryset ordered on the primary key
+
+    returns the page or an error response for a malformed cursor
+    """
+    params = request.GET
+    page_size = KeysetPagination().get_page_size(Request(request))
+    try:
+        names = serializer_class.requested_fields(request)
+    except APIException as exc:
+        return JsonResponse(exc.detail, status=exc.status_code)
+    queryset = queryset.only(*serializer_class.only_columns(names))
+
+    cursor = params.get("cursor")
+    if cursor:
+        after = decode_cursor(cursor)
+        if after is None:
+            return JsonResponse({"detail": "Invalid cursor"}, status=404)
+        queryset = queryset.filter(pk__gt=after)
+
+    rows = [row async for row in queryset.order_by("pk")[: page_size + 1]]
+    next_url = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        query = params.copy()
+        query["cursor"] = encode_cursor(rows[-1].pk)
+        next_url = request.build_absolute_uri(
+            f"{request.path}?{urlencode(query, doseq=True)}"
+        )
+
+    results = serializer_class(rows, many=True, context={"request": request}).data
+    return JsonResponse({"next": next_url, "previous": None, "results": results})
+
+
+async def book_list(request):
+    user = await authenticate(request)
+    if user is None:
+        return unauthorized()
+
+    if request.GET.get("search"):
+        await aprepare_search(BookData.objects.db)
+    try:
+        queryset = BookFilterBackend().filter_queryset(
+            Request(request), BookData.objects.visible_to(user), None
+        )
+    except APIException as exc:
+        return JsonResponse(exc.detail, status=exc.status_code)
+    return await keyset_page(request, queryset, BookDataSerializer)
+
+
+async def book_detail(request, pk):
+    user = await authenticate(request)
+    if user is None:
+        return unauthorized()
+
+    book = await BookData.objects.visible_to(user).filter(pk=pk).afirst()
+    if book is None:
+        return JsonResponse({"detail": "Not found."}, status=404)
+    return JsonResponse(BookDataSerializer(book, context={"request": request}).data)
+
+
+async def category_list(request):
+    user = await authenticate(request)
+    if user is None:
+        return unauthorized()
+    return await keyset_page(request, Category.objects.all(), CategorySerializer)
+
+
+async def download_book(request, book_id):
+    user = await authenticate(request)
+    if user is None:
+        return unauthorized()
+
+    purchase = (
+        await PurchaseBook.objects.filter(user_id=user.pk, book_id=book_id)
+        .select_related("book")
+        .afirst()
+    )
+    if purchase is None:
+        return error("You haven't purchased this book.", 403)
+
+    book = purchase.book
+    if not book.is_visible_to(user):
+        return error("You don't have access to download this private book.", 403)
+    if not book.file:
+        return error("Book file not available.", 404)
+    # * the size and mtime lookups are blocking
+    # * file system calls, kept off the event loop
+    try:
+        return await sync_to_async(deliver_file, thread_sensitive=False)(
+            request, book.file.storage, book.file.name, stream=aiter_range
+        )
+    except Http404:
+        return error("Book file not available.", 404)
@@ -0,0 +1,135 @@
+"""JWT authentication without a user query per request
+
+the token's user id claim identifies the user, the fields handlers read on
+every request (and the ledger balance) come from a short lived per-user
+snapshot in the cache, and the full UserData row is only loaded when a
+handler touches anything else.
+"""
+import uuid
+from functools import cached_property
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from core.models import UserData, balance_expression
+
+SNAPSHOT_FIELDS = ("username", "normal_user", "is_superuser")
+
+
+def get_cache():
+    return caches[settings.AUTH_SNAPSHOT_CACHE_ALIAS]
+
+
+def snapshot_key(user_id):
+    return f"auth:user:{user_id}"
+
+
+def load_snapshot(user_id):
+    """cached snapshot fields of a user, None when the user does not exist"""
+    cache = get_cache()
+    key = snapshot_key(user_id)
+    snapshot = cache.get(key)
+    if snapshot is None:
+        snapshot = (
+            UserData.objects.filter(pk=user_id)
+            .values(*SNAPSHOT_FIELDS, balance=balance_expression())
+            .first()
+        )
+        if snapshot is None:
+            return None
+        cache.set(key, snapshot, settings.AUTH_SNAPSHOT_TTL)
+    return snapshot
+
+
+async def aload_snapshot(user_id):
+    """load_snapshot for async views, through the async cache and ORM APIs"""
+    cache = get_cache()
+    key = snapshot_key(user_id)
+    snapshot = await cache.aget(key)
+    if snapshot is None:
+        snapshot = (
+            await UserData.objects.filter(pk=user_id)
+            .values(*SNAPSHOT_FIELDS, balance=balance_expression())
+            .afirst()
+        )
+        if snapshot is None:
+            return None
+        await cache.aset(key, snapshot, settings.AUTH_SNAPSHOT_TTL)
+    return snapshot
+
+
+def invalidate_snapshot(user_id):
+    get_cache().delete(snapshot_key(user_id))
+
+
+class SnapshotUser:
+    """
+    lightweight request.user
+
+    snapshot fields are plain attributes, anything else is read from the full
+    UserData instance, loaded lazily on first use (also available as .instance)
+    """
+
+    is_active = True
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, user_id, snapshot):
+        self.pk = self.id = user_id
+        self.__dict__.update(snapshot)
+
+    @cached_property
+    def instance(self):
+        return UserData.objects.get(pk=self.pk)
+
+    def __getattr__(self, name):
+        # * only called for attributes missing from the snapshot
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.instance, name)
+
+    def __eq__(self, other):
+        return isinstance(other, (SnapshotUser, UserData)) and other.pk == self.pk
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __str__(self):
+        return self.username
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication returning a SnapshotUser instead of querying UserData"""
+
+    def get_user_id(self, validated_token):
+        try:
+            return uuid.UUID(str(validated_token[api_settings.USER_ID_CLAIM]))
+        except (KeyError, ValueError):
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+    def get_user(self, validated_token):
+        user_id = self.get_user_id(validated_token)
+        snapshot = load_snapshot(user_id)
+        if snapshot is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+        return SnapshotUser(user_id, snapshot)
+
+    async def aauthenticate(self, request):
+        """authenticate() for async views, token validation itself needs no I/O"""
+        header = self.get_header(request)
+        if header is None:
+            return None
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+
+        validated_token = self.get_validated_token(raw_token)
+        user_id = self.get_user_id(validated_token)
+        snapshot = await aload_snapshot(user_id)
+        if snapshot is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+        return SnapshotUser(user_id, snapshot), validated_token
@@ -0,0 +1,153 @@
+"""helpers shared by the benchmark management commands
+
+benchmarks run against a throwaway test database, a temporary MEDIA_ROOT and
+a process local cache, never against the configured data.
+"""
+import random
+import tempfile
+from contextlib import contextmanager
+
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.test.utils import (
+    override_settings,
+    setup_test_environment,
+    teardown_test_environment,
+)
+
+from core.models import BalanceEntry, BookData, Category, PurchaseBook, UserData
+from .rollups import rebuild_rollups
+
+BENCH_PASSWORD = "bench-password"
+
+TITLE_WORDS = [
+    "silent",
+    "river",
+    "glass",
+    "empire",
+    "winter",
+    "garden",
+    "shadow",
+    "atlas",
+    "machine",
+    "ocean",
+    "letters",
+    "history",
+    "night",
+    "city",
+    "stone",
+    "light",
+]
+
+
+@contextmanager
+def benchmark_environment(keepdb=False):
+    """create the test database, media directory and cache, yield, then drop them"""
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(
+        verbosity=0, autoclobber=True, serialize=False, keepdb=keepdb
+    )
+    try:
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+            MEDIA_ROOT=media_root,
+            ALLOWED_HOSTS=["testserver"],
+            CACHES={
+                "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+            },
+        ):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+        teardown_test_environment()
+
+
+def percentile(values, pct):
+    """nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class QueryCounter:
+    """execute_wrapper that counts the queries run on one connection"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def seed_dataset(books, users, purchases, categories=20, file_size=64 * 1024, seed=0):
+    """
+    bulk insert a catalog, its buyers and their purchases
+
+    every book shares one stored PDF and every user the password
+    BENCH_PASSWORD, hashed once. users are normal users with a balance and
+    books have stock enough that no benchmark runs out of either, the sales
+    rollups are rebuilt from the purchases.
+    returns the users, books and the set of (user pk, book pk) pairs bought
+    """
+    rng = random.Random(seed)
+    name = default_storage.save(
+        "books/bench.pdf", ContentFile(b"%PDF-" + b"0" * (file_size - 5))
+    )
+
+    category_rows = Category.objects.bulk_create(
+        Category(name=f"category {i}") for i in range(categories)
+    )
+    book_rows = BookData.objects.bulk_create(
+        (
+            BookData(
+                book_name=f"{rng.choice(TITLE_WORDS)} {rng.choice(TITLE_WORDS)} {i}",
+                author_name=f"author {i % 97}",
+                book_amount=10**6,
+                price=round(rng.uniform(1, 50), 2),
+                category=rng.choice(category_rows),
+                file=name,
+                public=i % 10 != 0,
+            )
+            for i in range(books)
+        ),
+        batch_size=500,
+    )
+    password = make_password(BENCH_PASSWORD)
+    user_rows = UserData.objects.bulk_create(
+        (
+            UserData(
+                username=f"bench{i}",
+                email=f"bench{i}@example.com",
+                password=password,
+                last_name="bench",
+                normal_user=True,
+            )
+            for i in range(users)
+        ),
+        batch_size=500,
+    )
+    BalanceEntry.objects.bulk_create(
+        (
+            BalanceEntry(user=user, amount=10**9, kind=BalanceEntry.OPENING)
+            for user in user_rows
+        ),
+        batch_size=500,
+    )
+
+    bought = set()
+    while len(bought) < min(purchases, books * users):
+        bought.add((rng.choice(user_rows).pk, rng.choice(book_rows).pk))
+    prices = {book.pk: book.price for book in book_rows}
+    PurchaseBook.objects.bulk_create(
+        (
+            PurchaseBook(user_id=user_id, book_id=book_id, unit_price=prices[book_id])
+            for user_id, book_id in bought
+        ),
+        batch_size=500,
+    )
+    rebuild_rollups()
+    return user_rows, book_rows, bought
@@ -0,0 +1,154 @@
+"""versioned read cache for catalog responses
+
+every key embeds the current catalog version, saving or deleting a BookData or
+Category bumps the version so all older entries become unreachable at once and
+simply age out of the cache. Stock changes with every purchase and hold through
+.update(), so instead of bumping the version it is re-read for the rows of
+every cached response.
+"""
+import hashlib
+import time
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.response import Response
+
+VERSION_KEY = "catalog:version"
+
+
+def get_cache():
+    return caches[settings.CATALOG_CACHE_ALIAS]
+
+
+def catalog_version():
+    cache = get_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # * seed from the clock so a version key lost to eviction never
+        # * falls back to a number older entries were stored under
+        cache.add(VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    cache = get_cache()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        catalog_version()
+
+
+def visibility_tier(user):
+    """normal users see the whole catalog, everyone else only public books"""
+    return "all" if getattr(user, "normal_user", False) else "public"
+
+
+def cached_response(request, name, compute, refresh=None):
+    """
+    return the cached response data for this request or build it with compute()
+
+    only one worker rebuilds a missing entry, the others wait for it for up to
+    CATALOG_CACHE_LOCK_TIMEOUT seconds before computing it themselves. Cached
+    data goes through refresh() before it is returned
+    """
+    cache = get_cache()
+    url = hashlib.sha1(request.build_absolute_uri().encode()).hexdigest()
+    key = f"catalog:{catalog_version()}:{visibility_tier(request.user)}:{name}:{url}"
+    refresh = refresh or (lambda data: data)
+
+    data = cache.get(key)
+    if data is not None:
+        return Response(refresh(data))
+
+    lock_key = f"{key}:lock"
+    timeout = settings.CATALOG_CACHE_LOCK_TIMEOUT
+    locked = cache.add(lock_key, 1, timeout)
+    if not locked:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            data = cache.get(key)
+            if data is not None:
+                return Response(refresh(data))
+
+    try:
+        response = compute()
+        if response.status_code == 200:
+            cache.set(key, response.data, settings.CATALOG_CACHE_TTL)
+    finally:
+        if locked:
+            cache.delete(lock_key)
+    return response
+
+
+class CatalogCacheMixin:
+    """
+    serve list and retrieve from the versioned catalog cache
+
+    live_fields change without a version bump and are re-read by id for every
+    cached response, requests the cache cannot answer that way go straight
+    to the view
+    """
+
+    live_fields = ()
+
+    def uncacheable(self):
+        """
+        whether the response depends on live fields
+        beyond what refresh_live_fields() restores
+        """
+        if not self.live_fields:
+            return False
+        # * rows without their id cannot be matched with the current values
+        names = self.sparse_fields()
+        return (
+            names is not None
+            and "id" not in names
+            and any(field in names for field in self.live_fields)
+        )
+
+    def refresh_live_fields(self, data):
+        rows = data["results"] if isinstance(data, dict) and "results" in data else data
+        rows = [
+            row for row in (rows if isinstance(rows, list) else [rows]) if "id" in row
+        ]
+        fields = [field for field in self.live_fields if rows and field in rows[0]]
+        if not fields:
+            return data
+        current = {
+            str(pk): values
+            for pk, *values in self.queryset.model.objects.filter(
+                pk__in=[row["id"] for row in rows]
+            ).values_list("pk", *fields)
+        }
+        for row in rows:
+            # * a row deleted since it was cached keeps its
+            # * last values until the version bump lands
+            row.update(
+                zip(
+                    fields,
+                    current.get(str(row["id"]), [row[field] for field in fields]),
+                )
+            )
+        return data
+
+    def cached(self, request, name, compute):
+        if self.uncacheable():
+            return compute()
+        return cached_response(request, name, compute, self.refresh_live_fields)
+
+    def list(self, request, *args, **kwargs):
+        return self.cached(
+            request,
+            f"{self.basename}-list",
+            partial(super().list, request, *args, **kwargs),
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached(
+            request,
+            f"{self.basename}-detail",
+            partial(super().retrieve, request, *args, **kwargs),
+        )
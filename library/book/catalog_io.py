@@ -0,0 +1,187 @@
+"""streaming catalog import and export
+
+rows are plain dicts of CATALOG_FIELDS with the category given by name. A book
+is identified by its natural key (book_name, author_name): importing a row
+with a known key updates that book, anything else creates one. Reading,
+writing and upserting all work a batch at a time so memory stays flat
+whatever the size of the feed.
+"""
+import csv
+import io
+import json
+import math
+
+from django.db import transaction
+
+from core.models import BookData, Category
+from .cache import bump_catalog_version
+
+CATALOG_FIELDS = [
+    "book_name",
+    "author_name",
+    "book_amount",
+    "price",
+    "category",
+    "public",
+]
+NATURAL_KEY = ("book_name", "author_name")
+UPDATE_FIELDS = ["book_amount", "price", "category", "public"]
+TRUE_VALUES = {"1", "true", "yes", "y", "t"}
+FALSE_VALUES = {"0", "false", "no", "n", "f", ""}
+
+
+class RowError(ValueError):
+    """a row that cannot be imported, the message names the offending field"""
+
+
+def read_rows(file, fmt):
+    """yield (line number, raw dict) from an open text file in csv or jsonl"""
+    if fmt == "csv":
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line_num, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as exc:
+                yield line_num, RowError(f"invalid JSON: {exc}")
+                continue
+            yield line_num, row if isinstance(row, dict) else RowError(
+                "expected a JSON object"
+            )
+
+
+def clean_row(raw):
+    """validated model values of a raw row, the category still as a name"""
+    if isinstance(raw, RowError):
+        raise raw
+    row = {}
+    for field in NATURAL_KEY:
+        value = str(raw.get(field) or "").strip()
+        if not value:
+            raise RowError(f"{field} is required")
+        limit = BookData._meta.get_field(field).max_length
+        if len(value) > limit:
+            raise RowError(f"{field} is longer than {limit} characters")
+        row[field] = value
+    try:
+        row["book_amount"] = int(raw.get("book_amount") or 0)
+    except (TypeError, ValueError):
+        raise RowError(f"book_amount {raw.get('book_amount')!r} is not an integer")
+    if row["book_amount"] < 0:
+        raise RowError("book_amount cannot be negative")
+    try:
+        row["price"] = float(raw.get("price"))
+    except (TypeError, ValueError):
+        raise RowError(f"price {raw.get('price')!r} is not a number")
+    if not math.isfinite(row["price"]):
+        raise RowError(f"price {raw.get('price')!r} is not a finite number")
+    if row["price"] < 0:
+        raise RowError("price cannot be negative")
+    public = raw.get("public", True)
+    if not isinstance(public, bool):
+        text = str(public).strip().lower()
+        if text not in TRUE_VALUES | FALSE_VALUES:
+            raise RowError(f"public {public!r} is not a boolean")
+        public = text in TRUE_VALUES
+    row["public"] = public
+    row["category"] = str(raw.get("category") or "").strip() or None
+    return row
+
+
+class CatalogImporter:
+    """
+    upsert cleaned rows a batch at a time
+
+    categories are resolved through a name -> id map loaded once and extended
+    as new names show up, existing books of a batch are found with one query
+    on the (book_name, author_name) index, the ones whose values differ are
+    updated with bulk_update and the rest bulk_created in the same transaction
+    """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.categories = {}
+        for pk, name in Category.objects.order_by("name", "pk").values_list(
+            "pk", "name"
+        ):
+            self.categories.setdefault(name, pk)
+        self.created = self.updated = self.unchanged = 0
+
+    def category_id(self, name):
+        if name is None:
+            return None
+        if name not in self.categories:
+            self.categories[name] = Category.objects.create(name=name).pk
+        return self.categories[name]
+
+    def write(self, rows):
+        """upsert one batch of cleaned rows, a later row with the same key wins"""
+        by_key = {(row["book_name"], row["author_name"]): row for row in rows}
+        existing = {}
+        names = {name for name, _ in by_key}
+        authors = {author for _, author in by_key}
+        books = BookData.objects.filter(book_name__in=names, author_name__in=authors)
+        for book in books.only("pk", *NATURAL_KEY, *UPDATE_FIELDS):
+            existing.setdefault((book.book_name, book.author_name), book)
+
+        # * new categories are committed on their own so
+        # * the map never points at a rolled back row
+        to_create, to_update = [], []
+        for key, row in by_key.items():
+            values = dict(row, category_id=self.category_id(row["category"]))
+            del values["category"]
+            book = existing.get(key)
+            if book is None:
+                to_create.append(BookData(**values))
+            elif any(getattr(book, field) != value for field, value in values.items()):
+                for field, value in values.items():
+                    setattr(book, field, value)
+                to_update.append(book)
+
+        with transaction.atomic():
+            BookData.objects.bulk_create(to_create, batch_size=self.batch_size)
+            BookData.objects.bulk_update(
+                to_update, UPDATE_FIELDS, batch_size=self.batch_size
+            )
+            # * bulk writes send no post_save, so the catalog cache is invalidated here
+            transaction.on_commit(bump_catalog_version)
+        self.created += len(to_create)
+        self.updated += len(to_update)
+        self.unchanged += len(by_key) - len(to_create) - len(to_update)
+
+
+def export_rows(queryset=None, chunk_size=2000):
+    """yield catalog rows with a server side cursor, never holding the whole queryset"""
+    queryset = BookData.objects.all() if queryset is None else queryset
+    columns = [field for field in CATALOG_FIELDS if field != "category"] + [
+        "category__name"
+    ]
+    for values in (
+        queryset.order_by("pk").values_list(*columns).iterator(chunk_size=chunk_size)
+    ):
+        row = dict(zip(columns, values))
+        row["category"] = row.pop("category__name")
+        yield row
+
+
+def encode_csv(rows):
+    """yield CSV text, the header first then one line per row"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CATALOG_FIELDS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def encode_jsonl(rows):
+    """yield one JSON object per line"""
+    for row in rows:
+        yield json.dumps(row, default=str) + "\n"
@@ -0,0 +1,45 @@
+"""system checks of the book app"""
+from django.conf import settings
+from django.core.cache import caches
+from django.core.checks import Error, Tags, register
+from django.utils.module_loading import import_string
+
+from .otp import CacheOTPStore, InMemoryOTPStore
+
+# * caches whose entries the run_jobs workers cannot read back
+PROCESS_LOCAL_CACHES = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+@register(Tags.caches)
+def check_otp_store(app_configs, **kwargs):
+    """
+    with TEST_ENVIRONMENT off codes are mailed by the job workers, which only
+    see them when the OTP store is shared between processes
+    """
+    if settings.TEST_ENVIRONMENT:
+        return []
+    store = import_string(settings.OTP_STORE)
+    if issubclass(store, InMemoryOTPStore):
+        return [
+            Error(
+                f"OTP_STORE {settings.OTP_STORE} keeps codes in one process.",
+                hint="Use book.otp.CacheOTPStore with a shared cache.",
+                id="book.E001",
+            )
+        ]
+    if issubclass(store, CacheOTPStore):
+        backend = caches[settings.OTP_CACHE_ALIAS]
+        path = f"{type(backend).__module__}.{type(backend).__qualname__}"
+        if path in PROCESS_LOCAL_CACHES:
+            return [
+                Error(
+                    f"OTP_CACHE_ALIAS {settings.OTP_CACHE_ALIAS!r} uses {path}, "
+                    "the job workers cannot read the codes to mail them.",
+                    hint="Set REDIS_URL or point OTP_CACHE_ALIAS at a shared cache.",
+                    id="book.E002",
+                )
+            ]
+    return []
@@ -0,0 +1,237 @@
+"""file delivery for book downloads
+
+streamed files support conditional GET (ETag / Last-Modified, 304) and
+single byte ranges (206, If-Range) so interrupted downloads resume instead of
+restarting.
+
+BOOK_DOWNLOAD_DELIVERY can instead hand the transfer to the front proxy, the
+view then only authorizes the request and returns an internal redirect:
+
+    "x-accel-redirect"  nginx, with a matching internal location, e.g.
+                        location /protected/ { internal; alias <MEDIA_ROOT>/; }
+    "x-sendfile"        Apache mod_xsendfile / lighttpd, absolute file path
+"""
+import hashlib
+import logging
+import os
+import re
+import time
+from urllib.parse import quote
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ImproperlyConfigured
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+SIGNED_DOWNLOAD_SALT = "book.downloads.signed"
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+# * book.uploads names files after the SHA-256 of their content
+CONTENT_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def file_validators(storage, name):
+    """
+    ETag and Last-Modified timestamp of a stored file
+
+    the ETag of a content addressed file is its content digest, a strong
+    validator. Other files get a weak one made of name, size and mtime, which
+    does not prove the bytes are the same, so If-Range never matches it
+    """
+    size = storage.size(name)
+    modified = int(storage.get_modified_time(name).timestamp())
+    stem = os.path.splitext(os.path.basename(name))[0]
+    if CONTENT_DIGEST_RE.match(stem):
+        return size, f'"{stem}"', modified
+    digest = hashlib.sha1(f"{name}:{size}:{modified}".encode()).hexdigest()
+    return size, f'W/"{digest}"', modified
+
+
+def parse_range(header, size):
+    """
+    (start, end) of a single byte range, None to ignore the header or
+    ValueError when the range cannot be satisfied (RFC 7233 2.1, 4.4)
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        # * malformed and multi-range requests get the whole file
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if first and last and int(first) > int(last):
+        # * syntactically invalid, ignored like any other malformed range
+        return None
+    if not first:
+        # * suffix range, the last n bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError
+        return max(size - length, 0), size - 1
+    start = int(first)
+    if start >= size:
+        raise ValueError
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def if_range_matches(request, etag, modified):
+    """whether the Range header still applies to the current representation"""
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == modified
+
+
+def iter_range(storage, name, start, length):
+    file = storage.open(name, "rb")
+    try:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+async def aiter_range(storage, name, start, length):
+    """
+    async counterpart of iter_range, file reads run in the thread pool so a
+    slow client only holds a suspended coroutine, not a thread
+    """
+    file = await sync_to_async(storage.open, thread_sensitive=False)(name, "rb")
+    read = sync_to_async(file.read, thread_sensitive=False)
+    try:
+        await sync_to_async(file.seek, thread_sensitive=False)(start)
+        while length > 0:
+            chunk = await read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await sync_to_async(file.close, thread_sensitive=False)()
+
+
+def serve_file(request, storage, name, content_type="application/pdf", stream=None):
+    """
+    stream a stored file honouring conditional and range request headers
+
+    stream is the body iterator factory, iter_range by default (whole files
+    then go through FileResponse), aiter_range for ASGI views
+    """
+    size, etag, modified = file_validators(storage, name)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": http_date(modified),
+        "Accept-Ranges": "bytes",
+    }
+
+    conditional = get_conditional_response(request, etag=etag, last_modified=modified)
+    if conditional is not None:
+        for header, value in headers.items():
+            conditional.headers[header] = value
+        return conditional
+
+    byte_range = None
+    range_header = request.META.get("HTTP_RANGE")
+    if range_header and if_range_matches(request, etag, modified):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response.headers["Content-Range"] = f"bytes */{size}"
+            return response
+
+    if byte_range is None and stream is None:
+        response = FileResponse(storage.open(name, "rb"), content_type=content_type)
+    else:
+        start, end = byte_range or (0, size - 1)
+        length = end - start + 1
+        response = StreamingHttpResponse(
+            (stream or iter_range)(storage, name, start, length),
+            status=200 if byte_range is None else 206,
+            content_type=content_type,
+        )
+        if byte_range is not None:
+            response.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response.headers["Content-Length"] = str(length)
+
+    for header, value in headers.items():
+        response.headers[header] = value
+    return response
+
+
+def deliver_file(request, storage, name, content_type="application/pdf", stream=None):
+    """
+    send a stored file with the configured BOOK_DOWNLOAD_DELIVERY mode
+    """
+    mode = settings.BOOK_DOWNLOAD_DELIVERY
+    if mode == "stream":
+        try:
+            return serve_file(request, storage, name, content_type, stream)
+        except FileNotFoundError:
+            # * released or deleted since the book row or the signed link was read
+            raise Http404("Book file not available.")
+
+    # * the proxy replaces the empty body and handles Range / conditional headers itself
+    response = HttpResponse(content_type=content_type)
+    if mode == "x-accel-redirect":
+        prefix = settings.BOOK_DOWNLOAD_ACCEL_PREFIX.rstrip("/")
+        if not prefix:
+            # * "/" would make every URL of the site an internal location
+            raise ImproperlyConfigured(
+                "BOOK_DOWNLOAD_ACCEL_PREFIX must name the internal location."
+            )
+        response.headers["X-Accel-Redirect"] = prefix + "/" + quote(name)
+    elif mode == "x-sendfile":
+        response.headers["X-Sendfile"] = storage.path(name)
+    else:
+        raise ImproperlyConfigured(f"Unknown BOOK_DOWNLOAD_DELIVERY {mode!r}.")
+    return response
+
+
+def sign_download(book_id, name, user_id):
+    """
+    HMAC signed token bound to book, stored file, the user it was issued to
+    and expiry
+
+    returns the token and its expiry as a unix timestamp. The token is a
+    bearer credential: whoever holds the URL can download the file until it
+    expires, which is why it lives only BOOK_DOWNLOAD_URL_LIFETIME seconds.
+    The user is not checked on redemption (the link works without
+    credentials) but every redemption is logged with it, so a leaked link can
+    be traced to the account it was issued to
+    """
+    expires = int(time.time()) + settings.BOOK_DOWNLOAD_URL_LIFETIME
+    payload = {"b": str(book_id), "f": name, "u": str(user_id), "e": expires}
+    return signing.dumps(payload, salt=SIGNED_DOWNLOAD_SALT, compress=True), expires
+
+
+def verify_download(token, book_id):
+    """
+    storage name of the file a token grants, BadSignature if the token is
+    forged, expired or issued for another book
+    """
+    payload = signing.loads(token, salt=SIGNED_DOWNLOAD_SALT)
+    if payload.get("b") != str(book_id):
+        raise signing.BadSignature("Token issued for another book.")
+    if payload.get("e", 0) < time.time():
+        raise signing.SignatureExpired("Download link expired.")
+    logger.info(
+        "signed download of book %s, link issued to user %s",
+        book_id,
+        payload.get("u"),
+    )
+    return payload["f"]
@@ -0,0 +1,95 @@
+"""streamed JSON exports
+
+rows come from values() querysets read with .iterator(), a server side cursor
+on PostgreSQL and chunked fetches elsewhere, and are encoded as JSON Lines or
+as one JSON array written element by element. Only one fetch chunk and one
+output chunk are in memory at a time, and the first bytes leave as soon as the
+first chunk is full. Under ASGI Django buffers synchronous iterators, so
+these endpoints are meant for the WSGI workers.
+"""
+from django.core.serializers.json import DjangoJSONEncoder
+
+from core.models import BookData
+
+EXPORT_FORMATS = {"jsonl": "application/x-ndjson", "json": "application/json"}
+CHUNK_SIZE = 2000
+# * rows are written out in chunks of about this many bytes
+OUTPUT_CHUNK_BYTES = 32 * 1024
+
+
+def encode_rows(rows, fmt):
+    """
+    yield rows as JSON Lines or as a JSON array, in chunks of about OUTPUT_CHUNK_BYTES
+    """
+    encode = DjangoJSONEncoder().encode
+    array = fmt == "json"
+    parts, size = [], 0
+    if array:
+        # * open the array right away so clients see the
+        # * first byte before the first query returns
+        yield b"["
+    for index, row in enumerate(rows):
+        text = encode(row)
+        if array:
+            text = ("," if index else "") + "\n" + text
+        else:
+            text += "\n"
+        parts.append(text)
+        size += len(text)
+        if size >= OUTPUT_CHUNK_BYTES:
+            yield "".join(parts).encode()
+            parts, size = [], 0
+    if array:
+        parts.append("\n]\n")
+    if parts:
+        yield "".join(parts).encode()
+
+
+def book_rows(queryset, request, chunk_size=CHUNK_SIZE):
+    """books in the shape of BookDataSerializer"""
+    storage = BookData._meta.get_field("file").storage
+    columns = (
+        "id",
+        "book_name",
+        "author_name",
+        "book_amount",
+        "price",
+        "file",
+        "category",
+        "public",
+    )
+    for row in queryset.order_by("pk").values(*columns).iterator(chunk_size=chunk_size):
+        row["file"] = (
+            request.build_absolute_uri(storage.url(row["file"]))
+            if row["file"]
+            else None
+        )
+        yield row
+
+
+def purchase_rows(queryset, chunk_size=CHUNK_SIZE):
+    """
+    purchases in the shape of PurchaseBookSerializer plus the book id, oldest first
+    """
+    columns = (
+        "id",
+        "user__username",
+        "book_id",
+        "book__book_name",
+        "purchase_date",
+        "quantity",
+    )
+    for values in (
+        queryset.order_by("purchase_date", "pk")
+        .values_list(*columns)
+        .iterator(chunk_size=chunk_size)
+    ):
+        pk, username, book_id, book_name, purchase_date, quantity = values
+        yield {
+            "id": pk,
+            "user": username,
+            "book": book_name,
+            "book_id": book_id,
+            "purchase_date": purchase_date,
+            "quantity": quantity,
+        }
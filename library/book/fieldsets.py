@@ -0,0 +1,42 @@
+"""sparse fieldsets and the values() read path for generic views
+"""
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
+
+
+class SparseFieldsetMixin:
+    """
+    ?fields= and ?omit= for a generic view whose serializer has SparseFieldsMixin
+
+    reads only select the columns of the requested fields, and lists whose
+    fields all have a column are rendered from .values() rows through the
+    serializer's compiled ValuesPlan instead of model instances and DRF fields
+    """
+
+    def sparse_fields(self):
+        """the requested field names, None for all of them"""
+        if not hasattr(self, "_sparse_fields"):
+            self._sparse_fields = self.get_serializer_class().requested_fields(
+                self.request
+            )
+        return self._sparse_fields
+
+    def restrict_queryset(self, queryset):
+        """eager loading for the rendered fields, and on reads .only() their columns"""
+        serializer_class = self.get_serializer_class()
+        if self.request.method not in SAFE_METHODS:
+            return serializer_class.setup_eager_loading(queryset)
+        names = self.sparse_fields()
+        return serializer_class.setup_eager_loading(queryset, names).only(
+            *serializer_class.only_columns(names)
+        )
+
+    def list(self, request, *args, **kwargs):
+        plan = self.get_serializer_class().values_plan(self.sparse_fields())
+        if plan is None:
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset()).values(*plan.columns)
+        page = self.paginate_queryset(queryset)
+        if page is None:
+            return Response(plan.render(queryset, request))
+        return self.get_paginated_response(plan.render(page, request))
@@ -0,0 +1,60 @@
+"""server side search and filters for the book catalog
+"""
+import uuid
+
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+from core.search import search_books
+
+
+class BookFilterBackend(BaseFilterBackend):
+    """
+    ?search=        every word must occur in book_name or author_name
+    ?category=      category id
+    ?min_price=     lower price bound (inclusive)
+    ?max_price=     upper price bound (inclusive)
+    ?in_stock=      true for book_amount > 0, false for sold out books
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        params = request.query_params
+
+        category = params.get("category")
+        if category:
+            queryset = queryset.filter(
+                category_id=self.parse(category, uuid.UUID, "category")
+            )
+
+        min_price = params.get("min_price")
+        if min_price:
+            queryset = queryset.filter(
+                price__gte=self.parse(min_price, float, "min_price")
+            )
+
+        max_price = params.get("max_price")
+        if max_price:
+            queryset = queryset.filter(
+                price__lte=self.parse(max_price, float, "max_price")
+            )
+
+        in_stock = params.get("in_stock")
+        if in_stock:
+            if in_stock.lower() in ("true", "1"):
+                queryset = queryset.filter(book_amount__gt=0)
+            elif in_stock.lower() in ("false", "0"):
+                queryset = queryset.filter(book_amount__lte=0)
+            else:
+                raise ValidationError({"in_stock": "Expected true or false."})
+
+        search = params.get("search", "").strip()
+        if search:
+            queryset = search_books(queryset, search)
+        return queryset
+
+    @staticmethod
+    def parse(value, cast, name):
+        try:
+            return cast(value)
+        except ValueError:
+            raise ValidationError({name: f"Invalid value {value!r}."})
@@ -0,0 +1,184 @@
+"""database backed job queue
+
+enqueue() inserts a Job, inside the caller's transaction when there is one,
+so work queued by a purchase exists exactly when the purchase does. Workers
+claim batches with claim_jobs(): SELECT ... FOR UPDATE SKIP LOCKED where the
+backend has it (PostgreSQL), elsewhere (SQLite) a conditional UPDATE that only
+takes rows still queued, so two workers never run the same job. A failed job
+is retried after an exponential backoff until max_attempts, then left FAILED.
+Finished jobs are deleted by prune_jobs() after JOB_RETENTION seconds.
+
+handlers are registered with @handler("kind") and receive the job payload.
+"""
+import datetime
+import logging
+import random
+import uuid
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from core.models import Job
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+
+def handler(kind):
+    """register the decorated function as the handler of jobs of kind"""
+
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+
+    return register
+
+
+def enqueue(kind, payload, key=None, delay=0, max_attempts=None):
+    """
+    queue a job and return it, or the job already queued under key
+
+    with a key the insert runs in a savepoint, so a duplicate does not break
+    the caller's transaction
+    """
+    job = Job(
+        kind=kind,
+        payload=payload,
+        idempotency_key=key,
+        run_at=timezone.now() + datetime.timedelta(seconds=delay),
+        max_attempts=max_attempts or settings.JOB_MAX_ATTEMPTS,
+    )
+    if key is None:
+        job.save()
+        return job
+    try:
+        with transaction.atomic():
+            job.save()
+    except IntegrityError:
+        return Job.objects.get(idempotency_key=key)
+    return job
+
+
+def claimable(now):
+    """queued jobs that are due and running jobs whose worker's lease ran out"""
+    return Job.objects.filter(
+        Q(status=Job.QUEUED, run_at__lte=now)
+        | Q(status=Job.RUNNING, locked_until__lt=now)
+    )
+
+
+def claim_jobs(worker, batch_size=10, lease=None):
+    """mark up to batch_size due jobs as running for worker and return them"""
+    now = timezone.now()
+    lease = settings.JOB_LEASE if lease is None else lease
+    claim = {
+        "status": Job.RUNNING,
+        "locked_by": worker,
+        "locked_until": now + datetime.timedelta(seconds=lease),
+        "attempts": F("attempts") + 1,
+    }
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(
+                claimable(now)
+                .select_for_update(skip_locked=True)
+                .order_by("run_at")
+                .values_list("pk", flat=True)[:batch_size]
+            )
+            Job.objects.filter(pk__in=ids).update(**claim)
+    else:
+        # * the UPDATE re-checks the condition, a job
+        # * another worker took in between is skipped
+        ids = list(
+            claimable(now).order_by("run_at").values_list("pk", flat=True)[:batch_size]
+        )
+        claimable(now).filter(pk__in=ids).update(**claim)
+    return list(
+        Job.objects.filter(pk__in=ids, locked_by=worker, status=Job.RUNNING).order_by(
+            "run_at"
+        )
+    )
+
+
+def backoff(attempts):
+    """
+    seconds before retry number attempts, doubling
+    up to JOB_RETRY_MAX with up to 10% jitter
+    """
+    delay = min(settings.JOB_RETRY_BASE * 2 ** (attempts - 1), settings.JOB_RETRY_MAX)
+    return delay * (1 + random.random() / 10)
+
+
+def finish(job, worker, **changes):
+    """
+    record the outcome, unless the lease ran out and another worker owns the job now
+    """
+    changes.update(locked_by="", locked_until=None)
+    if changes.get("status") in (Job.DONE, Job.FAILED):
+        changes["finished_at"] = timezone.now()
+    return Job.objects.filter(pk=job.pk, locked_by=worker).update(**changes)
+
+
+def run_job(job, worker):
+    """run one claimed job and record its outcome, returns the new status"""
+    func = HANDLERS.get(job.kind)
+    try:
+        if func is None:
+            raise LookupError(f"no handler for job kind {job.kind!r}")
+        func(job.payload)
+    except Exception as exc:
+        error = f"{type(exc).__name__}: {exc}"
+        if job.attempts >= job.max_attempts or func is None:
+            logger.error(
+                "job %s failed for good after %s attempts: %s",
+                job.pk,
+                job.attempts,
+                error,
+            )
+            finish(job, worker, status=Job.FAILED, last_error=error)
+            return Job.FAILED
+        delay = backoff(job.attempts)
+        logger.warning("job %s failed, retrying in %.0fs: %s", job.pk, delay, error)
+        finish(
+            job,
+            worker,
+            status=Job.QUEUED,
+            last_error=error,
+            run_at=timezone.now() + datetime.timedelta(seconds=delay),
+        )
+        return Job.QUEUED
+    finish(job, worker, status=Job.DONE, last_error="")
+    return Job.DONE
+
+
+def new_worker_id():
+    return uuid.uuid4().hex
+
+
+def prune_jobs(retention=None, batch_size=1000):
+    """
+    delete jobs finished more than retention seconds
+    ago in batches, returns the number deleted
+    """
+    retention = settings.JOB_RETENTION if retention is None else retention
+    finished = Job.objects.filter(
+        status__in=[Job.DONE, Job.FAILED],
+        finished_at__lt=timezone.now() - datetime.timedelta(seconds=retention),
+    )
+    deleted = 0
+    while True:
+        ids = list(finished.values_list("pk", flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += Job.objects.filter(pk__in=ids).delete()[0]
+
+
+def work_once(worker, batch_size=10, lease=None):
+    """claim and run one batch, returns the number of jobs run"""
+    jobs = claim_jobs(worker, batch_size, lease)
+    for job in jobs:
+        run_job(job, worker)
+    return len(jobs)
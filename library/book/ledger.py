@@ -0,0 +1,178 @@
+"""append-only balance ledger
+
+every movement of money is a BalanceEntry that is inserted and never changed,
+a user's balance is their BalanceSnapshot plus the entries after its
+last_entry_id. Credits are a single insert without locks (they can never
+overdraw), debits lock the snapshot row, check the balance and insert. The
+snapshots are moved forward by take_snapshots() so a balance read only sums
+a short tail of entries, and reconcile() checks them against the ledger.
+"""
+import datetime
+import math
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import DecimalField, F, Max, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from core.models import (
+    CENT,
+    BalanceEntry,
+    BalanceSnapshot,
+    UserData,
+    balance_expression,
+)
+from .authentication import invalidate_snapshot
+
+
+class InsufficientBalance(Exception):
+    """a debit larger than the current balance"""
+
+
+def to_money(value):
+    """value as a Decimal rounded to cents, floats go through their shortest repr"""
+    return Decimal(str(value)).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def valid_topup(amount):
+    """
+    a JSON number worth at least a cent and at most
+    BALANCE_TOPUP_MAX, booleans are not amounts
+    """
+    if (
+        isinstance(amount, bool)
+        or not isinstance(amount, (int, float))
+        or not math.isfinite(amount)
+    ):
+        return False
+    # * bounds first, to_money() cannot quantize huge values
+    return 0 < amount <= settings.BALANCE_TOPUP_MAX and to_money(amount) >= CENT
+
+
+def credit(user_id, amount, kind=BalanceEntry.TOPUP):
+    """add amount to the user's balance, one INSERT"""
+    with transaction.atomic():
+        entry = BalanceEntry.objects.create(
+            user_id=user_id, amount=to_money(amount), kind=kind
+        )
+        transaction.on_commit(lambda: invalidate_snapshot(user_id))
+    return entry
+
+
+def lock_snapshot(user_id):
+    """
+    the user's snapshot row locked for the rest of
+    the transaction, created empty on first use
+    """
+    snapshot, _ = BalanceSnapshot.objects.select_for_update().get_or_create(
+        user_id=user_id
+    )
+    return snapshot
+
+
+def entries_after(user_id, after, upto=None):
+    """sum of the user's entries with after < id (<= upto)"""
+    entries = BalanceEntry.objects.filter(user_id=user_id, id__gt=after)
+    if upto is not None:
+        entries = entries.filter(id__lte=upto)
+    return entries.aggregate(total=Coalesce(Sum("amount"), Value(Decimal("0"))))[
+        "total"
+    ]
+
+
+def debit(user_id, amount, kind=BalanceEntry.PURCHASE):
+    """
+    take amount from the user's balance or raise InsufficientBalance, call it
+    inside the transaction that pays for something
+
+    the snapshot row lock serializes the debits of one user, so two of them
+    can never both pass the balance check on the same money
+    """
+    amount = to_money(amount)
+    snapshot = lock_snapshot(user_id)
+    if snapshot.balance + entries_after(user_id, snapshot.last_entry_id) < amount:
+        raise InsufficientBalance("Insufficient balance. Balance cannot be negative.")
+    return BalanceEntry.objects.create(user_id=user_id, amount=-amount, kind=kind)
+
+
+def take_snapshots(lag=None, batch_size=500):
+    """
+    fold the entries older than lag seconds into their users' snapshots, a
+    batch of users per transaction, and return the number of users moved on
+
+    ids are handed out before commit, so an entry committed late could get an
+    id below one already folded and would be skipped forever. Leaving the
+    newest lag seconds alone keeps well clear of any open transaction
+    """
+    lag = settings.BALANCE_SNAPSHOT_LAG if lag is None else lag
+    cutoff = timezone.now() - datetime.timedelta(seconds=lag)
+    pending = list(
+        BalanceEntry.objects.filter(created_at__lte=cutoff)
+        .filter(
+            Q(user__balance_snapshot__isnull=True)
+            | Q(id__gt=F("user__balance_snapshot__last_entry_id"))
+        )
+        .values("user_id")
+        .annotate(last=Max("id"))
+        .order_by("user_id")
+        .values_list("user_id", "last")
+    )
+    moved = 0
+    for start in range(0, len(pending), batch_size):
+        with transaction.atomic():
+            for user_id, last in pending[start : start + batch_size]:
+                snapshot = lock_snapshot(user_id)
+                if last <= snapshot.last_entry_id:
+                    continue
+                snapshot.balance += entries_after(
+                    user_id, snapshot.last_entry_id, upto=last
+                )
+                snapshot.last_entry_id = last
+                snapshot.save(update_fields=["balance", "last_entry_id", "taken_at"])
+                moved += 1
+    return moved
+
+
+def reconcile(repair=False):
+    """
+    check every snapshot against the entries it covers and every balance for
+    going negative, returns (mismatched snapshots, negative balances)
+
+    mismatches are (user id, snapshot balance, ledger sum) and with repair
+    the snapshot is rewritten from the ledger, which is the source of truth
+    """
+    money = DecimalField(max_digits=14, decimal_places=2)
+    covered = (
+        BalanceEntry.objects.filter(
+            user_id=OuterRef("user_id"), id__lte=OuterRef("last_entry_id")
+        )
+        .order_by()
+        .values("user_id")
+        .annotate(total=Sum("amount"))
+        .values("total")
+    )
+    snapshots = BalanceSnapshot.objects.annotate(
+        ledger=Coalesce(Subquery(covered), Value(Decimal("0")), output_field=money)
+    ).values_list("user_id", "balance", "ledger")
+    # * compared in Python, SQLite sums decimals as floats
+    mismatched = [
+        row for row in snapshots.iterator() if to_money(row[1]) != to_money(row[2])
+    ]
+    if repair:
+        for user_id, _, _ in mismatched:
+            with transaction.atomic():
+                snapshot = lock_snapshot(user_id)
+                snapshot.balance = entries_after(
+                    user_id, 0, upto=snapshot.last_entry_id
+                )
+                snapshot.save(update_fields=["balance", "taken_at"])
+            invalidate_snapshot(user_id)
+
+    negative = list(
+        UserData.objects.annotate(current=balance_expression())
+        .filter(current__lt=0)
+        .values_list("pk", "current")
+    )
+    return mismatched, negative
@@ -0,0 +1,114 @@
+"""compare slow-client download capacity of the WSGI and ASGI paths
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.models import BookData, PurchaseBook, UserData
+from book.benchmarks import benchmark_environment
+
+
+class InFlight:
+    """counter of open downloads that remembers its peak"""
+
+    def __init__(self):
+        self.current = self.peak = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        with self.lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def __exit__(self, *exc):
+        with self.lock:
+            self.current -= 1
+
+
+class Command(BaseCommand):
+    help = (
+        "Download one book with many slow clients through the sync view on a fixed "
+        "thread pool (WSGI) and through the async view on one event loop (ASGI)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--clients", type=int, default=200, help="concurrent downloads"
+        )
+        parser.add_argument(
+            "--workers", type=int, default=8, help="WSGI worker threads"
+        )
+        parser.add_argument(
+            "--size", type=int, default=512 * 1024, help="book file size in bytes"
+        )
+        parser.add_argument(
+            "--bandwidth",
+            type=int,
+            default=1024 * 1024,
+            help="bytes/s each client reads",
+        )
+
+    def handle(self, *args, **options):
+        with benchmark_environment():
+            user = UserData.objects.create_user(
+                "bench", "bench@example.com", None, last_name="bench"
+            )
+            book = BookData.objects.create(
+                book_name="bench", author_name="bench", book_amount=1, price=1.0
+            )
+            book.file.save(
+                "bench.pdf", ContentFile(b"%PDF-" + b"0" * (options["size"] - 5))
+            )
+            PurchaseBook.objects.create(user=user, book=book)
+            auth = f"Bearer {AccessToken.for_user(user)}"
+
+            wsgi = self.run_wsgi(f"/api/download/{book.id}/", auth, options)
+            asgi = asyncio.run(
+                self.run_asgi(f"/api/async/download/{book.id}/", auth, options)
+            )
+
+        self.stdout.write(
+            f"{'path':<6}{'clients':>9}{'peak open':>11}{'wall s':>9}{'MB/s':>9}"
+        )
+        total = options["clients"] * options["size"] / 1e6
+        for name, (peak, elapsed) in (("wsgi", wsgi), ("asgi", asgi)):
+            self.stdout.write(
+                f"{name:<6}{options['clients']:>9}{peak:>11}{elapsed:>9.2f}{total / elapsed:>9.1f}"
+            )
+
+    def run_wsgi(self, url, auth, options):
+        in_flight = InFlight()
+        bandwidth = options["bandwidth"]
+
+        def download(_):
+            response = Client().get(url, HTTP_AUTHORIZATION=auth)
+            with in_flight:
+                for chunk in response.streaming_content:
+                    time.sleep(len(chunk) / bandwidth)
+            response.close()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["workers"]) as pool:
+            list(pool.map(download, range(options["clients"])))
+        return in_flight.peak, time.perf_counter() - start
+
+    async def run_asgi(self, url, auth, options):
+        in_flight = InFlight()
+        bandwidth = options["bandwidth"]
+        client = AsyncClient()
+
+        async def download():
+            response = await client.get(url, headers={"Authorization": auth})
+            with in_flight:
+                async for chunk in response.streaming_content:
+                    await asyncio.sleep(len(chunk) / bandwidth)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(download() for _ in range(options["clients"])))
+        return in_flight.peak, time.perf_counter() - start
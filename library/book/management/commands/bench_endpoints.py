@@ -0,0 +1,558 @@
+"""load test every route of the book app against a seeded throwaway database
+"""
+import itertools
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import get_resolver, reverse
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from core.models import UserData
+from book.benchmarks import (
+    BENCH_PASSWORD,
+    QueryCounter,
+    benchmark_environment,
+    percentile,
+    seed_dataset,
+)
+from book.downloads import sign_download
+from book.otp import get_otp_store
+
+# * a regression needs to be this many milliseconds
+# * slower as well, so sub-millisecond noise is ignored
+LATENCY_FLOOR_MS = 1.0
+
+
+class Dataset:
+    """the seeded rows and a supply of (user, book) pairs nobody has bought yet"""
+
+    def __init__(self, users, books, bought, seed):
+        self.users = users
+        self.books = books
+        self.bought = list(bought)
+        self.by_pk = {user.pk: user for user in users}
+        self.tokens = {
+            user.pk: f"Bearer {AccessToken.for_user(user)}" for user in users
+        }
+        self.taken = set(bought)
+        self.order = {}
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def user(self, i):
+        return self.users[i % len(self.users)]
+
+    def book(self, i):
+        return self.books[i % len(self.books)]
+
+    def fresh_books(self, user, count):
+        """count books user has not bought, reserved so no other request buys them"""
+        with self.lock:
+            if user.pk not in self.order:
+                order = list(range(len(self.books)))
+                self.rng.shuffle(order)
+                self.order[user.pk] = iter(order)
+            picked = []
+            for index in self.order[user.pk]:
+                book = self.books[index]
+                if (user.pk, book.pk) not in self.taken:
+                    self.taken.add((user.pk, book.pk))
+                    picked.append(book)
+                    if len(picked) == count:
+                        return picked
+        raise CommandError(f"{user.username} has bought every book, seed more books.")
+
+
+def users_list(data, i):
+    return "get", reverse("user-list"), {}, data.user(i)
+
+
+def users_detail(data, i):
+    return "get", reverse("user-detail", args=[data.user(i + 1).pk]), {}, data.user(i)
+
+
+def api_root(data, i):
+    return "get", reverse("api-root"), {}, data.user(i)
+
+
+def books_list(data, i):
+    return "get", reverse("book-list"), {}, data.user(i)
+
+
+def books_sparse(data, i):
+    return (
+        "get",
+        reverse("book-list"),
+        {"data": {"fields": "id,book_name,price"}},
+        data.user(i),
+    )
+
+
+def books_search(data, i):
+    book = data.book(i)
+    query = {"search": book.book_name.split()[0], "max_price": "40", "in_stock": "true"}
+    return "get", reverse("book-list"), {"data": query}, data.user(i)
+
+
+def books_detail(data, i):
+    return "get", reverse("book-detail", args=[data.book(i).pk]), {}, data.user(i)
+
+
+def books_create(data, i):
+    upload = SimpleUploadedFile(
+        f"bench{i}.pdf", b"%PDF-" + str(i).encode() * 64, "application/pdf"
+    )
+    body = {
+        "book_name": f"upload {i}",
+        "author_name": "bench",
+        "book_amount": 5,
+        "price": 9.5,
+        "file": upload,
+    }
+    return "post", reverse("book-list"), {"data": body}, data.user(i)
+
+
+def books_update(data, i):
+    body = json.dumps({"price": 10 + i % 40})
+    return (
+        "patch",
+        reverse("book-detail", args=[data.book(i).pk]),
+        as_json(body),
+        data.user(i),
+    )
+
+
+def categories_list(data, i):
+    return "get", reverse("category-list"), {}, data.user(i)
+
+
+def categories_detail(data, i):
+    category_id = data.book(i).category_id
+    return "get", reverse("category-detail", args=[category_id]), {}, data.user(i)
+
+
+def login(data, i):
+    body = json.dumps({"username": data.user(i).username, "password": BENCH_PASSWORD})
+    return "post", reverse("login"), as_json(body), None
+
+
+def logout(data, i):
+    body = json.dumps({"refresh": str(RefreshToken.for_user(data.user(i)))})
+    return "post", reverse("token_blacklist"), as_json(body), None
+
+
+def purchase_request(data, i):
+    user = data.user(i)
+    (book,) = data.fresh_books(user, 1)
+    body = json.dumps({"book": str(book.pk), "quantity": 1})
+    return "post", reverse("purchase"), as_json(body), user
+
+
+def purchase_confirm(data, i):
+    user = data.user(i)
+    (book,) = data.fresh_books(user, 1)
+    code = get_otp_store().issue(
+        "purchase", user.pk, {"book": str(book.pk), "quantity": 1}
+    )
+    body = json.dumps({"book": str(book.pk), "quantity": 1, "otp_code": code})
+    return "put", reverse("purchase"), as_json(body), user
+
+
+def checkout_request(data, i):
+    user = data.user(i)
+    items = [
+        {"book": str(book.pk), "quantity": 1} for book in data.fresh_books(user, 3)
+    ]
+    return "post", reverse("checkout"), as_json(json.dumps({"items": items})), user
+
+
+def checkout_confirm(data, i):
+    user = data.user(i)
+    cart = [[str(book.pk), 1] for book in data.fresh_books(user, 3)]
+    code = get_otp_store().issue("checkout", user.pk, {"items": cart})
+    return "put", reverse("checkout"), as_json(json.dumps({"otp_code": code})), user
+
+
+def topup_request(data, i):
+    return (
+        "post",
+        reverse("balance_topup"),
+        as_json(json.dumps({"amount": 25})),
+        data.user(i),
+    )
+
+
+def topup_confirm(data, i):
+    user = data.user(i)
+    code = get_otp_store().issue("topup", user.pk, {"amount": 25})
+    return (
+        "put",
+        reverse("balance_topup"),
+        as_json(json.dumps({"amount": 25, "otp_code": code})),
+        user,
+    )
+
+
+def bought(data, i):
+    user_id, book_id = data.bought[i % len(data.bought)]
+    return book_id, data.by_pk[user_id]
+
+
+def purchases_list(data, i):
+    _, user = bought(data, i)
+    return "get", reverse("purchase_list"), {}, user
+
+
+def download(data, i):
+    book_id, user = bought(data, i)
+    return "get", reverse("download_book", args=[book_id]), {}, user
+
+
+def download_link(data, i):
+    book_id, user = bought(data, i)
+    return "get", reverse("download_link", args=[book_id]), {}, user
+
+
+def signed_download(data, i):
+    book_id, user = bought(data, i)
+    token, _ = sign_download(book_id, data.books[0].file.name, user.pk)
+    return (
+        "get",
+        reverse("signed_download", args=[book_id]),
+        {"data": {"token": token}},
+        None,
+    )
+
+
+def async_books_list(data, i):
+    return "get", reverse("async_book_list"), {}, data.user(i)
+
+
+def async_books_detail(data, i):
+    return "get", reverse("async_book_detail", args=[data.book(i).pk]), {}, data.user(i)
+
+
+def async_categories_list(data, i):
+    return "get", reverse("async_category_list"), {}, data.user(i)
+
+
+def async_download(data, i):
+    book_id, user = bought(data, i)
+    return "get", reverse("async_download_book", args=[book_id]), {}, user
+
+
+def export_books(data, i):
+    return "get", reverse("export_books"), {}, data.user(i)
+
+
+def export_purchases(data, i):
+    return (
+        "get",
+        reverse("export_purchases"),
+        {"data": {"output": "json"}},
+        data.user(i),
+    )
+
+
+def request_metrics(data, i):
+    return "get", reverse("request_metrics"), {}, data.users[0]
+
+
+def sales_analytics(data, i):
+    group = ("day", "book", "category")[i % 3]
+    return "get", reverse("sales_analytics"), {"data": {"group": group}}, data.users[0]
+
+
+def as_json(body):
+    return {"data": body, "content_type": "application/json"}
+
+
+# * (route name, label, request builder), reads
+# * first so writes do not change what they measure
+ENDPOINTS = [
+    ("api-root", "GET api/", api_root),
+    ("user-list", "GET users", users_list),
+    ("user-detail", "GET users/<id>", users_detail),
+    ("book-list", "GET books", books_list),
+    ("book-list", "GET books?fields", books_sparse),
+    ("book-list", "GET books?search", books_search),
+    ("book-detail", "GET books/<id>", books_detail),
+    ("category-list", "GET categories", categories_list),
+    ("category-detail", "GET categories/<id>", categories_detail),
+    ("async_book_list", "GET async/books", async_books_list),
+    ("async_book_detail", "GET async/books/<id>", async_books_detail),
+    ("async_category_list", "GET async/categories", async_categories_list),
+    ("purchase_list", "GET purchases", purchases_list),
+    ("download_book", "GET download", download),
+    ("download_link", "GET download/link", download_link),
+    ("signed_download", "GET download/signed", signed_download),
+    ("async_download_book", "GET async/download", async_download),
+    ("export_books", "GET export/books", export_books),
+    ("export_purchases", "GET export/purchases", export_purchases),
+    ("request_metrics", "GET metrics", request_metrics),
+    ("sales_analytics", "GET analytics/sales", sales_analytics),
+    ("login", "POST login", login),
+    ("token_blacklist", "POST logout", logout),
+    ("purchase", "POST purchase", purchase_request),
+    ("purchase", "PUT purchase", purchase_confirm),
+    ("checkout", "POST checkout", checkout_request),
+    ("checkout", "PUT checkout", checkout_confirm),
+    ("balance_topup", "POST topup", topup_request),
+    ("balance_topup", "PUT topup", topup_confirm),
+    ("book-list", "POST books", books_create),
+    ("book-detail", "PATCH books/<id>", books_update),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed books, users and purchases into a throwaway database and drive every route "
+        "of book/urls.py concurrently, reporting throughput, latency percentiles and SQL "
+        "queries per endpoint. Run with DATABASE_ENGINE=sqlite for the SQLite numbers."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--books", type=int, default=2000)
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument("--purchases", type=int, default=5000)
+        parser.add_argument(
+            "--requests", type=int, default=200, help="requests per endpoint"
+        )
+        parser.add_argument("--concurrency", type=int, default=8, help="client threads")
+        parser.add_argument(
+            "--warmup", type=int, default=20, help="untimed requests per endpoint first"
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--only",
+            action="append",
+            default=[],
+            help="run endpoints whose label contains this",
+        )
+        parser.add_argument(
+            "--baseline", default="bench_baseline.json", help="baseline file"
+        )
+        parser.add_argument(
+            "--save-baseline",
+            action="store_true",
+            help="write the results to --baseline",
+        )
+        parser.add_argument(
+            "--compare",
+            action="store_true",
+            help="fail if results regressed from --baseline",
+        )
+        parser.add_argument(
+            "--tolerance", type=float, default=0.5, help="allowed relative slowdown"
+        )
+
+    def handle(self, *args, **options):
+        if options["purchases"] < 1:
+            raise CommandError(
+                "--purchases must be at least 1, the download routes need one."
+            )
+        endpoints = [
+            endpoint
+            for endpoint in ENDPOINTS
+            if not options["only"]
+            or any(word in endpoint[1] for word in options["only"])
+        ]
+        self.warn_uncovered()
+
+        # * throttles still run, with rates no benchmark reaches
+        rest_framework = {
+            **settings.REST_FRAMEWORK,
+            "DEFAULT_THROTTLE_RATES": {
+                scope: "1000000/s"
+                for scope in settings.REST_FRAMEWORK["DEFAULT_THROTTLE_RATES"]
+            },
+        }
+        with benchmark_environment(), override_settings(
+            TEST_ENVIRONMENT=True,
+            REST_FRAMEWORK=rest_framework,
+            THROTTLE_BUCKET_STORE="book.throttling.LocalBucketStore",
+        ):
+            users, books, bought = seed_dataset(
+                options["books"],
+                options["users"],
+                options["purchases"],
+                seed=options["seed"],
+            )
+            # * the first user reads the superuser only metrics and analytics endpoints
+            UserData.objects.filter(pk=users[0].pk).update(is_superuser=True)
+            data = Dataset(users, books, bought, options["seed"])
+            results = {
+                label: self.run_endpoint(label, build, data, options)
+                for _, label, build in endpoints
+            }
+
+        self.report(results)
+        params = {
+            key: options[key]
+            for key in ("books", "users", "purchases", "requests", "concurrency")
+        }
+        if options["compare"]:
+            self.compare(results, params, options)
+        if options["save_baseline"]:
+            with open(options["baseline"], "w") as file:
+                json.dump({"params": params, "results": results}, file, indent=2)
+            self.stdout.write(f"baseline saved to {options['baseline']}")
+
+    def warn_uncovered(self):
+        names = {
+            name
+            for name in get_resolver("book.urls").reverse_dict
+            if isinstance(name, str)
+        }
+        missing = sorted(names - {name for name, _, _ in ENDPOINTS})
+        if missing:
+            self.stderr.write(f"routes without a benchmark: {', '.join(missing)}")
+
+    def run_endpoint(self, label, build, data, options):
+        """
+        send --warmup then --requests requests from --concurrency threads, one
+        Client per thread, and measure the second batch
+        """
+        local = threading.local()
+        counter = itertools.count()
+        timings, queries, errors = [], [], []
+
+        def send(record):
+            if not hasattr(local, "client"):
+                local.client = Client(raise_request_exception=False)
+            i = next(counter)
+            method, path, kwargs, user = build(data, i)
+            if user is not None:
+                kwargs["HTTP_AUTHORIZATION"] = data.tokens[user.pk]
+            queries_run = QueryCounter()
+            with connection.execute_wrapper(queries_run):
+                start = time.perf_counter()
+                response = getattr(local.client, method)(path, **kwargs)
+                if response.streaming:
+                    drain(response)
+                elapsed = time.perf_counter() - start
+            response.close()
+            if not record:
+                return
+            timings.append(elapsed * 1000)
+            queries.append(queries_run.count)
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+            list(pool.map(send, [False] * options["warmup"]))
+            start = time.perf_counter()
+            list(pool.map(send, [True] * options["requests"]))
+            wall = time.perf_counter() - start
+            close_thread_connections(pool, options["concurrency"])
+
+        if errors:
+            self.stderr.write(
+                f"{label}: {len(errors)} failed requests, statuses {sorted(set(errors))}"
+            )
+        return {
+            "requests": len(timings),
+            "errors": len(errors),
+            "rps": round(len(timings) / wall, 1),
+            "p50": round(percentile(timings, 50), 2),
+            "p95": round(percentile(timings, 95), 2),
+            "p99": round(percentile(timings, 99), 2),
+            "queries": percentile(queries, 50),
+            "max_queries": max(queries),
+        }
+
+    def report(self, results):
+        self.stdout.write(
+            f"{'endpoint':<24}{'reqs':>6}{'errors':>8}{'req/s':>9}"
+            f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}"
+        )
+        for label, row in results.items():
+            self.stdout.write(
+                f"{label:<24}{row['requests']:>6}{row['errors']:>8}{row['rps']:>9.1f}"
+                f"{row['p50']:>9.2f}{row['p95']:>9.2f}{row['p99']:>9.2f}{row['queries']:>9}"
+            )
+
+    def compare(self, results, params, options):
+        try:
+            with open(options["baseline"]) as file:
+                baseline = json.load(file)
+        except FileNotFoundError:
+            raise CommandError(
+                f"no baseline at {options['baseline']}, run with --save-baseline first."
+            )
+        if baseline["params"] != params:
+            self.stderr.write(
+                f"baseline was recorded with {baseline['params']}, numbers may not compare"
+            )
+
+        tolerance = options["tolerance"]
+        regressions = []
+        for label, row in results.items():
+            old = baseline["results"].get(label)
+            if old is None:
+                continue
+            if row["queries"] > old["queries"]:
+                regressions.append(
+                    f"{label}: {old['queries']} -> {row['queries']} queries"
+                )
+            if row["errors"] > old["errors"]:
+                regressions.append(
+                    f"{label}: {old['errors']} -> {row['errors']} errors"
+                )
+            # * p99 of a few hundred requests is a single
+            # * outlier, it is reported but not compared
+            for key in ("p50", "p95"):
+                if (
+                    row[key] > old[key] * (1 + tolerance)
+                    and row[key] - old[key] > LATENCY_FLOOR_MS
+                ):
+                    regressions.append(f"{label}: {key} {old[key]} -> {row[key]} ms")
+            if row["rps"] < old["rps"] * (1 - tolerance):
+                regressions.append(f"{label}: {old['rps']} -> {row['rps']} req/s")
+
+        if regressions:
+            for line in regressions:
+                self.stderr.write(f"regression {line}")
+            raise CommandError(
+                f"{len(regressions)} regressions against {options['baseline']}"
+            )
+        self.stdout.write(f"no regressions against {options['baseline']}")
+
+
+def drain(response):
+    """read a streamed body to the end, the way a client would"""
+    if response.is_async:
+        async_to_sync(adrain)(response.streaming_content)
+    else:
+        for _ in response.streaming_content:
+            pass
+
+
+async def adrain(content):
+    async for _ in content:
+        pass
+
+
+def close_thread_connections(pool, threads):
+    """
+    close the database connection each pool thread
+    opened, so the test database can be dropped
+    """
+    barrier = threading.Barrier(threads)
+
+    def close(_):
+        # * holding every thread at the barrier makes each one run exactly one close
+        barrier.wait()
+        connections.close_all()
+
+    list(pool.map(close, range(threads)))
@@ -0,0 +1,175 @@
+"""compare purchase inserts with random and time ordered keys, and the
+"already purchased" check with and without its (user, book) index
+"""
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection, transaction
+
+from core.ids import uuid7
+from core.models import PurchaseBook
+from book.benchmarks import benchmark_environment, percentile, seed_dataset
+
+KEY_SCHEMES = {"uuid4": uuid.uuid4, "uuid7": uuid7}
+
+
+class Command(BaseCommand):
+    help = (
+        "Insert purchases one transaction each on top of an existing table, with uuid4 and "
+        "with uuid7 primary keys, then time the already-purchased check with and without "
+        "the (user, book) unique index."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--books", type=int, default=1000)
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument(
+            "--existing",
+            type=int,
+            default=100000,
+            help="purchases in the table before timing",
+        )
+        parser.add_argument(
+            "--rows", type=int, default=10000, help="purchases inserted while timing"
+        )
+        parser.add_argument(
+            "--checks", type=int, default=2000, help="already-purchased checks timed"
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        pairs_needed = options["existing"] + options["rows"]
+        if pairs_needed > options["books"] * options["users"]:
+            self.stderr.write("--existing + --rows must not exceed --books * --users")
+            return
+
+        with benchmark_environment():
+            users, books, _ = seed_dataset(
+                options["books"], options["users"], 0, seed=options["seed"]
+            )
+            rng = random.Random(options["seed"])
+            # * distinct (user, book) pairs, the unique index allows each only once
+            pairs = [
+                (users[index // len(books)].pk, books[index % len(books)].pk)
+                for index in rng.sample(range(len(users) * len(books)), pairs_needed)
+            ]
+            existing, timed = pairs[: options["existing"]], pairs[options["existing"] :]
+
+            self.stdout.write(
+                f"{'keys':<7}{'rows':>8}{'rows/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'pk index':>12}"
+            )
+            for name, new_key in KEY_SCHEMES.items():
+                rate, latencies, index_size = self.run_inserts(new_key, existing, timed)
+                self.stdout.write(
+                    f"{name:<7}{len(timed):>8}{rate:>10.0f}{percentile(latencies, 50):>9.3f}"
+                    f"{percentile(latencies, 99):>9.3f}{index_size:>12}"
+                )
+
+            PurchaseBook.objects.bulk_create(
+                (
+                    PurchaseBook(id=uuid7(), user_id=user_id, book_id=book_id)
+                    for user_id, book_id in existing
+                ),
+                batch_size=1000,
+            )
+            probes = [
+                rng.choice(existing) if i % 2 else rng.choice(timed)
+                for i in range(options["checks"])
+            ]
+            self.stdout.write(
+                f"\n{'already purchased check':<26}{'p50 ms':>9}{'p99 ms':>9}  plan"
+            )
+            self.stdout.write(self.format_check("unique (user, book)", probes))
+            # * SQLite drops a constraint by rebuilding the
+            # * table from _meta, so take it out there too
+            constraints = PurchaseBook._meta.constraints
+            unique = next(
+                c for c in constraints if c.name == "purchasebook_user_book_uniq"
+            )
+            PurchaseBook._meta.constraints = [c for c in constraints if c is not unique]
+            try:
+                with connection.schema_editor() as editor:
+                    editor.remove_constraint(PurchaseBook, unique)
+                self.stdout.write(self.format_check("(user, date) index only", probes))
+            finally:
+                PurchaseBook._meta.constraints = constraints
+
+    def run_inserts(self, new_key, existing, timed):
+        """prefill the table, time one insert per transaction, empty the table again"""
+        PurchaseBook.objects.bulk_create(
+            (
+                PurchaseBook(id=new_key(), user_id=user_id, book_id=book_id)
+                for user_id, book_id in existing
+            ),
+            batch_size=1000,
+        )
+        latencies = []
+        start = time.perf_counter()
+        for user_id, book_id in timed:
+            began = time.perf_counter()
+            with transaction.atomic():
+                PurchaseBook.objects.create(
+                    id=new_key(), user_id=user_id, book_id=book_id, unit_price=1.0
+                )
+            latencies.append((time.perf_counter() - began) * 1000)
+        rate = len(timed) / (time.perf_counter() - start)
+        index_size = self.primary_key_size()
+        self.empty_table()
+        return rate, latencies, index_size
+
+    def empty_table(self):
+        """
+        delete every purchase and give the pages back,
+        so the next run starts from a fresh B-tree
+        """
+        table = connection.ops.quote_name(PurchaseBook._meta.db_table)
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute(f"TRUNCATE {table}")
+            else:
+                cursor.execute(f"DELETE FROM {table}")
+                if connection.vendor == "sqlite":
+                    cursor.execute("VACUUM")
+
+    def primary_key_size(self):
+        """bytes used by the purchase primary key index, where the backend can tell"""
+        table = PurchaseBook._meta.db_table
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute(
+                    "SELECT pg_relation_size(indexrelid) FROM pg_index"
+                    " WHERE indrelid = %s::regclass AND indisprimary",
+                    [table],
+                )
+                return cursor.fetchone()[0]
+            if connection.vendor == "sqlite":
+                try:
+                    cursor.execute(
+                        "SELECT SUM(pgsize) FROM dbstat WHERE name = "
+                        "(SELECT name FROM pragma_index_list(%s) WHERE origin = 'pk')",
+                        [table],
+                    )
+                except DatabaseError:
+                    # * dbstat is an optional SQLite build
+                    return "n/a"
+                return cursor.fetchone()[0] or "n/a"
+        return "n/a"
+
+    def format_check(self, label, probes):
+        latencies = []
+        for user_id, book_id in probes:
+            began = time.perf_counter()
+            PurchaseBook.objects.filter(user_id=user_id, book_id=book_id).exists()
+            latencies.append((time.perf_counter() - began) * 1000)
+        user_id, book_id = probes[0]
+        plan = " ".join(
+            PurchaseBook.objects.filter(user_id=user_id, book_id=book_id)
+            .explain()
+            .split()
+        )
+        return (
+            f"{label:<26}{percentile(latencies, 50):>9.3f}"
+            f"{percentile(latencies, 99):>9.3f}  {plan[:90]}"
+        )
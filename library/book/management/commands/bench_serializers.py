@@ -0,0 +1,115 @@
+"""per row CPU cost of the serializer and values() read paths
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from core.models import BookData, Category, PurchaseBook, UserData
+from core.serializers import (
+    BookDataSerializer,
+    CategorySerializer,
+    PurchaseBookSerializer,
+    UserDataSerializer,
+)
+from book.benchmarks import benchmark_environment, seed_dataset
+from book.renderers import FastJSONRenderer
+
+# * (label, serializer, queryset, sparse fieldset), users
+# * leave out purchased_books, which has no values() column
+TARGETS = [
+    ("books", BookDataSerializer, lambda: BookData.objects.all(), "id,book_name,price"),
+    ("categories", CategorySerializer, lambda: Category.objects.all(), "name"),
+    ("users", UserDataSerializer, lambda: UserData.objects.all(), "id,username"),
+    (
+        "purchases",
+        PurchaseBookSerializer,
+        lambda: PurchaseBook.objects.all(),
+        "book,quantity",
+    ),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Time fetching, serializing and rendering the same rows through the serializers "
+        "(all fields and a sparse fieldset) and through the values() plan with the orjson "
+        "renderer, and print the cost per row of each stage."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows", type=int, default=5000, help="books, users and purchases seeded"
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=5, help="runs per path, the fastest counts"
+        )
+
+    def handle(self, *args, **options):
+        with benchmark_environment():
+            rows = options["rows"]
+            seed_dataset(rows, max(1, rows // 10), rows, categories=min(rows, 200))
+
+            self.stdout.write(
+                f"{'target':<11}{'path':<34}{'rows':>7}{'fetch us':>10}"
+                f"{'serialize us':>14}{'render us':>11}{'total us':>10}"
+            )
+            for label, serializer_class, queryset, sparse in TARGETS:
+                for path, fields in (
+                    ("serializer", None),
+                    ("values plan", None),
+                    ("serializer", sparse),
+                    ("values plan", sparse),
+                ):
+                    if label == "users" and fields is None:
+                        fields = "omit"
+                    name = (
+                        path
+                        if fields is None
+                        else f"{path} {'-purchased_books' if fields == 'omit' else fields}"
+                    )
+                    timings = min(
+                        (
+                            self.run_path(serializer_class, queryset(), path, fields)
+                            for _ in range(options["repeat"])
+                        ),
+                        key=lambda timing: sum(timing[1:]),
+                    )
+                    count, *stages = timings
+                    per_row = [stage / max(count, 1) * 1e6 for stage in stages]
+                    self.stdout.write(
+                        f"{label:<11}{name:<34}{count:>7}{per_row[0]:>10.2f}"
+                        f"{per_row[1]:>14.2f}{per_row[2]:>11.2f}{sum(per_row):>10.2f}"
+                    )
+
+    def run_path(self, serializer_class, queryset, path, fields):
+        """(rows, fetch seconds, serialize seconds, render seconds) of one pass"""
+        query = (
+            "omit=purchased_books"
+            if fields == "omit"
+            else (f"fields={fields}" if fields else "")
+        )
+        request = Request(APIRequestFactory().get(f"/bench/?{query}"))
+        names = serializer_class.requested_fields(request)
+
+        start = time.perf_counter()
+        if path == "serializer":
+            queryset = serializer_class.setup_eager_loading(queryset, names).only(
+                *serializer_class.only_columns(names)
+            )
+            rows = list(queryset.order_by("pk"))
+            fetched = time.perf_counter()
+            data = serializer_class(rows, many=True, context={"request": request}).data
+            serialized = time.perf_counter()
+            JSONRenderer().render(data)
+        else:
+            plan = serializer_class.values_plan(names)
+            rows = list(queryset.order_by("pk").values(*plan.columns))
+            fetched = time.perf_counter()
+            data = plan.render(rows, request)
+            serialized = time.perf_counter()
+            FastJSONRenderer().render(data)
+        rendered = time.perf_counter()
+        return len(rows), fetched - start, serialized - fetched, rendered - serialized
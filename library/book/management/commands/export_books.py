@@ -0,0 +1,39 @@
+"""stream BookData out as CSV or JSONL
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from book.catalog_io import encode_csv, encode_jsonl, export_rows
+
+
+class Command(BaseCommand):
+    help = "Export the catalog as CSV or JSONL in the format import_books reads."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", choices=["csv", "jsonl"], default="jsonl")
+        parser.add_argument("--output", default="-", help="file to write, - for stdout")
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=2000,
+            help="rows fetched per database round trip",
+        )
+
+    def handle(self, *args, **options):
+        encode = encode_csv if options["format"] == "csv" else encode_jsonl
+        self.count = 0
+        chunks = encode(self.counted(export_rows(chunk_size=options["chunk_size"])))
+        if options["output"] == "-":
+            for chunk in chunks:
+                self.stdout.write(chunk, ending="")
+        else:
+            try:
+                with open(options["output"], "w", encoding="utf-8", newline="") as file:
+                    file.writelines(chunks)
+            except OSError as exc:
+                raise CommandError(str(exc))
+        self.stderr.write(f"{self.count} books exported")
+
+    def counted(self, rows):
+        for row in rows:
+            self.count += 1
+            yield row
@@ -0,0 +1,81 @@
+"""stream a CSV or JSONL catalog feed into BookData
+"""
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from book.catalog_io import CatalogImporter, RowError, clean_row, read_rows
+
+
+class Command(BaseCommand):
+    help = (
+        "Import books from CSV or JSONL (columns book_name, author_name, book_amount, price, "
+        "category, public). Rows are upserted on (book_name, author_name) in batches, "
+        "categories are matched or created by name."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="file to read, - for stdin")
+        parser.add_argument(
+            "--format",
+            choices=["csv", "jsonl"],
+            help="default: from the file extension",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--max-errors", type=int, default=None, help="stop after this many bad rows"
+        )
+
+    def handle(self, *args, **options):
+        fmt = options["format"] or self.guess_format(options["path"])
+        importer = CatalogImporter(batch_size=options["batch_size"])
+        batch, read, errors = [], 0, 0
+
+        with self.open(options["path"]) as file:
+            for line_num, raw in read_rows(file, fmt):
+                read += 1
+                try:
+                    batch.append(clean_row(raw))
+                except RowError as exc:
+                    errors += 1
+                    self.stderr.write(f"line {line_num}: {exc}")
+                    if (
+                        options["max_errors"] is not None
+                        and errors > options["max_errors"]
+                    ):
+                        raise CommandError(
+                            f"more than {options['max_errors']} bad rows, "
+                            f"stopped at line {line_num}"
+                        )
+                if len(batch) >= options["batch_size"]:
+                    importer.write(batch)
+                    batch = []
+                    self.progress(read, importer, errors)
+            if batch or not read:
+                importer.write(batch)
+                self.progress(read, importer, errors)
+
+        self.stdout.write(self.style.SUCCESS("import finished"))
+
+    def progress(self, read, importer, errors):
+        self.stdout.write(
+            f"{read} rows read, {importer.created} created, {importer.updated} updated, "
+            f"{importer.unchanged} unchanged, {errors} errors"
+        )
+
+    @staticmethod
+    def guess_format(path):
+        extension = os.path.splitext(path)[1].lower()
+        if extension in (".csv", ".jsonl"):
+            return extension[1:]
+        raise CommandError("cannot tell the format from the file name, pass --format")
+
+    @staticmethod
+    def open(path):
+        if path == "-":
+            return open(sys.stdin.fileno(), encoding="utf-8", newline="", closefd=False)
+        try:
+            return open(path, encoding="utf-8", newline="")
+        except OSError as exc:
+            raise CommandError(str(exc))
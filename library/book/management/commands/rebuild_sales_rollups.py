@@ -0,0 +1,34 @@
+"""recompute the daily sales rollups from PurchaseBook
+"""
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from book.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild BookSalesDaily and CategorySalesDaily from the purchase history, all days "
+        "or the days from --since on. Run it while no purchases are being committed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", help="first day to rebuild, YYYY-MM-DD")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        since = None
+        if options["since"]:
+            try:
+                since = datetime.date.fromisoformat(options["since"])
+            except ValueError:
+                raise CommandError(
+                    f"--since {options['since']!r} is not a YYYY-MM-DD date"
+                )
+        books, categories = rebuild_rollups(since, batch_size=options["batch_size"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{books} book and {categories} category rollup rows written"
+            )
+        )
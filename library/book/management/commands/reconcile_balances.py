@@ -0,0 +1,37 @@
+"""verify the balance snapshots against the ledger
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from book.ledger import reconcile
+
+
+class Command(BaseCommand):
+    help = (
+        "Check that every balance snapshot equals the sum of the ledger entries it covers and "
+        "that no balance is negative. Exits with an error when anything is off."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--repair",
+            action="store_true",
+            help="rewrite mismatched snapshots from the ledger",
+        )
+
+    def handle(self, *args, **options):
+        mismatched, negative = reconcile(repair=options["repair"])
+        for user_id, balance, ledger in mismatched:
+            self.stdout.write(
+                f"snapshot of {user_id} is {balance}, its entries sum to {ledger}"
+            )
+        for user_id, balance in negative:
+            self.stdout.write(f"balance of {user_id} is negative: {balance}")
+
+        if mismatched and options["repair"]:
+            self.stdout.write(f"{len(mismatched)} snapshots rewritten from the ledger")
+            mismatched = []
+        if mismatched or negative:
+            raise CommandError(
+                f"{len(mismatched)} mismatched snapshots, {len(negative)} negative balances"
+            )
+        self.stdout.write("ledger and snapshots agree")
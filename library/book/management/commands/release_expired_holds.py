@@ -0,0 +1,39 @@
+"""give the stock of expired purchase holds back to their books
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError
+
+from book.reservations import release_expired_holds
+
+
+class Command(BaseCommand):
+    help = "Release expired stock reservations in bulk, once or every --every seconds."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=500, help="holds released per transaction"
+        )
+        parser.add_argument(
+            "--every",
+            type=float,
+            default=None,
+            help="keep running, sweeping at this interval",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                released = release_expired_holds(options["batch_size"])
+            except DatabaseError as exc:
+                if options["every"] is None:
+                    raise
+                # * a busy database only delays the sweep to the next round
+                self.stderr.write(f"sweep failed: {exc}")
+            else:
+                if released or options["every"] is None:
+                    self.stdout.write(f"{released} expired holds released")
+            if options["every"] is None:
+                return
+            time.sleep(options["every"])
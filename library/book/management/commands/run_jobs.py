@@ -0,0 +1,109 @@
+"""background job worker
+"""
+import signal
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection
+
+from book.jobs import new_worker_id, prune_jobs, work_once
+
+
+class Command(BaseCommand):
+    help = (
+        "Run queued background jobs (OTP and receipt mails, ...) in --threads worker "
+        "threads until SIGINT or SIGTERM, or with --once until the queue is empty. "
+        "Jobs finished more than JOB_RETENTION seconds ago are deleted every "
+        "--prune-every seconds."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=2,
+            help="worker threads, each claims its own batches",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=10, help="jobs claimed per query"
+        )
+        parser.add_argument(
+            "--lease",
+            type=int,
+            default=None,
+            help="seconds a claim lasts, JOB_LEASE by default",
+        )
+        parser.add_argument(
+            "--poll",
+            type=float,
+            default=1.0,
+            help="seconds to wait when the queue is empty",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="run until the queue is empty, then exit",
+        )
+        parser.add_argument(
+            "--prune-every",
+            type=float,
+            default=3600,
+            help="seconds between deletes of old finished jobs",
+        )
+
+    def handle(self, *args, **options):
+        self.stopping = threading.Event()
+        if not options["once"]:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, lambda *_: self.stopping.set())
+
+        threads = [
+            threading.Thread(
+                target=self.work, args=(options,), name=f"jobs-{index}", daemon=True
+            )
+            for index in range(max(1, options["threads"]))
+        ]
+        for thread in threads:
+            thread.start()
+        # * join with a timeout, a bare join would
+        # * not let the main thread take the signal
+        next_prune = 0
+        while any(thread.is_alive() for thread in threads):
+            if not options["once"] and time.monotonic() >= next_prune:
+                self.prune()
+                next_prune = time.monotonic() + options["prune_every"]
+            for thread in threads:
+                thread.join(timeout=0.5)
+        self.stdout.write("workers stopped")
+
+    def prune(self):
+        try:
+            deleted = prune_jobs()
+        except DatabaseError as exc:
+            self.stderr.write(f"pruning finished jobs failed: {exc}")
+        else:
+            if deleted:
+                self.stdout.write(f"{deleted} finished jobs deleted")
+        finally:
+            connection.close()
+
+    def work(self, options):
+        worker = new_worker_id()
+        try:
+            while not self.stopping.is_set():
+                try:
+                    ran = work_once(worker, options["batch_size"], options["lease"])
+                except DatabaseError as exc:
+                    # * a busy or restarting database only
+                    # * delays the jobs to the next round
+                    self.stderr.write(f"worker {worker} failed to claim jobs: {exc}")
+                    connection.close()
+                    ran = 0
+                if not ran:
+                    if options["once"]:
+                        return
+                    self.stopping.wait(options["poll"])
+        finally:
+            # * every thread has its own connection
+            connection.close()
@@ -0,0 +1,50 @@
+"""move balance snapshots forward over the ledger entries written since
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError
+
+from book.ledger import take_snapshots
+
+
+class Command(BaseCommand):
+    help = (
+        "Fold settled balance ledger entries into the per-user snapshots, once or "
+        "every --every seconds."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--lag",
+            type=int,
+            default=None,
+            help="leave entries younger than this many seconds (BALANCE_SNAPSHOT_LAG)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="users snapshotted per transaction",
+        )
+        parser.add_argument(
+            "--every",
+            type=float,
+            default=None,
+            help="keep running, snapshotting at this interval",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                moved = take_snapshots(options["lag"], options["batch_size"])
+            except DatabaseError as exc:
+                if options["every"] is None:
+                    raise
+                self.stderr.write(f"snapshot failed: {exc}")
+            else:
+                if moved or options["every"] is None:
+                    self.stdout.write(f"{moved} balance snapshots moved forward")
+            if options["every"] is None:
+                return
+            time.sleep(options["every"])
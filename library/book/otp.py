@@ -0,0 +1,159 @@
+"""one time passwords for purchase, checkout and top-up confirmation
+
+codes are kept per purpose and per user, expire after OTP_TTL seconds, allow
+OTP_MAX_ATTEMPTS wrong guesses and are consumed atomically by a successful
+verify(), so a code can confirm exactly one operation of one kind. The store
+class is chosen with the OTP_STORE setting.
+"""
+import secrets
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+class OTPError(Exception):
+    """a code that cannot be accepted, the message is safe to show to the user"""
+
+
+def generate_code():
+    return str(1000 + secrets.randbelow(9000))
+
+
+class OTPStore:
+    """
+    base store, subclasses keep one entry per (purpose, user) made of the
+    code, the context it was issued for and the number of attempts
+    """
+
+    def __init__(self):
+        self.ttl = settings.OTP_TTL
+        self.max_attempts = settings.OTP_MAX_ATTEMPTS
+
+    def issue(self, purpose, user_id, context=None):
+        """replace any pending code for purpose and return a new one"""
+        raise NotImplementedError
+
+    def verify(self, purpose, user_id, code, context=None):
+        """
+        consume the pending code and return its context
+
+        when context is given it must equal the one the code was issued for
+        """
+        raise NotImplementedError
+
+    def pending(self, purpose, user_id):
+        """
+        the code waiting to be verified, None once it expired or was used, for delivery
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def key(purpose, user_id):
+        return f"otp:{purpose}:{user_id}"
+
+    @staticmethod
+    def matches(entry, code, context):
+        return secrets.compare_digest(entry["code"], str(code)) and (
+            context is None or entry["context"] == context
+        )
+
+
+class InMemoryOTPStore(OTPStore):
+    """process local store, for tests and single process development"""
+
+    def __init__(self):
+        super().__init__()
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def issue(self, purpose, user_id, context=None):
+        code = generate_code()
+        with self.lock:
+            self.entries[self.key(purpose, user_id)] = {
+                "code": code,
+                "context": context,
+                "attempts": 0,
+                "expires": time.monotonic() + self.ttl,
+            }
+        return code
+
+    def verify(self, purpose, user_id, code, context=None):
+        key = self.key(purpose, user_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry["expires"] < time.monotonic():
+                self.entries.pop(key, None)
+                raise OTPError("OTP expired or already used.")
+            entry["attempts"] += 1
+            if entry["attempts"] > self.max_attempts:
+                del self.entries[key]
+                raise OTPError("Too many attempts, request a new OTP.")
+            if not self.matches(entry, code, context):
+                raise OTPError("Invalid OTP code.")
+            del self.entries[key]
+            return entry["context"]
+
+    def pending(self, purpose, user_id):
+        with self.lock:
+            entry = self.entries.get(self.key(purpose, user_id))
+            if entry is None or entry["expires"] < time.monotonic():
+                return None
+            return entry["code"]
+
+
+class CacheOTPStore(OTPStore):
+    """
+    store in a Django cache, shared between workers when the cache is
+
+    attempts are counted with cache.incr() and consumption relies on
+    cache.delete() reporting whether it removed the key, so of two concurrent
+    requests with the right code only one succeeds
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.cache = caches[settings.OTP_CACHE_ALIAS]
+
+    def issue(self, purpose, user_id, context=None):
+        code = generate_code()
+        key = self.key(purpose, user_id)
+        self.cache.set_many(
+            {key: {"code": code, "context": context}, f"{key}:attempts": 0}, self.ttl
+        )
+        return code
+
+    def verify(self, purpose, user_id, code, context=None):
+        key = self.key(purpose, user_id)
+        entry = self.cache.get(key)
+        if entry is None:
+            raise OTPError("OTP expired or already used.")
+        try:
+            attempts = self.cache.incr(f"{key}:attempts")
+        except ValueError:
+            raise OTPError("OTP expired or already used.")
+        if attempts > self.max_attempts:
+            self.cache.delete(key)
+            raise OTPError("Too many attempts, request a new OTP.")
+        if not self.matches(entry, code, context):
+            raise OTPError("Invalid OTP code.")
+        if not self.cache.delete(key):
+            raise OTPError("OTP expired or already used.")
+        return entry["context"]
+
+    def pending(self, purpose, user_id):
+        entry = self.cache.get(self.key(purpose, user_id))
+        return None if entry is None else entry["code"]
+
+
+_store = None
+
+
+def get_otp_store():
+    """the OTP_STORE instance, rebuilt when the setting changes"""
+    global _store
+    if _store is None or _store[0] != settings.OTP_STORE:
+        _store = (settings.OTP_STORE, import_string(settings.OTP_STORE)())
+    return _store[1]
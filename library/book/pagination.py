@@ -0,0 +1,27 @@
+"""keyset pagination for list endpoints
+"""
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    """
+    cursor pagination ordered on the primary key
+
+    the cursor encodes the last seen key, so every page is a
+    `WHERE id > ... ORDER BY id LIMIT n` on the primary key index and deep
+    pages cost the same as the first one. An ordering on a column that is not
+    unique gets the primary key appended, rows sharing a key then come back
+    in the same order on every query and the cursor offset that counts them
+    stays valid
+    """
+
+    ordering = "id"
+    page_size_query_param = "page_size"
+    max_page_size = settings.PAGINATION_MAX_PAGE_SIZE
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        if not any(field.lstrip("-") in ("id", "pk") for field in ordering):
+            ordering = tuple(ordering) + ("id",)
+        return ordering
@@ -0,0 +1,14 @@
+"""permission classes of the book API
+"""
+from rest_framework import permissions
+
+
+class IsSuperUser(permissions.BasePermission):
+    """
+    superusers only, is_superuser is part of the user snapshot so this costs no query
+    """
+
+    def has_permission(self, request, view):
+        return bool(
+            request.user and request.user.is_authenticated and request.user.is_superuser
+        )
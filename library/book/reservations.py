@@ -0,0 +1,102 @@
+"""stock reservations between a purchase OTP request and its confirmation
+
+hold_stock() takes copies out of book_amount and records a StockReservation
+that lives STOCK_RESERVATION_TTL seconds, commit_purchase() converts a live
+hold into the purchase and release_expired_holds() gives the stock of holds
+nobody confirmed back in bulk. Every path locks the reservation row before the
+book row (and the book row before the balance snapshot), so they cannot deadlock.
+"""
+import datetime
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Sum, When
+from django.utils import timezone
+
+from core.models import BookData, StockReservation
+from .services import PurchaseError
+
+
+def hold_stock(user, book, quantity):
+    """
+    hold quantity copies of book for user and return the reservation
+
+    asking again for the same quantity while the hold lives only extends it,
+    any other earlier hold of the book is released first. The copies a user
+    holds over all books are capped at STOCK_RESERVATION_MAX_COPIES
+    """
+    now = timezone.now()
+    expires_at = now + datetime.timedelta(seconds=settings.STOCK_RESERVATION_TTL)
+    previous = StockReservation.objects.filter(user_id=user.pk, book=book).first()
+    held = (
+        StockReservation.objects.filter(user_id=user.pk, expires_at__gt=now)
+        .exclude(book=book)
+        .aggregate(total=Sum("quantity"))["total"]
+        or 0
+    )
+    if held + quantity > settings.STOCK_RESERVATION_MAX_COPIES:
+        raise PurchaseError(
+            "You are holding too many books, confirm or let earlier purchases expire first."
+        )
+    try:
+        with transaction.atomic():
+            if previous is not None:
+                if previous.quantity == quantity and StockReservation.objects.filter(
+                    pk=previous.pk, expires_at__gt=now
+                ).update(expires_at=expires_at):
+                    previous.expires_at = expires_at
+                    return previous
+                # * a hold the sweeper or a confirmation
+                # * took first was already accounted for
+                if StockReservation.objects.filter(pk=previous.pk).delete()[0]:
+                    BookData.objects.filter(pk=book.pk).update(
+                        book_amount=F("book_amount") + previous.quantity
+                    )
+
+            taken = BookData.objects.filter(
+                pk=book.pk, book_amount__gte=quantity
+            ).update(book_amount=F("book_amount") - quantity)
+            if not taken:
+                raise PurchaseError("Requested quantity exceeds available stock.")
+            return StockReservation.objects.create(
+                user_id=user.pk, book=book, quantity=quantity, expires_at=expires_at
+            )
+    except IntegrityError:
+        raise PurchaseError("Another request is reserving this book, try again.")
+
+
+def release_expired_holds(batch_size=500):
+    """
+    return the stock of expired holds to their books, a batch per transaction,
+    and the number of holds released
+
+    holds are claimed with SELECT ... FOR UPDATE SKIP LOCKED, so a hold that
+    is being confirmed or replaced right now is left to that request
+    """
+    released = 0
+    while True:
+        with transaction.atomic():
+            holds = list(
+                StockReservation.objects.filter(expires_at__lte=timezone.now())
+                .select_for_update(skip_locked=True)
+                .order_by("expires_at")
+                .values_list("pk", "book_id", "quantity")[:batch_size]
+            )
+            if not holds:
+                return released
+            totals = defaultdict(int)
+            for _, book_id, quantity in holds:
+                totals[book_id] += quantity
+            BookData.objects.filter(pk__in=list(totals)).update(
+                book_amount=Case(
+                    *(
+                        When(pk=book_id, then=F("book_amount") + total)
+                        for book_id, total in totals.items()
+                    )
+                )
+            )
+            StockReservation.objects.filter(pk__in=[pk for pk, _, _ in holds]).delete()
+        released += len(holds)
+        if len(holds) < batch_size:
+            return released
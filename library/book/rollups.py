@@ -0,0 +1,195 @@
+"""daily sales rollups
+
+BookSalesDaily and CategorySalesDaily hold units sold and revenue per book and
+per category per day. record_sales() adds committed purchases to them inside
+the purchase transaction, rebuild_rollups() recomputes them from PurchaseBook,
+and the analytics queries below read nothing but the rollups (plus the names
+of the rows they return).
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, Sum, Value
+from django.db.models.functions import Cast, Coalesce, TruncDate
+from django.utils import timezone
+
+from core.models import (
+    BookData,
+    BookSalesDaily,
+    Category,
+    CategorySalesDaily,
+    PurchaseBook,
+)
+from .ledger import to_money
+
+ORDERINGS = ("revenue", "units")
+
+
+def add_to_rollup(model, keys, units, revenue):
+    """increment one rollup row, creating it on the first sale of its day"""
+    changes = {"units": F("units") + units, "revenue": F("revenue") + revenue}
+    if model.objects.filter(**keys).update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(units=units, revenue=revenue, **keys)
+    except IntegrityError:
+        # * a concurrent purchase created the row first
+        model.objects.filter(**keys).update(**changes)
+
+
+def record_sales(purchases):
+    """
+    add freshly created purchases (with their book loaded) to the rollups,
+    call it inside the transaction that created them
+
+    book rows are updated in book order and category rows in category order,
+    so concurrent checkouts lock rollup rows in the same order
+    """
+    books, categories = defaultdict(lambda: [0, Decimal("0")]), defaultdict(
+        lambda: [0, Decimal("0")]
+    )
+    for purchase in purchases:
+        day = timezone.localdate(purchase.purchase_date)
+        revenue = purchase.quantity * to_money(purchase.unit_price)
+        for totals, key in (
+            (books, (purchase.book_id, day)),
+            (categories, (purchase.book.category_id, day)),
+        ):
+            totals[key][0] += purchase.quantity
+            totals[key][1] += revenue
+
+    for (book_id, day), (units, revenue) in sorted(
+        books.items(), key=lambda item: str(item[0])
+    ):
+        add_to_rollup(BookSalesDaily, {"book_id": book_id, "day": day}, units, revenue)
+    for (category_id, day), (units, revenue) in sorted(
+        categories.items(), key=lambda item: str(item[0])
+    ):
+        add_to_rollup(
+            CategorySalesDaily, {"category_id": category_id, "day": day}, units, revenue
+        )
+
+
+def rebuild_rollups(since=None, batch_size=1000):
+    """
+    recompute the rollups from PurchaseBook, every day or the days from since on
+
+    purchases recorded before unit_price existed are valued at the current
+    book price. Returns the number of book and category rows written.
+    """
+    purchases = PurchaseBook.objects.all()
+    book_rollups = BookSalesDaily.objects.all()
+    category_rollups = CategorySalesDaily.objects.all()
+    if since is not None:
+        purchases = purchases.filter(purchase_date__date__gte=since)
+        book_rollups = book_rollups.filter(day__gte=since)
+        category_rollups = category_rollups.filter(day__gte=since)
+
+    money = DecimalField(max_digits=14, decimal_places=2)
+    unit_price = Coalesce("unit_price", Cast("book__price", money), output_field=money)
+    revenue = ExpressionWrapper(F("quantity") * unit_price, output_field=money)
+    rows = (
+        purchases.annotate(day=TruncDate("purchase_date"))
+        .values("book_id", "book__category_id", "day")
+        .annotate(units=Sum("quantity"), revenue=Sum(revenue))
+        .order_by()
+    )
+
+    written = 0
+    categories = defaultdict(lambda: [0, Decimal("0")])
+    with transaction.atomic():
+        book_rollups.delete()
+        category_rollups.delete()
+        batch = []
+        for row in rows.iterator(chunk_size=batch_size):
+            # * SQLite sums decimals as floats
+            revenue = to_money(row["revenue"])
+            batch.append(
+                BookSalesDaily(
+                    book_id=row["book_id"],
+                    day=row["day"],
+                    units=row["units"],
+                    revenue=revenue,
+                )
+            )
+            totals = categories[(row["book__category_id"], row["day"])]
+            totals[0] += row["units"]
+            totals[1] += revenue
+            if len(batch) >= batch_size:
+                written += len(BookSalesDaily.objects.bulk_create(batch))
+                batch = []
+        written += len(BookSalesDaily.objects.bulk_create(batch))
+        CategorySalesDaily.objects.bulk_create(
+            (
+                CategorySalesDaily(
+                    category_id=category_id, day=day, units=units, revenue=revenue
+                )
+                for (category_id, day), (units, revenue) in categories.items()
+            ),
+            batch_size=batch_size,
+        )
+    return written, len(categories)
+
+
+def sales_totals(start, end):
+    totals = CategorySalesDaily.objects.filter(day__range=(start, end)).aggregate(
+        units=Coalesce(Sum("units"), 0),
+        revenue=Coalesce(Sum("revenue"), Value(Decimal("0"))),
+    )
+    return {"units": totals["units"], "revenue": to_money(totals["revenue"])}
+
+
+def sales_by_day(start, end):
+    rows = (
+        CategorySalesDaily.objects.filter(day__range=(start, end))
+        .values("day")
+        .annotate(units=Sum("units"), revenue=Sum("revenue"))
+        .order_by("day")
+    )
+    return [
+        {"day": row["day"], "units": row["units"], "revenue": to_money(row["revenue"])}
+        for row in rows
+    ]
+
+
+def top_sellers(model, key, names, start, end, top, order):
+    """the top rows of one rollup grouped by key, named from the names queryset"""
+    rows = list(
+        model.objects.filter(day__range=(start, end))
+        .values(key)
+        .annotate(units=Sum("units"), revenue=Sum("revenue"))
+        .order_by(f"-{order}", key)[:top]
+    )
+    labels = dict(
+        names.filter(
+            pk__in=[row[key] for row in rows if row[key] is not None]
+        ).values_list("pk", "name")
+    )
+    return [
+        {
+            "id": row[key],
+            "name": labels.get(row[key]),
+            "units": row["units"],
+            "revenue": to_money(row["revenue"]),
+        }
+        for row in rows
+    ]
+
+
+def top_books(start, end, top, order):
+    names = BookData.objects.annotate(name=F("book_name"))
+    return top_sellers(BookSalesDaily, "book_id", names, start, end, top, order)
+
+
+def top_categories(start, end, top, order):
+    return top_sellers(
+        CategorySalesDaily,
+        "category_id",
+        Category.objects.all(),
+        start,
+        end,
+        top,
+        order,
+    )
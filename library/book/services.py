@@ -0,0 +1,146 @@
+"""purchase commit path
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Q, When
+from django.utils import timezone
+
+from core.models import BookData, PurchaseBook, StockReservation
+from .authentication import invalidate_snapshot
+from .ledger import InsufficientBalance, credit, debit, to_money
+from .rollups import record_sales
+from .tasks import queue_receipt
+
+
+class PurchaseError(Exception):
+    """a purchase that cannot be committed, the message is safe to show to the user"""
+
+
+def commit_purchase(user, book, quantity):
+    """
+    take quantity copies of book out of stock (or convert the user's live
+    hold of them) and charge user for them
+
+    stock is taken with a conditional UPDATE and the price debited from the
+    ledger under the buyer's snapshot lock, so the database serializes
+    concurrent buyers of one book (and concurrent spending of one user) for
+    the length of a single short transaction and a failed check rolls the
+    whole purchase back. The sale is added to the daily rollups and the
+    receipt queued in the same transaction
+    """
+    total_price = to_money(book.price) * quantity
+    with transaction.atomic():
+        # * a live hold from the OTP request already took the stock
+        held = StockReservation.objects.filter(
+            user_id=user.pk, book=book, quantity=quantity, expires_at__gt=timezone.now()
+        ).delete()[0]
+        if not held:
+            taken = BookData.objects.filter(
+                pk=book.pk, book_amount__gte=quantity
+            ).update(book_amount=F("book_amount") - quantity)
+            if not taken:
+                raise PurchaseError(
+                    "Not enough books in stock. Stock cannot be negative."
+                )
+
+        try:
+            debit(user.pk, total_price)
+        except InsufficientBalance as exc:
+            raise PurchaseError(str(exc))
+
+        transaction.on_commit(lambda: invalidate_snapshot(user.pk))
+        try:
+            purchase = PurchaseBook.objects.create(
+                user_id=user.pk,
+                book=book,
+                quantity=quantity,
+                unit_price=to_money(book.price),
+            )
+        except IntegrityError:
+            # * a concurrent request bought the book first,
+            # * the unique (user, book) index caught it
+            raise PurchaseError("You have already purchased this book.")
+        record_sales([purchase])
+        queue_receipt([purchase])
+        return purchase
+
+
+def prepare_checkout(user, items):
+    """
+    validate a cart with one query for the books and one for earlier purchases
+
+    returns the (book, quantity) lines in primary key order and the total price
+    """
+    quantities = {item["book"]: item["quantity"] for item in items}
+    books = BookData.objects.in_bulk(list(quantities))
+
+    missing = [str(book_id) for book_id in quantities if book_id not in books]
+    if missing:
+        raise PurchaseError(f"Books not found: {', '.join(missing)}.")
+
+    if not all(book.is_visible_to(user) for book in books.values()):
+        raise PurchaseError("You are not allowed to purchase some of these books.")
+
+    if PurchaseBook.objects.filter(user_id=user.pk, book_id__in=list(books)).exists():
+        raise PurchaseError("You have already purchased some of these books.")
+
+    lines = [(books[book_id], quantities[book_id]) for book_id in sorted(books)]
+    for book, quantity in lines:
+        if quantity > book.book_amount:
+            raise PurchaseError(
+                f"Requested quantity of {book.book_name} exceeds available stock."
+            )
+
+    total_price = sum(to_money(book.price) * quantity for book, quantity in lines)
+    if user.balance < total_price:
+        raise PurchaseError("Insufficient balance.")
+    return lines, total_price
+
+
+def commit_checkout(user, lines):
+    """
+    buy every (book, quantity) line or none of them
+
+    stock of all books is taken with a single conditional UPDATE, books before
+    the balance snapshot like commit_purchase so the two paths lock in the
+    same order
+    """
+    total_price = sum(to_money(book.price) * quantity for book, quantity in lines)
+    in_stock = Q()
+    new_amounts = []
+    for book, quantity in lines:
+        in_stock |= Q(pk=book.pk, book_amount__gte=quantity)
+        new_amounts.append(When(pk=book.pk, then=F("book_amount") - quantity))
+
+    with transaction.atomic():
+        taken = BookData.objects.filter(in_stock).update(book_amount=Case(*new_amounts))
+        if taken != len(lines):
+            raise PurchaseError("Not enough books in stock. Stock cannot be negative.")
+
+        try:
+            debit(user.pk, total_price)
+        except InsufficientBalance as exc:
+            raise PurchaseError(str(exc))
+
+        transaction.on_commit(lambda: invalidate_snapshot(user.pk))
+        try:
+            purchases = PurchaseBook.objects.bulk_create(
+                [
+                    PurchaseBook(
+                        user_id=user.pk,
+                        book=book,
+                        quantity=quantity,
+                        unit_price=to_money(book.price),
+                    )
+                    for book, quantity in lines
+                ]
+            )
+        except IntegrityError:
+            raise PurchaseError("You have already purchased some of these books.")
+        record_sales(purchases)
+        queue_receipt(purchases)
+        return purchases
+
+
+def top_up_balance(user, amount):
+    """add amount to the user's balance, a single ledger insert"""
+    return credit(user.pk, amount)
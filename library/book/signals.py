@@ -0,0 +1,30 @@
+"""signal receivers of the book app
+"""
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from core.models import BookData, Category, UserData
+from .authentication import invalidate_snapshot
+from .cache import bump_catalog_version
+from .uploads import release_book_file
+
+
+@receiver([post_save, post_delete], sender=BookData)
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_catalog_cache(sender, **kwargs):
+    # * bump after commit, a reader in between would
+    # * cache the old rows under the new version
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver(post_delete, sender=BookData)
+def release_deleted_book_file(sender, instance, **kwargs):
+    release_book_file(instance.file.name)
+
+
+@receiver([post_save, post_delete], sender=UserData)
+def invalidate_user_snapshot(sender, instance, **kwargs):
+    # * again after commit, a request in between would cache the old row
+    invalidate_snapshot(instance.pk)
+    transaction.on_commit(lambda: invalidate_snapshot(instance.pk))
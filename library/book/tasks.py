@@ -0,0 +1,117 @@
+"""job handlers of the book app, run by the run_jobs workers
+
+OTP and receipt mails are sent here instead of inside the request, the views
+and services only enqueue them. Handlers can run more than once (a worker can
+die after sending and before recording it), so they only do work that is
+harmless to repeat.
+
+OTP jobs carry no code, the handler mails the one pending in the OTP store,
+so codes never sit in the jobs table.
+"""
+import logging
+
+from django.conf import settings
+from django.core.mail import send_mail
+
+from core.models import PurchaseBook, UserData
+from .jobs import enqueue, handler
+from .ledger import to_money
+from .otp import get_otp_store
+
+logger = logging.getLogger(__name__)
+
+SEND_OTP = "send_otp"
+SEND_RECEIPT = "send_receipt"
+
+OTP_SUBJECTS = {
+    "purchase": "Your purchase code",
+    "checkout": "Your checkout code",
+    "topup": "Your top-up code",
+}
+
+
+def queue_otp(purpose, user_pk):
+    """
+    deliver the pending OTP out of the request,
+    fails once the code has expired or been used
+    """
+    return enqueue(
+        SEND_OTP,
+        {"purpose": purpose, "user": str(user_pk)},
+        max_attempts=settings.JOB_OTP_MAX_ATTEMPTS,
+    )
+
+
+def queue_receipt(purchases):
+    """
+    mail a receipt of purchases once they are committed
+
+    call inside the purchase transaction, the job then exists exactly when the
+    purchases do. The first purchase keys the job, so it is only queued once
+    """
+    return enqueue(
+        SEND_RECEIPT,
+        {"purchases": [str(purchase.pk) for purchase in purchases]},
+        key=f"receipt:{purchases[0].pk}",
+    )
+
+
+@handler(SEND_OTP)
+def send_otp(payload):
+    code = get_otp_store().pending(payload["purpose"], payload["user"])
+    if code is None:
+        # * also what a worker sees when the store is not shared with the web
+        # * processes, failing the job keeps that from passing silently
+        logger.error(
+            "no pending %s OTP for user %s, expired, used or not in a shared store",
+            payload["purpose"],
+            payload["user"],
+        )
+        raise LookupError(f"no pending {payload['purpose']} OTP")
+    email = (
+        UserData.objects.filter(pk=payload["user"])
+        .values_list("email", flat=True)
+        .first()
+    )
+    if not email:
+        logger.warning(
+            "user %s has no email address, %s OTP not sent",
+            payload["user"],
+            payload["purpose"],
+        )
+        return
+    send_mail(
+        OTP_SUBJECTS.get(payload["purpose"], "Your code"),
+        f"Your code is {code}. It expires in {settings.OTP_TTL // 60} minutes.",
+        None,
+        [email],
+    )
+
+
+@handler(SEND_RECEIPT)
+def send_receipt(payload):
+    purchases = list(
+        PurchaseBook.objects.filter(pk__in=payload["purchases"])
+        .select_related("book", "user")
+        .order_by("pk")
+    )
+    if not purchases or not purchases[0].user.email:
+        return
+    # * rows bought before unit_price was recorded are billed at the current price
+    amounts = [
+        to_money(
+            purchase.book.price if purchase.unit_price is None else purchase.unit_price
+        )
+        * purchase.quantity
+        for purchase in purchases
+    ]
+    lines = [
+        f"{purchase.book.book_name} x{purchase.quantity}: {amount}"
+        for purchase, amount in zip(purchases, amounts)
+    ]
+    send_mail(
+        "Your receipt",
+        "\n".join(lines + [f"Total: {sum(amounts)}"]),
+        None,
+        [purchases[0].user.email],
+    )
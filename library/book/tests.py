@@ -1,3 +1,1307 @@
-from django.test import TestCase
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import time
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core import mail, signing
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management import call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from django.db import connection, transaction
+from django.test import AsyncClient, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from core.dbstats import connection_stats
+from core.ids import uuid7
+from core.middleware import view_histograms
+from core.models import (
+    UserData, BookData, BookFile, PurchaseBook, Category, BookSalesDaily, CategorySalesDaily, StockReservation,
+    BalanceEntry, BalanceSnapshot, Job,
+)
+from core.search import fts_available, search_books
+from core.serializers import PurchaseBookSerializer
+from .authentication import CachedJWTAuthentication
+from .cache import cached_response
+from .checks import check_otp_store
+from .downloads import SIGNED_DOWNLOAD_SALT, deliver_file, file_validators, parse_range, sign_download
+from .jobs import HANDLERS, claim_jobs, enqueue, prune_jobs, work_once
+from .ledger import credit, debit, reconcile, take_snapshots, valid_topup
+from .otp import OTPError, get_otp_store
+from .pagination import KeysetPagination
+from .reservations import release_expired_holds
+from .rollups import rebuild_rollups
+from .services import PurchaseError, commit_checkout, commit_purchase, prepare_checkout
+from .tasks import queue_otp
+from .uploads import book_file_name, stored_book_file
+
+
+def use_temporary_media(test):
+    """point MEDIA_ROOT at a directory removed after the test"""
+    media = tempfile.TemporaryDirectory()
+    test.addCleanup(media.cleanup)
+    media_root = override_settings(MEDIA_ROOT=media.name)
+    media_root.enable()
+    test.addCleanup(media_root.disable)
+
+
+class ListQueryCountTests(TestCase):
+    """list endpoints must run a fixed number of queries whatever the page size"""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name="novel")
+        cls.books = [
+            BookData.objects.create(
+                book_name=f"book {i}", author_name="author", book_amount=10, price=5.0, category=category
+            )
+            for i in range(5)
+        ]
+        cls.users = [
+            UserData.objects.create_user(f"user{i}", f"user{i}@example.com", "pass", last_name="test")
+            for i in range(5)
+        ]
+        for user in cls.users:
+            for book in cls.books:
+                PurchaseBook.objects.create(user=user, book=book)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.users[0])
+
+    def test_user_list(self):
+        # * users page + purchased_books prefetch
+        with self.assertNumQueries(2):
+            response = self.client.get("/api/users/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["results"]), 5)
+        self.assertEqual(len(response.data["results"][0]["purchased_books"]), 5)
+
+    def test_book_list(self):
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/books/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["results"]), 5)
+
+    def test_category_list(self):
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/categories/")
+        self.assertEqual(response.status_code, 200)
+
+    def test_purchase_serializer(self):
+        queryset = PurchaseBookSerializer.setup_eager_loading(PurchaseBook.objects.all())
+        with self.assertNumQueries(1):
+            data = PurchaseBookSerializer(queryset, many=True).data
+        self.assertEqual(len(data), 25)
+
+
+class KeysetPaginationTests(TestCase):
+    """cursors walk every row once in both directions, page sizes are capped"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserData.objects.create_user("reader", "reader@example.com", "pass", last_name="test")
+        for i in range(7):
+            Category.objects.create(name=f"category {i}")
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def walk(self, url, direction):
+        """the urls and names of every page from url on, following the direction links"""
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            body = response.json()
+            pages.append((url, [row["name"] for row in body["results"]]))
+            url = body[direction]
+        return pages
+
+    def test_next_and_previous_cursors(self):
+        forward = self.walk("/api/categories/?page_size=3", "next")
+        self.assertEqual([len(names) for _, names in forward], [3, 3, 1])
+        names = [name for _, page in forward for name in page]
+        self.assertCountEqual(names, [f"category {i}" for i in range(7)])
+
+        backward = self.walk(forward[-1][0], "previous")
+        self.assertEqual([page for _, page in reversed(backward)], [page for _, page in forward])
+
+    def test_page_size_is_capped(self):
+        with mock.patch.object(KeysetPagination, "max_page_size", 2):
+            response = self.client.get("/api/categories/", {"page_size": 100})
+        self.assertEqual(len(response.json()["results"]), 2)
+
+    def test_bad_cursor_is_not_found(self):
+        response = self.client.get("/api/categories/", {"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_duplicate_ordering_keys(self):
+        for i in range(10):
+            BookData.objects.create(book_name=f"tied {i}", author_name="a", book_amount=1, price=1.0 if i < 7 else 2.0)
+        paginator = KeysetPagination()
+        # * seven rows share the first key, more than two pages of them
+        paginator.ordering = "price"
+
+        def page(url):
+            rows = paginator.paginate_queryset(BookData.objects.all(), Request(APIRequestFactory().get(url)))
+            return [row.book_name for row in rows], paginator.get_next_link()
+
+        rows, url = [], "/books/?page_size=3"
+        while url:
+            names, url = page(url)
+            rows.extend(names)
+        self.assertEqual(len(rows), 10)
+        self.assertCountEqual(rows, [f"tied {i}" for i in range(10)])
+        self.assertEqual(paginator.ordering, ("price", "id"))
+
+
+class SparseFieldsetTests(TestCase):
+    """?fields= and ?omit= narrow the output and the SQL, the values() path renders what the serializers do"""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name="novel")
+        cls.books = [
+            BookData.objects.create(
+                book_name=f"book {i}", author_name="author", book_amount=10, price=5.5, category=category,
+                file="books/shared.pdf" if i % 2 else None,
+            )
+            for i in range(3)
+        ]
+        cls.user = UserData.objects.create_user("reader", "reader@example.com", "pass", last_name="test")
+        for book in cls.books:
+            PurchaseBook.objects.create(user=cls.user, book=book)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_values_path_matches_serializers(self):
+        books = self.client.get("/api/books/").json()["results"]
+        self.assertEqual(books, [self.client.get(f"/api/books/{book.pk}/").json() for book in self.books])
+
+        users = self.client.get("/api/users/?omit=purchased_books").json()["results"]
+        detail = self.client.get(f"/api/users/{self.user.pk}/?omit=purchased_books").json()
+        self.assertEqual(users, [detail])
+        self.assertNotIn("purchased_books", detail)
+
+        purchases = self.client.get("/api/purchases/").json()["results"]
+        expected = PurchaseBookSerializer(
+            PurchaseBook.objects.select_related("user", "book").order_by("pk"), many=True
+        ).data
+        self.assertEqual(purchases, json.loads(json.dumps(expected, cls=DjangoJSONEncoder)))
+
+    def test_fields_restrict_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/books/?fields=book_name,price")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.json()["results"][0]), ["book_name", "price"])
+        self.assertNotIn("author_name", queries.captured_queries[-1]["sql"])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f"/api/books/{self.books[0].pk}/?omit=file,category,public")
+        self.assertEqual(list(response.json()), ["id", "book_name", "author_name", "book_amount", "price"])
+        self.assertNotIn("category_id", queries.captured_queries[-1]["sql"])
+
+        response = self.client.get("/api/categories/?fields=name,shelf")
+        self.assertEqual(response.status_code, 400)
+
+
+class RequestMetricsTests(TestCase):
+    """every response carries its query count and timings, the metrics endpoint is for superusers"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserData.objects.create_user("reader", "reader@example.com", "pass", last_name="test")
+        cls.admin = UserData.objects.create_superuser("admin", "admin@example.com", "pass", last_name="test")
+        Category.objects.create(name="novel")
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def test_server_timing_and_log_line(self):
+        self.client.force_authenticate(self.user)
+        with self.assertLogs("core.requests", "INFO") as logs, self.assertNumQueries(1):
+            response = self.client.get("/api/categories/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('desc="1 queries"', response["Server-Timing"])
+        self.assertIn("serialize;dur=", response["Server-Timing"])
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual((line["view"], line["queries"], line["status"]), ("category-list", 1, 200))
+        self.assertGreaterEqual(view_histograms()["category-list"]["count"], 1)
+
+    def test_streamed_response_is_logged_when_consumed(self):
+        self.client.force_authenticate(self.user)
+        with self.assertLogs("core.requests", "INFO") as logs:
+            response = self.client.get("/api/export/books/")
+            self.assertEqual(logs.records, [])
+            b"".join(response.streaming_content)
+        self.assertIn("queries before streaming", response["Server-Timing"])
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual((line["view"], line["queries"]), ("export_books", 1))
+
+    def test_slow_request_lists_queries(self):
+        self.client.force_authenticate(self.user)
+        with self.settings(REQUEST_SLOW_QUERIES=0), self.assertLogs("core.requests", "WARNING") as logs:
+            self.client.get("/api/categories/")
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertTrue(line["slow"])
+        self.assertIn("core_category", line["slowest_queries"][0]["sql"])
+
+    def test_metrics_endpoint_is_superuser_only(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get("/api/metrics/").status_code, 403)
+        self.client.force_authenticate(self.admin)
+        response = self.client.get("/api/metrics/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("views", response.data)
+
+
+class CatalogImportTests(TestCase):
+    """import_books upserts on (book_name, author_name) and skips bad rows"""
+
+    def import_feed(self, text, suffix=".csv"):
+        with tempfile.NamedTemporaryFile("w", suffix=suffix) as feed:
+            feed.write(text)
+            feed.flush()
+            err = StringIO()
+            call_command("import_books", feed.name, batch_size=2, stdout=StringIO(), stderr=err)
+        return err.getvalue()
+
+    def test_upsert_and_errors(self):
+        Category.objects.create(name="novel")
+        BookData.objects.create(book_name="Dune", author_name="Herbert", book_amount=1, price=9.0)
+        errors = self.import_feed(
+            "book_name,author_name,book_amount,price,category,public\n"
+            "Dune,Herbert,4,12.5,novel,true\n"
+            "Emma,Austen,2,7,classic,false\n"
+            ",Nobody,1,1,novel,true\n"
+            "Ulysses,Joyce,1,cheap,novel,true\n"
+            "Ulysses,Joyce,1,nan,novel,true\n"
+            "Ulysses,Joyce,1,inf,novel,true\n"
+        )
+        self.assertIn("line 4: book_name is required", errors)
+        self.assertIn("line 5: price 'cheap' is not a number", errors)
+        self.assertIn("line 6: price 'nan' is not a finite number", errors)
+        self.assertIn("line 7: price 'inf' is not a finite number", errors)
+
+        dune = BookData.objects.get(book_name="Dune")
+        self.assertEqual((dune.book_amount, dune.price, dune.category.name), (4, 12.5, "novel"))
+        self.assertFalse(BookData.objects.get(book_name="Emma").public)
+        self.assertEqual(BookData.objects.count(), 2)
+        self.assertEqual(Category.objects.filter(name="novel").count(), 1)
+
+        out = StringIO()
+        call_command("export_books", stdout=out, stderr=StringIO())
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+
+
+class StreamingExportTests(TestCase):
+    """exports stream every row in either format"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserData.objects.create_user("buyer", "buyer@example.com", "pass", last_name="test")
+        books = BookData.objects.bulk_create(
+            BookData(book_name=f"book {i}", author_name="author", book_amount=1, price=2.0) for i in range(30)
+        )
+        for book in books[:3]:
+            PurchaseBook.objects.create(user=cls.user, book=book)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_book_export_lines(self):
+        response = self.client.get("/api/export/books/")
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual(len(rows), 30)
+        self.assertEqual(set(rows[0]), {"id", "book_name", "author_name", "book_amount", "price", "file", "category", "public"})
+
+    def test_book_export_follows_visibility(self):
+        BookData.objects.create(book_name="private", author_name="author", book_amount=1, price=2.0, public=False)
+        staff = UserData.objects.create_user("staff", "staff@example.com", "pass", last_name="test", normal_user=True)
+        for user, expected in ((staff, 31), (self.user, 30)):
+            self.client.force_authenticate(user)
+            rows = b"".join(self.client.get("/api/export/books/").streaming_content).splitlines()
+            self.assertEqual(len(rows), expected)
+
+    def test_purchase_export_array(self):
+        response = self.client.get("/api/export/purchases/", {"output": "json"})
+        rows = json.loads(b"".join(response.streaming_content))
+        self.assertEqual([row["user"] for row in rows], ["buyer"] * 3)
+
+
+class SalesRollupTests(TestCase):
+    """purchases keep the rollups equal to a rebuild from the purchase history"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = UserData.objects.create_superuser("admin", "admin@example.com", "pass", last_name="test")
+        cls.buyer = UserData.objects.create_user("buyer", "buyer@example.com", "pass", last_name="test", balance=500.0)
+        novel = Category.objects.create(name="novel")
+        cls.books = [
+            BookData.objects.create(book_name=f"book {i}", author_name="author", book_amount=10, price=price, category=category)
+            for i, (price, category) in enumerate([(10.0, novel), (4.0, novel), (7.5, None)])
+        ]
+
+    def rollups(self):
+        books = sorted(BookSalesDaily.objects.values_list("book_id", "day", "units", "revenue"))
+        categories = sorted(CategorySalesDaily.objects.values_list("category_id", "day", "units", "revenue"), key=str)
+        return books, categories
+
+    def test_incremental_matches_rebuild(self):
+        commit_purchase(self.buyer, self.books[0], 2)
+        commit_checkout(self.buyer, [(self.books[1], 3), (self.books[2], 1)])
+        incremental = self.rollups()
+        self.assertEqual(sum(row[3] for row in incremental[1]), Decimal("39.50"))
+
+        rebuild_rollups()
+        self.assertEqual(self.rollups(), incremental)
+
+    def test_revenue_is_exact_in_cents(self):
+        cheap = BookData.objects.create(book_name="cheap", author_name="author", book_amount=10, price=0.1)
+        commit_purchase(self.buyer, cheap, 3)
+        self.assertEqual(PurchaseBook.objects.get(book=cheap).unit_price, Decimal("0.10"))
+        rebuild_rollups()
+        self.assertEqual(BookSalesDaily.objects.get(book=cheap).revenue, Decimal("0.30"))
+
+    def test_analytics_endpoint(self):
+        commit_purchase(self.buyer, self.books[0], 2)
+        commit_purchase(self.buyer, self.books[1], 1)
+        client = APIClient()
+        client.force_authenticate(self.buyer)
+        self.assertEqual(client.get("/api/analytics/sales/").status_code, 403)
+
+        client.force_authenticate(self.admin)
+        with self.assertNumQueries(3):
+            response = client.get("/api/analytics/sales/", {"group": "book", "top": 1})
+        self.assertEqual(response.data["totals"], {"units": 3, "revenue": Decimal("24.00")})
+        self.assertEqual([row["name"] for row in response.data["results"]], ["book 0"])
+        response = client.get("/api/analytics/sales/", {"group": "category", "order": "units"})
+        self.assertEqual(response.data["results"][0]["units"], 3)
+        self.assertEqual(client.get("/api/analytics/sales/", {"from": "yesterday"}).status_code, 400)
+
+
+@override_settings(OTP_STORE="book.otp.InMemoryOTPStore", TEST_ENVIRONMENT=True)
+class StockReservationTests(TestCase):
+    """the OTP request holds stock, the confirmation converts the hold, the sweeper returns expired ones"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = BookData.objects.create(book_name="hot", author_name="author", book_amount=3, price=5.0)
+        cls.buyers = [
+            UserData.objects.create_user(f"buyer{i}", f"buyer{i}@example.com", "pass", last_name="t", balance=50.0)
+            for i in range(2)
+        ]
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def request_otp(self, user, quantity):
+        self.client.force_authenticate(user)
+        return self.client.post("/api/purchase/", {"book": str(self.book.pk), "quantity": quantity}, format="json")
+
+    def stock(self):
+        return BookData.objects.values_list("book_amount", flat=True).get(pk=self.book.pk)
+
+    def test_quantity_must_be_a_positive_integer(self):
+        self.client.force_authenticate(self.buyers[0])
+        for quantity in (True, 0, -1, 1.5, "2"):
+            with self.subTest(quantity=quantity):
+                for method in (self.client.post, self.client.put):
+                    response = method("/api/purchase/", {"book": str(self.book.pk), "quantity": quantity, "otp_code": "1234"}, format="json")
+                    self.assertEqual((response.status_code, response.data), (400, {"error": "Invalid quantity."}))
+        self.assertEqual((self.stock(), StockReservation.objects.count()), (3, 0))
+
+    def test_hold_blocks_others_and_converts(self):
+        response = self.request_otp(self.buyers[0], 2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stock(), 1)
+        # * asking again extends the same hold instead of taking more
+        self.request_otp(self.buyers[0], 2)
+        self.assertEqual((self.stock(), StockReservation.objects.count()), (1, 1))
+        self.assertEqual(self.request_otp(self.buyers[1], 2).status_code, 400)
+
+        response = self.request_otp(self.buyers[0], 2)
+        code = response.data["message"].split()[3].rstrip(".")
+        response = self.client.put(
+            "/api/purchase/", {"book": str(self.book.pk), "quantity": 2, "otp_code": code}, format="json"
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((self.stock(), StockReservation.objects.count()), (1, 0))
+
+    def test_expired_holds_are_released(self):
+        self.request_otp(self.buyers[0], 1)
+        self.request_otp(self.buyers[1], 2)
+        self.assertEqual(self.stock(), 0)
+        StockReservation.objects.filter(user=self.buyers[0]).update(expires_at=timezone.now())
+        self.assertEqual(release_expired_holds(), 1)
+        self.assertEqual((self.stock(), StockReservation.objects.count()), (1, 1))
+
+    @override_settings(STOCK_RESERVATION_MAX_COPIES=3)
+    def test_holds_are_capped_per_user(self):
+        other = BookData.objects.create(book_name="other", author_name="author", book_amount=5, price=1.0)
+        self.assertEqual(self.request_otp(self.buyers[0], 2).status_code, 200)
+        response = self.client.post("/api/purchase/", {"book": str(other.pk), "quantity": 2}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(BookData.objects.get(pk=other.pk).book_amount, 5)
+        # * replacing the hold of the same book does not count the old one
+        self.assertEqual(self.request_otp(self.buyers[0], 3).status_code, 200)
+
+
+class TimeOrderedKeyTests(TestCase):
+    """new rows get increasing version 7 keys and a book is bought once per user"""
+
+    def test_keys_increase(self):
+        keys = [uuid7() for _ in range(5000)]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual({key.version for key in keys}, {7})
+        first = Category.objects.create(name="first")
+        second = Category.objects.create(name="second")
+        self.assertLess(first.pk, second.pk)
+
+    def test_repeat_purchase_is_refused(self):
+        user = UserData.objects.create_user("repeat", "repeat@example.com", "pass", last_name="t", balance=50.0)
+        book = BookData.objects.create(book_name="once", author_name="author", book_amount=5, price=1.0)
+        commit_purchase(user, book, 1)
+        with self.assertRaisesMessage(PurchaseError, "already purchased"):
+            commit_purchase(user, book, 1)
+        self.assertEqual(BookData.objects.get(pk=book.pk).book_amount, 4)
+
+
+@override_settings(OTP_STORE="book.otp.InMemoryOTPStore", TEST_ENVIRONMENT=True)
+class BalanceLedgerTests(TestCase):
+    """money moves as inserted entries, snapshots fold them and reconcile checks the snapshots"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = UserData.objects.create_user("saver", "saver@example.com", "pass", last_name="t")
+
+    def test_topup_inserts_an_entry(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        last_edit = UserData.objects.get(pk=self.user.pk).last_edit
+        message = client.post("/api/topup/", {"amount": 0.1}, format="json").data["message"]
+        code = message.split()[3].rstrip(".")
+        response = client.put("/api/topup/", {"amount": 0.1, "otp_code": code}, format="json")
+        self.assertEqual(response.status_code, 200)
+        credit(self.user.pk, 0.2)
+
+        self.assertEqual(self.user.balance, Decimal("0.30"))
+        self.assertEqual(BalanceEntry.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(UserData.objects.get(pk=self.user.pk).last_edit, last_edit)
+
+    def test_topup_amount_is_bounded(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        for amount in (True, "5", None, 0, 0.001, -1, float("inf"), 1e20, settings.BALANCE_TOPUP_MAX + 1):
+            self.assertFalse(valid_topup(amount), amount)
+        for amount in (0.01, 5, settings.BALANCE_TOPUP_MAX):
+            self.assertTrue(valid_topup(amount), amount)
+        self.assertEqual(client.post("/api/topup/", {"amount": 1e20}, format="json").status_code, 400)
+        self.assertEqual(client.put("/api/topup/", {"amount": True, "otp_code": "1"}, format="json").status_code, 400)
+
+    def test_snapshots_and_reconcile(self):
+        credit(self.user.pk, 40)
+        with transaction.atomic():
+            debit(self.user.pk, 15.5)
+        self.assertEqual(take_snapshots(lag=0), 1)
+        credit(self.user.pk, 1)
+
+        snapshot = BalanceSnapshot.objects.get(user=self.user)
+        self.assertEqual(snapshot.balance, Decimal("24.50"))
+        self.assertEqual(self.user.balance, Decimal("25.50"))
+        self.assertEqual(reconcile(), ([], []))
+
+        BalanceSnapshot.objects.filter(user=self.user).update(balance=Decimal("99"))
+        mismatched, _ = reconcile(repair=True)
+        self.assertEqual([row[0] for row in mismatched], [self.user.pk])
+        self.assertEqual(reconcile(), ([], []))
+        self.assertEqual(self.user.balance, Decimal("25.50"))
+
+
+@override_settings(OTP_STORE="book.otp.InMemoryOTPStore", TEST_ENVIRONMENT=False)
+class JobQueueTests(TestCase):
+    """side effects are queued with the request and run, retried or given up on by the workers"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = UserData.objects.create_user("reader", "reader@example.com", "pass", last_name="t", balance=20.0)
+        self.book = BookData.objects.create(book_name="mailed", author_name="author", book_amount=5, price=4.0)
+
+    def test_otp_and_receipt_are_mailed(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post("/api/purchase/", {"book": str(self.book.pk), "quantity": 2}, format="json")
+        self.assertEqual(response.data["message"], "OTP sent. Use the OTP to complete the transaction.")
+        purchase = commit_purchase(self.user, self.book, 2)
+        # * the receipt is keyed by the purchase, queueing it again returns the same job
+        self.assertEqual(enqueue("send_receipt", {}, key=f"receipt:{purchase.pk}").payload, {"purchases": [str(purchase.pk)]})
+        self.assertEqual(len(mail.outbox), 0)
+        # * the code stays in the OTP store, never in the jobs table
+        self.assertEqual(Job.objects.get(kind="send_otp").payload, {"purpose": "purchase", "user": str(self.user.pk)})
+
+        self.assertEqual(work_once("worker"), 2)
+        self.assertEqual([message.to for message in mail.outbox], [["reader@example.com"]] * 2)
+        self.assertIn(f"Your code is {get_otp_store().pending('purchase', self.user.pk)}.", mail.outbox[0].body)
+        self.assertIn("Total: 8.00", mail.outbox[1].body)
+        self.assertEqual(work_once("worker"), 0)
+
+    @override_settings(JOB_OTP_MAX_ATTEMPTS=1)
+    def test_used_codes_are_not_mailed(self):
+        code = get_otp_store().issue("topup", self.user.pk, {"amount": 5})
+        queue_otp("topup", self.user.pk)
+        get_otp_store().verify("topup", self.user.pk, code)
+        with self.assertLogs("book.tasks", "ERROR"), self.assertLogs("book.jobs", "ERROR"):
+            work_once("worker")
+        job = Job.objects.get()
+        self.assertEqual((len(mail.outbox), job.status), (0, Job.FAILED))
+        self.assertIn("no pending topup OTP", job.last_error)
+
+    def test_finished_jobs_are_pruned(self):
+        old, recent, queued = (enqueue("noop", {}) for _ in range(3))
+        Job.objects.filter(pk=old.pk).update(status=Job.DONE, finished_at=timezone.now() - datetime.timedelta(days=8))
+        Job.objects.filter(pk=recent.pk).update(status=Job.FAILED, finished_at=timezone.now())
+        self.assertEqual(prune_jobs(batch_size=1), 1)
+        self.assertEqual(set(Job.objects.values_list("pk", flat=True)), {recent.pk, queued.pk})
+
+    def test_failures_back_off_then_fail(self):
+        HANDLERS["flaky"] = lambda payload: 1 / 0
+        self.addCleanup(HANDLERS.pop, "flaky")
+        job = enqueue("flaky", {}, max_attempts=2)
+
+        self.assertEqual([claimed.pk for claimed in claim_jobs("first", lease=60)], [job.pk])
+        # * a live claim is not handed to another worker
+        self.assertEqual(claim_jobs("second"), [])
+        Job.objects.filter(pk=job.pk).update(status=Job.QUEUED, locked_by="", attempts=0)
+
+        with self.assertLogs("book.jobs", "WARNING"):
+            work_once("first")
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 1))
+        self.assertGreater(job.run_at, timezone.now())
+        self.assertEqual(work_once("first"), 0)
+
+        Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+        with self.assertLogs("book.jobs", "ERROR"):
+            work_once("first")
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+        self.assertIn("ZeroDivisionError", job.last_error)
+
+
+THROTTLED_LOGINS = {
+    **settings.REST_FRAMEWORK,
+    "DEFAULT_THROTTLE_RATES": {**settings.REST_FRAMEWORK["DEFAULT_THROTTLE_RATES"], "login_ip": "3/min", "login_username": "2/min"},
+}
+
+
+@override_settings(REST_FRAMEWORK=THROTTLED_LOGINS)
+class LoginThrottleTests(TestCase):
+    """login buckets key on the socket address and on username plus address"""
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        UserData.objects.create_user("victim", "victim@example.com", "secret", last_name="t")
+
+    def login(self, username, password="wrong", **extra):
+        return self.client.post("/api/login/", {"username": username, "password": password}, format="json", **extra)
+
+    def test_forwarded_for_does_not_reset_the_ip_bucket(self):
+        for i in range(3):
+            response = self.login(f"guess{i}", HTTP_X_FORWARDED_FOR=f"198.51.100.{i}")
+            self.assertEqual(response.status_code, 401)
+        response = self.login("guess9", HTTP_X_FORWARDED_FOR="198.51.100.9")
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response["Retry-After"]), 0)
+
+    def test_username_bucket_is_per_address(self):
+        self.assertEqual([self.login("Victim").status_code for _ in range(2)], [401, 401])
+        response = self.login("victim")
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+        # * the owner logging in from elsewhere is not locked out
+        self.assertEqual(self.login("victim", "secret", REMOTE_ADDR="203.0.113.5").status_code, 200)
+
+
+class BookUploadTests(TestCase):
+    """uploads are stored once per content and released with their last reference"""
+
+    def setUp(self):
+        cache.clear()
+        use_temporary_media(self)
+        self.client = APIClient()
+        self.client.force_authenticate(UserData.objects.create_user("editor", "editor@example.com", "pass", last_name="t"))
+
+    def upload(self, content, book=None):
+        data = {"file": SimpleUploadedFile("book.pdf", content, content_type="application/pdf")}
+        if book is None:
+            data.update(book_name="title", author_name="author", book_amount=1, price=1.0, public=True)
+            return self.client.post("/api/books/", data, format="multipart")
+        return self.client.patch(f"/api/books/{book}/", data, format="multipart")
+
+    def stored(self, name):
+        return BookFile._meta.get_field("file").storage.exists(name)
+
+    def test_same_content_is_stored_once(self):
+        first, second = (self.upload(b"%PDF-1.4 same").data for _ in range(2))
+        name = BookData.objects.get(pk=first["id"]).file.name
+        self.assertEqual(BookData.objects.get(pk=second["id"]).file.name, name)
+        self.assertEqual(list(BookFile.objects.values_list("file", "ref_count")), [(name, 2)])
+
+        # * replacing the file of one book drops one reference
+        self.assertEqual(self.upload(b"%PDF-1.4 other", first["id"]).status_code, 200)
+        self.assertEqual(BookFile.objects.get(file=name).ref_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            BookData.objects.get(pk=second["id"]).delete()
+        self.assertFalse(BookFile.objects.filter(file=name).exists())
+        self.assertFalse(self.stored(name))
+        self.assertEqual(BookFile.objects.get().ref_count, 1)
+
+    def test_signature_is_checked(self):
+        response = self.upload(b"MZ\x90\x00 not a pdf")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual((BookData.objects.count(), BookFile.objects.count()), (0, 0))
+
+    def test_orphans_are_replaced_and_rollbacks_clean_up(self):
+        content = b"%PDF-1.4 orphan"
+        name = book_file_name(hashlib.sha256(content).hexdigest())
+        storage = BookFile._meta.get_field("file").storage
+        storage.save(name, ContentFile(b"left behind"))
+
+        upload = SimpleUploadedFile("book.pdf", content)
+        upload.sha256 = hashlib.sha256(content).hexdigest()
+        with self.assertRaises(ValueError), stored_book_file(upload) as stored:
+            self.assertEqual(stored, name)
+            raise ValueError
+        self.assertFalse(self.stored(name))
+        self.assertFalse(BookFile.objects.exists())
+
+        response = self.upload(content)
+        self.assertEqual(BookData.objects.get(pk=response.data["id"]).file.name, name)
+        with storage.open(name) as file:
+            self.assertEqual(file.read(), content)
+
+
+class OTPStoreTests(TestCase):
+    """both stores cap attempts, consume a code once and keep purposes apart"""
+
+    def setUp(self):
+        cache.clear()
+
+    def stores(self):
+        for path in ("book.otp.InMemoryOTPStore", "book.otp.CacheOTPStore"):
+            with self.subTest(store=path):
+                yield import_string(path)()
+
+    def test_attempts_are_capped(self):
+        for store in self.stores():
+            code = store.issue("purchase", 1)
+            # * codes are 4 digits from 1000 up
+            for _ in range(settings.OTP_MAX_ATTEMPTS):
+                with self.assertRaisesMessage(OTPError, "Invalid OTP code."):
+                    store.verify("purchase", 1, "0000")
+            with self.assertRaisesMessage(OTPError, "Too many attempts"):
+                store.verify("purchase", 1, code)
+            with self.assertRaisesMessage(OTPError, "expired or already used"):
+                store.verify("purchase", 1, code)
+
+    def test_code_is_consumed_once(self):
+        for store in self.stores():
+            code = store.issue("topup", 1, {"amount": 5})
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                results = list(pool.map(lambda _: self.try_verify(store, "topup", 1, code), range(8)))
+            self.assertEqual(results.count(True), 1)
+
+    def test_purposes_and_contexts_are_separate(self):
+        for store in self.stores():
+            code = store.issue("purchase", 1, {"book": "a", "quantity": 1})
+            self.assertFalse(self.try_verify(store, "topup", 1, code))
+            self.assertFalse(self.try_verify(store, "purchase", 2, code))
+            self.assertFalse(self.try_verify(store, "purchase", 1, code, {"book": "a", "quantity": 2}))
+            self.assertEqual(store.verify("purchase", 1, code, {"book": "a", "quantity": 1}), {"book": "a", "quantity": 1})
+
+    @override_settings(OTP_TTL=0)
+    def test_codes_expire(self):
+        for store in self.stores():
+            code = store.issue("checkout", 1)
+            time.sleep(0.01)
+            with self.assertRaisesMessage(OTPError, "expired or already used"):
+                store.verify("checkout", 1, code)
+
+    @staticmethod
+    def try_verify(store, purpose, user_id, code, context=None):
+        try:
+            store.verify(purpose, user_id, code, context)
+            return True
+        except OTPError:
+            return False
+
+    @override_settings(TEST_ENVIRONMENT=False)
+    def test_process_local_stores_are_rejected(self):
+        self.assertEqual([error.id for error in check_otp_store(None)], ["book.E002"])
+        with self.settings(OTP_STORE="book.otp.InMemoryOTPStore"):
+            self.assertEqual([error.id for error in check_otp_store(None)], ["book.E001"])
+        with tempfile.TemporaryDirectory() as path, self.settings(
+            CACHES={"default": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": path}}
+        ):
+            self.assertEqual(check_otp_store(None), [])
+        with self.settings(TEST_ENVIRONMENT=True, OTP_STORE="book.otp.InMemoryOTPStore"):
+            self.assertEqual(check_otp_store(None), [])
+
+    @override_settings(TEST_ENVIRONMENT=False)
+    def test_mailed_code_completes_a_top_up(self):
+        user = UserData.objects.create_user("payer", "payer@example.com", "pass", last_name="t")
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.post("/api/topup/", {"amount": 5}, format="json")
+        self.assertNotIn("code", response.data["message"])
+        work_once("worker")
+        code = mail.outbox[0].body.split()[3].rstrip(".")
+
+        # * a top-up code cannot confirm a purchase
+        book = BookData.objects.create(book_name="b", author_name="a", book_amount=1, price=1.0)
+        response = client.put("/api/purchase/", {"book": str(book.pk), "quantity": 1, "otp_code": code}, format="json")
+        self.assertEqual(response.status_code, 400)
+        response = client.put("/api/topup/", {"amount": 5, "otp_code": code}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(user.balance, Decimal("5.00"))
+
+
+@override_settings(OTP_STORE="book.otp.InMemoryOTPStore", TEST_ENVIRONMENT=True)
+class CheckoutTests(TestCase):
+    """a cart is bought with one code, completely or not at all"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = UserData.objects.create_user("cart", "cart@example.com", "pass", last_name="t", balance=30.0)
+        self.books = [
+            BookData.objects.create(book_name=f"cart {i}", author_name="author", book_amount=2, price=10.0)
+            for i in range(2)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def cart(self, *quantities):
+        return {"items": [{"book": str(book.pk), "quantity": quantity} for book, quantity in zip(self.books, quantities)]}
+
+    def state(self):
+        stock = list(BookData.objects.order_by("pk").values_list("book_amount", flat=True))
+        return stock, self.user.balance, PurchaseBook.objects.count()
+
+    def test_cart_is_bought_with_one_code(self):
+        response = self.client.post("/api/checkout/", self.cart(1, 2), format="json")
+        self.assertEqual(response.data["total_price"], Decimal("30.00"))
+        code = response.data["message"].split()[3].rstrip(".")
+        response = self.client.put("/api/checkout/", {"otp_code": code}, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.state(), ([1, 0], Decimal("0.00"), 2))
+
+    def test_refused_carts(self):
+        book = str(self.books[0].pk)
+        duplicate = {"items": [{"book": book, "quantity": 1}, {"book": book, "quantity": 1}]}
+        # * JSON true is no quantity, the serializer's IntegerField refuses it
+        for cart in (duplicate, self.cart(1, 3), self.cart(2, 2), self.cart(True, 1), self.cart(1, 0)):
+            with self.subTest(cart=cart):
+                self.assertEqual(self.client.post("/api/checkout/", cart, format="json").status_code, 400)
+        self.assertEqual(self.state(), ([2, 2], Decimal("30.00"), 0))
+
+    def test_commit_is_all_or_nothing(self):
+        items = [{"book": self.books[0].pk, "quantity": 2}, {"book": self.books[1].pk, "quantity": 1}]
+        lines, _ = prepare_checkout(self.user, items)
+        # * stock or money gone between the code request and its confirmation
+        BookData.objects.filter(pk=self.books[1].pk).update(book_amount=0)
+        with self.assertRaisesMessage(PurchaseError, "Not enough books"):
+            commit_checkout(self.user, lines)
+        BookData.objects.filter(pk=self.books[1].pk).update(book_amount=2)
+        debit(self.user.pk, 5)
+        with self.assertRaisesMessage(PurchaseError, "Insufficient balance"):
+            commit_checkout(self.user, lines)
+        self.assertEqual(self.state(), ([2, 2], Decimal("25.00"), 0))
+
+
+class SignedDownloadTests(TestCase):
+    """signed links grant one book's file until they expire, whoever presents them"""
+
+    def setUp(self):
+        cache.clear()
+        use_temporary_media(self)
+        self.user = UserData.objects.create_user("downloader", "dl@example.com", "pass", last_name="t")
+        self.books = [
+            BookData.objects.create(book_name=f"signed {i}", author_name="author", book_amount=1, price=1.0)
+            for i in range(2)
+        ]
+        storage = BookData._meta.get_field("file").storage
+        self.books[0].file = storage.save("books/signed.pdf", ContentFile(b"%PDF-1.4 signed"))
+        self.books[0].save()
+        PurchaseBook.objects.create(user=self.user, book=self.books[0])
+        self.client = APIClient()
+
+    def signed_url(self, book):
+        self.client.force_authenticate(self.user)
+        response = self.client.get(f"/api/download/{book.pk}/link/")
+        self.client.force_authenticate(None)
+        return response
+
+    def test_link_downloads_without_credentials(self):
+        response = self.client.get(self.signed_url(self.books[0]).data["url"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), b"%PDF-1.4 signed")
+
+    def test_redemption_is_logged_with_the_issuing_user(self):
+        url = self.signed_url(self.books[0]).data["url"]
+        token = url.split("token=")[1]
+        self.assertEqual(signing.loads(token, salt=SIGNED_DOWNLOAD_SALT)["u"], str(self.user.pk))
+        with self.assertLogs("book.downloads", "INFO") as logs:
+            self.client.get(url)
+        self.assertIn(f"issued to user {self.user.pk}", logs.output[0])
+
+    def test_link_requires_a_purchase(self):
+        response = self.signed_url(self.books[1])
+        self.assertEqual((response.status_code, response.data), (403, {"error": "You haven't purchased this book."}))
+
+    def test_refused_tokens(self):
+        token, _ = sign_download(self.books[0].pk, self.books[0].file.name, self.user.pk)
+        with override_settings(BOOK_DOWNLOAD_URL_LIFETIME=-1):
+            expired, _ = sign_download(self.books[0].pk, self.books[0].file.name, self.user.pk)
+        tampered = token[:-1] + ("A" if token[-1] != "A" else "B")
+        for book, token in ((self.books[1], token), (self.books[0], tampered), (self.books[0], expired)):
+            response = self.client.get(f"/api/download/{book.pk}/signed/", {"token": token})
+            self.assertEqual(response.status_code, 403)
+
+    def test_released_file_is_not_found(self):
+        url = self.signed_url(self.books[0]).data["url"]
+        self.books[0].file.storage.delete(self.books[0].file.name)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class DownloadRangeTests(TestCase):
+    """single byte ranges are served, malformed ones ignored and impossible ones refused"""
+
+    def test_parse_range(self):
+        cases = [
+            ("bytes=0-9", 100, (0, 9)),
+            ("bytes=90-", 100, (90, 99)),
+            ("bytes=95-200", 100, (95, 99)),
+            ("bytes=-10", 100, (90, 99)),
+            ("bytes=-200", 100, (0, 99)),
+            ("bytes=5-3", 100, None),
+            ("bytes=0-1,5-6", 100, None),
+            ("bytes=-", 100, None),
+            ("items=0-9", 100, None),
+            ("bytes=100-", 100, ValueError),
+            ("bytes=-0", 100, ValueError),
+            ("bytes=0-0", 0, ValueError),
+            ("bytes=-5", 0, ValueError),
+        ]
+        for header, size, expected in cases:
+            with self.subTest(header=header, size=size):
+                if expected is ValueError:
+                    self.assertRaises(ValueError, parse_range, header, size)
+                else:
+                    self.assertEqual(parse_range(header, size), expected)
+
+    def test_ranges_and_validators(self):
+        use_temporary_media(self)
+        content = b"%PDF-1.4 ranged content"
+        upload = SimpleUploadedFile("book.pdf", content)
+        upload.sha256 = hashlib.sha256(content).hexdigest()
+        with stored_book_file(upload) as name:
+            book = BookData.objects.create(book_name="ranged", author_name="a", book_amount=1, price=1.0, file=name)
+        user = UserData.objects.create_user("ranger", "ranger@example.com", "pass", last_name="t")
+        PurchaseBook.objects.create(user=user, book=book)
+        client = APIClient()
+        client.force_authenticate(user)
+        url = f"/api/download/{book.pk}/"
+
+        response = client.get(url, HTTP_RANGE="bytes=5-8")
+        self.assertEqual((response.status_code, response["Content-Range"]), (206, f"bytes 5-8/{len(content)}"))
+        self.assertEqual(b"".join(response.streaming_content), content[5:9])
+        # * the tag of a stored book is its content digest
+        self.assertEqual(response["ETag"], f'"{upload.sha256}"')
+        self.assertEqual(client.get(url, HTTP_RANGE="bytes=5-3").status_code, 200)
+        self.assertEqual(client.get(url, HTTP_RANGE="bytes=5-8", HTTP_IF_RANGE='"stale"').status_code, 200)
+        self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+        self.assertEqual(client.get(url, HTTP_RANGE="bytes=500-").status_code, 416)
+
+        storage = book.file.storage
+        storage.save("books/legacy.pdf", ContentFile(b""))
+        self.assertTrue(file_validators(storage, "books/legacy.pdf")[1].startswith('W/"'))
+
+
+class DownloadDeliveryTests(TestCase):
+    """proxy delivery modes answer with an empty body and the internal location of the file"""
+
+    def setUp(self):
+        use_temporary_media(self)
+        self.user = UserData.objects.create_user("downloader", "dl@example.com", "pass", last_name="t")
+        self.book = BookData.objects.create(book_name="offloaded", author_name="author", book_amount=1, price=1.0)
+        storage = BookData._meta.get_field("file").storage
+        self.book.file = storage.save("books/off loaded.pdf", ContentFile(b"%PDF-1.4 offloaded"))
+        self.book.save()
+        PurchaseBook.objects.create(user=self.user, book=self.book)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def download(self):
+        return self.client.get(f"/api/download/{self.book.pk}/", HTTP_RANGE="bytes=0-3")
+
+    @override_settings(BOOK_DOWNLOAD_DELIVERY="x-accel-redirect", BOOK_DOWNLOAD_ACCEL_PREFIX="/protected/")
+    def test_x_accel_redirect(self):
+        response = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Accel-Redirect"], "/protected/books/off%20loaded.pdf")
+        self.assertEqual(response["Content-Type"], "application/pdf")
+        self.assertEqual(response.content, b"")
+
+    @override_settings(BOOK_DOWNLOAD_DELIVERY="x-sendfile")
+    def test_x_sendfile(self):
+        response = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Sendfile"], os.path.join(settings.MEDIA_ROOT, "books", "off loaded.pdf"))
+        self.assertEqual(response.content, b"")
+
+    def test_misconfigured_delivery(self):
+        request = APIRequestFactory().get("/")
+        storage = self.book.file.storage
+        for overrides in (
+            {"BOOK_DOWNLOAD_DELIVERY": "sendfile"},
+            {"BOOK_DOWNLOAD_DELIVERY": "x-accel-redirect", "BOOK_DOWNLOAD_ACCEL_PREFIX": ""},
+            {"BOOK_DOWNLOAD_DELIVERY": "x-accel-redirect", "BOOK_DOWNLOAD_ACCEL_PREFIX": "/"},
+        ):
+            with self.subTest(**overrides), self.settings(**overrides):
+                self.assertRaises(ImproperlyConfigured, deliver_file, request, storage, self.book.file.name)
+
+
+class CatalogCacheTests(TestCase):
+    """cached catalog responses follow book changes and stock, and are built once per miss"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = UserData.objects.create_user("browser", "browser@example.com", "pass", last_name="t", balance=50.0)
+        self.book = BookData.objects.create(book_name="cached", author_name="author", book_amount=5, price=1.0)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def listed(self, query=""):
+        return {row["book_name"]: row["book_amount"] for row in self.client.get(f"/api/books/{query}").data["results"]}
+
+    def test_hits_refresh_stock(self):
+        self.assertEqual(self.listed(), {"cached": 5})
+        commit_purchase(self.user, self.book, 2)
+        # * a hit only re-reads the stock of its rows
+        with self.assertNumQueries(1):
+            self.assertEqual(self.listed(), {"cached": 3})
+        response = self.client.get(f"/api/books/{self.book.pk}/")
+        self.assertEqual(response.data["book_amount"], 3)
+
+        self.assertEqual(self.listed("?in_stock=true"), {"cached": 3})
+        BookData.objects.filter(pk=self.book.pk).update(book_amount=0)
+        self.assertEqual(self.listed("?in_stock=true"), {})
+
+    def test_saves_and_deletes_invalidate(self):
+        self.listed()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.book.book_name = "renamed"
+            self.book.save()
+        self.assertEqual(self.listed(), {"renamed": 5})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.book.delete()
+        self.assertEqual(self.listed(), {})
+
+    def test_a_miss_is_computed_once(self):
+        request = Request(APIRequestFactory().get("/api/books/"))
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return Response({"built": True})
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(lambda _: cached_response(request, "stampede", compute).data, range(4)))
+        self.assertEqual((len(calls), results), (1, [{"built": True}] * 4))
+
+
+class AsyncViewTests(TestCase):
+    """the async read paths answer like their DRF counterparts"""
+
+    def setUp(self):
+        cache.clear()
+        use_temporary_media(self)
+        self.reader = UserData.objects.create_user("async", "async@example.com", "pass", last_name="t")
+        storage = BookData._meta.get_field("file").storage
+        self.public = BookData.objects.create(
+            book_name="public", author_name="a", book_amount=1, price=1.0,
+            file=storage.save("books/async.pdf", ContentFile(b"%PDF-1.4 async")),
+        )
+        self.private = BookData.objects.create(book_name="private", author_name="a", book_amount=1, price=1.0, public=False)
+        PurchaseBook.objects.create(user=self.reader, book=self.public)
+        # * AsyncClient(headers=...) is lost on Django 4.2, the header goes with every request
+        self.auth = {"Authorization": f"Bearer {RefreshToken.for_user(self.reader).access_token}"}
+        self.client = AsyncClient()
+
+    async def test_catalog_follows_visibility(self):
+        response = await self.client.get("/api/async/books/", headers=self.auth)
+        self.assertEqual([row["book_name"] for row in response.json()["results"]], ["public"])
+        self.assertEqual((await self.client.get(f"/api/async/books/{self.private.pk}/", headers=self.auth)).status_code, 404)
+        self.assertEqual((await AsyncClient().get("/api/async/books/")).status_code, 401)
+
+    async def test_download(self):
+        url = f"/api/async/download/{self.public.pk}/"
+        response = await self.client.get(url, headers={**self.auth, "Range": "bytes=0-3"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join([chunk async for chunk in response.streaming_content]), b"%PDF")
+
+        self.public.file.storage.delete(self.public.file.name)
+        response = await self.client.get(url, headers=self.auth)
+        self.assertEqual((response.status_code, response.json()), (404, {"error": "Book file not available."}))
+
+
+class AuthSnapshotTests(TestCase):
+    """JWT requests read the user from the cached snapshot, not the database"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = UserData.objects.create_user("snap", "snap@example.com", "pass", last_name="t")
+        token = RefreshToken.for_user(self.user).access_token
+        self.request = APIRequestFactory().get("/", HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def authenticate(self):
+        user, _ = CachedJWTAuthentication().authenticate(self.request)
+        return user
+
+    def test_snapshot_needs_no_user_query(self):
+        self.authenticate()
+        with self.assertNumQueries(0):
+            user = self.authenticate()
+            self.assertEqual((user.username, user.normal_user, user.balance), ("snap", False, 0))
+        self.assertEqual(user, self.user)
+
+    def test_other_fields_load_the_row_once(self):
+        user = self.authenticate()
+        with self.assertNumQueries(1):
+            self.assertEqual(user.email, "snap@example.com")
+            self.assertEqual(user.last_name, "t")
+        with self.assertRaises(AttributeError):
+            user._private
+
+    def test_saving_the_user_refreshes_the_snapshot(self):
+        self.assertFalse(self.authenticate().normal_user)
+        self.user.normal_user = True
+        self.user.save()
+        self.assertTrue(self.authenticate().normal_user)
+
+    async def test_async_views_share_the_snapshot(self):
+        user, _ = await CachedJWTAuthentication().aauthenticate(self.request)
+        self.assertEqual((user.username, user.balance), ("snap", 0))
+        self.assertEqual(await cache.aget(f"auth:user:{self.user.pk}"), {"username": "snap", "normal_user": False, "is_superuser": False, "balance": 0})
+
+    def test_deleted_users_are_rejected(self):
+        self.authenticate()
+        self.user.delete()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+
+class BookSearchTests(TestCase):
+    """every backend matches the books containing all words of the term"""
+
+    @classmethod
+    def setUpTestData(cls):
+        for name, author in (("Dune", "Frank Herbert"), ("Dune Messiah", "Frank Herbert"), ("Emma", "Jane Austen"), ("It", "Stephen King")):
+            BookData.objects.create(book_name=name, author_name=author, book_amount=1, price=1.0)
+
+    def search(self, term):
+        return sorted(search_books(BookData.objects.all(), term).values_list("book_name", flat=True))
+
+    def test_fts_and_fallback_agree(self):
+        for fts in (True, False):
+            with self.subTest(fts=fts), mock.patch.dict("core.search._fts_available", {"default": fts}):
+                self.assertEqual(self.search("dune"), ["Dune", "Dune Messiah"])
+                self.assertEqual(self.search("UNE herb"), ["Dune", "Dune Messiah"])
+                self.assertEqual(self.search("messiah, frank!"), ["Dune Messiah"])
+                self.assertEqual(self.search("it"), ["It"])
+                self.assertEqual(self.search("dune austen"), [])
+                self.assertEqual(self.search("?!% *"), [])
+
+    def test_migration_creates_the_fts_table(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("the FTS5 table is SQLite only")
+        migration = import_module("core.migrations.0008_book_search_indexes")
+        with mock.patch.dict("core.search._fts_available", clear=True):
+            self.assertEqual(fts_available("default"), migration.sqlite_has_trigrams(connection))
+
+
+class QueryRecorderTests(TransactionTestCase):
+    """queries are counted even when the connection was opened inside someone else's execute_wrapper"""
+
+    def setUp(self):
+        if connection.vendor == "sqlite" and connection.is_in_memory_db():
+            self.skipTest("closing an in-memory SQLite connection drops the database")
+        self.user = UserData.objects.create_user("reader", "reader@example.com", "pass", last_name="test")
+        Category.objects.create(name="novel")
+
+    def test_outer_wrapper_does_not_unhook_the_recorder(self):
+        def passthrough(execute, sql, params, many, context):
+            return execute(sql, params, many, context)
+
+        connection.close()
+        with connection.execute_wrapper(passthrough):
+            connection.ensure_connection()
+        self.assertEqual(connection.execute_wrappers, [])
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with self.assertLogs("core.requests", "INFO") as logs:
+            response = client.get("/api/categories/")
+        self.assertIn('desc="1 queries"', response["Server-Timing"])
+        self.assertEqual(json.loads(logs.records[-1].getMessage())["queries"], 1)
+        self.assertEqual(connection.execute_wrappers, [])
+
+
+class ConnectionReuseTests(TransactionTestCase):
+    """the WSGI handler keeps a connection for CONN_MAX_AGE and opens one per request with 0"""
+
+    def setUp(self):
+        if connection.vendor == "sqlite" and connection.is_in_memory_db():
+            self.skipTest("closing an in-memory SQLite connection drops the database")
+        user = UserData.objects.create_user("reader", "reader@example.com", "pass", last_name="test")
+        Category.objects.create(name="novel")
+        self.environ = RequestFactory().get(
+            "/api/categories/", HTTP_AUTHORIZATION=f"Bearer {RefreshToken.for_user(user).access_token}"
+        ).environ
+        connection.close()
+
+    def opened_by(self, requests):
+        handler = WSGIHandler()
+        before = connection_stats()["connections_opened"]
+        for _ in range(requests):
+            response = handler(dict(self.environ), lambda status, headers: None)
+            self.assertEqual(response.status_code, 200)
+            # * fires request_finished, which closes connections past CONN_MAX_AGE
+            response.close()
+        return connection_stats()["connections_opened"] - before
+
+    def test_persistent_connection_is_reused(self):
+        with mock.patch.dict(connection.settings_dict, CONN_MAX_AGE=60):
+            self.assertEqual(self.opened_by(5), 1)
+
+    def test_no_reuse_without_max_age(self):
+        with mock.patch.dict(connection.settings_dict, CONN_MAX_AGE=0):
+            self.assertEqual(self.opened_by(5), 5)
+
+
+class ConcurrentPurchaseTests(TransactionTestCase):
+    """many buyers racing for one book must never oversell or lose a balance update"""
+
+    threads = 16
+
+    def setUp(self):
+        if connection.vendor == "sqlite" and connection.is_in_memory_db():
+            self.skipTest("in-memory SQLite locks whole tables between threads")
+
+    def buy_all(self, jobs):
+        def buy(job):
+            user, book = job
+            try:
+                commit_purchase(user, book, 1)
+                return True
+            except PurchaseError:
+                return False
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            return list(pool.map(buy, jobs))
+
+    def test_stock_is_exact(self):
+        book = BookData.objects.create(book_name="hot", author_name="author", book_amount=10, price=3.0)
+        users = [
+            UserData.objects.create_user(f"buyer{i}", f"buyer{i}@example.com", None, last_name="test", balance=10.0)
+            for i in range(40)
+        ]
+
+        results = self.buy_all([(user, book) for user in users])
+
+        book.refresh_from_db()
+        self.assertEqual(results.count(True), 10)
+        self.assertEqual(book.book_amount, 0)
+        self.assertEqual(PurchaseBook.objects.filter(book=book).count(), 10)
+        buyers = set(PurchaseBook.objects.values_list("user_id", flat=True))
+        for user in users:
+            user.refresh_from_db()
+            self.assertEqual(user.balance, 7.0 if user.pk in buyers else 10.0)
+
+    def test_checkouts_are_all_or_nothing(self):
+        books = [
+            BookData.objects.create(book_name=f"pair {i}", author_name="author", book_amount=amount, price=2.0)
+            for i, amount in enumerate((10, 5))
+        ]
+        users = [
+            UserData.objects.create_user(f"buyer{i}", f"buyer{i}@example.com", None, last_name="test", balance=10.0)
+            for i in range(20)
+        ]
+
+        def checkout(user):
+            try:
+                commit_checkout(user, [(book, 1) for book in books])
+                return True
+            except PurchaseError:
+                return False
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            results = list(pool.map(checkout, users))
+
+        self.assertEqual(results.count(True), 5)
+        self.assertEqual(list(BookData.objects.order_by("pk").values_list("book_amount", flat=True)), [5, 0])
+        for user, bought in zip(users, results):
+            self.assertEqual(PurchaseBook.objects.filter(user=user).count(), 2 if bought else 0)
+            self.assertEqual(user.balance, 6.0 if bought else 10.0)
+
+    def test_balance_is_exact(self):
+        user = UserData.objects.create_user("buyer", "buyer@example.com", None, last_name="test", balance=50.0)
+        books = [
+            BookData.objects.create(book_name=f"book {i}", author_name="author", book_amount=5, price=10.0)
+            for i in range(30)
+        ]
+
+        results = self.buy_all([(user, book) for book in books])
+
+        user.refresh_from_db()
+        self.assertEqual(results.count(True), 5)
+        self.assertEqual(user.balance, 0.0)
+        self.assertEqual(PurchaseBook.objects.filter(user=user).count(), 5)
+        self.assertEqual(sum(BookData.objects.values_list("book_amount", flat=True)), 30 * 5 - 5)
@@ -0,0 +1,179 @@
+"""token bucket throttling
+
+every bucket holds at most `num` tokens and refills at num/period per second,
+a request takes one token or is refused with the time until the next one.
+checks are O(1) and run in APIView.initial(), before the handler does any
+password hashing or OTP lookups. Rates come from REST_FRAMEWORK's
+DEFAULT_THROTTLE_RATES, buckets live in the THROTTLE_BUCKET_STORE backend.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+PERIODS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_rate(rate):
+    """'10/min' -> (capacity 10, refill 10/60 tokens per second)"""
+    num, period = rate.split("/")
+    capacity = int(num)
+    return capacity, capacity / PERIODS[period[0]]
+
+
+def refill(state, capacity, rate, now):
+    """take one token from (tokens, updated), return the new state and the wait"""
+    tokens, updated = state if state else (capacity, now)
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+    return (tokens, now), (1 - tokens) / rate
+
+
+class LocalBucketStore:
+    """buckets in process memory, each worker throttles on its own"""
+
+    # * idle buckets are dropped once the table grows past this many keys
+    max_keys = 100000
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        now = time.monotonic()
+        with self.lock:
+            self.buckets[key], wait = refill(self.buckets.get(key), capacity, rate, now)
+            if len(self.buckets) > self.max_keys:
+                self.prune(now, capacity / rate)
+        return wait
+
+    def prune(self, now, full_after):
+        self.buckets = {
+            key: state
+            for key, state in self.buckets.items()
+            if now - state[1] < full_after
+        }
+
+
+class CacheBucketStore:
+    """
+    buckets in a Django cache, shared by every worker using the same cache
+
+    the read-modify-write of a bucket is guarded by a short cache.add() lock,
+    a bucket that stays locked is updated anyway rather than blocking the request
+    """
+
+    lock_attempts = 5
+
+    def __init__(self):
+        self.cache = caches[settings.THROTTLE_CACHE_ALIAS]
+
+    def take(self, key, capacity, rate):
+        lock_key = f"{key}:lock"
+        locked = False
+        for _ in range(self.lock_attempts):
+            locked = self.cache.add(lock_key, 1, 1)
+            if locked:
+                break
+            time.sleep(0.005)
+        try:
+            state, wait = refill(self.cache.get(key), capacity, rate, time.time())
+            self.cache.set(key, state, int(capacity / rate) + 1)
+        finally:
+            if locked:
+                self.cache.delete(lock_key)
+        return wait
+
+
+_store = None
+
+
+def get_bucket_store():
+    """the THROTTLE_BUCKET_STORE instance, rebuilt when the setting changes"""
+    global _store
+    if _store is None or _store[0] != settings.THROTTLE_BUCKET_STORE:
+        _store = (
+            settings.THROTTLE_BUCKET_STORE,
+            import_string(settings.THROTTLE_BUCKET_STORE)(),
+        )
+    return _store[1]
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """one bucket per scope and key, subclasses pick the key"""
+
+    scope = None
+    methods = None
+
+    def get_key(self, request, view):
+        raise NotImplementedError
+
+    def allow_request(self, request, view):
+        self.retry_after = None
+        if self.methods and request.method not in self.methods:
+            return True
+        key = self.get_key(request, view)
+        if key is None:
+            return True
+        capacity, rate = parse_rate(api_settings.DEFAULT_THROTTLE_RATES[self.scope])
+        self.retry_after = get_bucket_store().take(
+            f"throttle:{self.scope}:{key}", capacity, rate
+        )
+        return self.retry_after == 0
+
+    def wait(self):
+        return self.retry_after
+
+
+class LoginIPThrottle(TokenBucketThrottle):
+    """
+    per client address, get_ident() only trusts X-Forwarded-For entries
+    added by the NUM_PROXIES proxies in front of the app
+    """
+
+    scope = "login_ip"
+
+    def get_key(self, request, view):
+        return self.get_ident(request)
+
+
+class LoginUsernameThrottle(TokenBucketThrottle):
+    """
+    per username and client address, guessing one account's password is
+    limited tighter than login_ip, but someone hammering a username from
+    their own address cannot lock its owner out everywhere
+    """
+
+    scope = "login_username"
+
+    def get_key(self, request, view):
+        username = request.data.get("username")
+        return (
+            f"{str(username).lower()}:{self.get_ident(request)}" if username else None
+        )
+
+
+class OTPRequestThrottle(TokenBucketThrottle):
+    """issuing codes, the POST step of the OTP flows"""
+
+    scope = "otp_request"
+    methods = ("POST",)
+
+    def get_key(self, request, view):
+        return (
+            request.user.pk
+            if request.user.is_authenticated
+            else self.get_ident(request)
+        )
+
+
+class OTPVerifyThrottle(OTPRequestThrottle):
+    """guessing codes, the PUT step of the OTP flows"""
+
+    scope = "otp_verify"
+    methods = ("PUT",)
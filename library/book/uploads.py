@@ -0,0 +1,164 @@
+"""content addressed book upload pipeline
+
+uploads are streamed chunk by chunk into a temporary file while being hashed,
+the first bytes are checked for the PDF signature instead of trusting the file
+name, and every distinct content is stored once as a BookFile that counts the
+BookData rows referencing it.
+"""
+import hashlib
+import os
+from contextlib import contextmanager
+
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from core.models import BookFile
+
+PDF_MAGIC = b"%PDF-"
+
+
+class HashingPDFUploadHandler(FileUploadHandler):
+    """
+    write uploads straight to disk while hashing them, never keeping the
+    whole file in memory
+
+    the returned file carries `sha256` and `is_pdf`, a file that does not start
+    with the PDF signature is drained without being written
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.file = TemporaryUploadedFile(
+            self.file_name, self.content_type, 0, self.charset, self.content_type_extra
+        )
+        self.hash = hashlib.sha256()
+        self.head = b""
+        self.is_pdf = None
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.is_pdf is None:
+            self.head += raw_data
+            if len(self.head) < len(PDF_MAGIC):
+                return None
+            self.is_pdf = self.head.startswith(PDF_MAGIC)
+            raw_data, self.head = self.head, b""
+        if self.is_pdf:
+            self.hash.update(raw_data)
+            self.file.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        self.file.seek(0)
+        self.file.is_pdf = bool(self.is_pdf)
+        self.file.size = file_size if self.file.is_pdf else 0
+        self.file.sha256 = self.hash.hexdigest()
+        return self.file
+
+    def upload_interrupted(self):
+        if hasattr(self, "file"):
+            temp_location = self.file.temporary_file_path()
+            try:
+                self.file.close()
+                os.remove(temp_location)
+            except FileNotFoundError:
+                pass
+
+
+def book_file_storage():
+    return BookFile._meta.get_field("file").storage
+
+
+def book_file_name(digest):
+    """
+    storage name of the content with digest, sharded by
+    the first byte of the hash to keep directories small
+    """
+    return BookFile._meta.get_field("file").generate_filename(
+        None, f"{digest[:2]}/{digest}.pdf"
+    )
+
+
+def store_book_file(uploaded):
+    """
+    take a reference on the BookFile of the uploaded content, storing the file
+    when the content is new
+
+    returns (storage name to put in BookData.file, whether this call wrote it).
+    Call inside a transaction, stored_book_file() also cleans up after a rollback
+    """
+    digest = uploaded.sha256
+    for _ in range(3):
+        # * an existing blob is referenced with one
+        # * conditional UPDATE that locks its row
+        if BookFile.objects.filter(digest=digest).update(ref_count=F("ref_count") + 1):
+            return (
+                BookFile.objects.values_list("file", flat=True).get(digest=digest),
+                False,
+            )
+        name = book_file_name(digest)
+        try:
+            with transaction.atomic():
+                BookFile.objects.create(
+                    digest=digest, file=name, size=uploaded.size, ref_count=1
+                )
+        except IntegrityError:
+            # * a concurrent upload of the same content
+            # * inserted it first, reference that one
+            continue
+        storage = book_file_storage()
+        # * the same content, left behind by an upload whose transaction rolled back,
+        # * replaced instead of getting a suffixed name no BookFile would point to
+        storage.delete(name)
+        storage.save(name, uploaded)
+        return name, True
+    raise IntegrityError(f"could not reference book file {digest}")
+
+
+@contextmanager
+def stored_book_file(uploaded):
+    """
+    a transaction holding a reference on the BookFile of uploaded, yields the
+    storage name to save the book with
+
+    a file written by the block is deleted again when the block raises, while
+    the new BookFile row is still locked, so no concurrent upload of the same
+    content can have referenced it yet
+    """
+    with transaction.atomic():
+        name, written = store_book_file(uploaded)
+        try:
+            yield name
+        except BaseException:
+            if written:
+                book_file_storage().delete(name)
+            raise
+
+
+def release_book_file(name):
+    """
+    drop a reference taken by store_book_file, deleting the file with the last one
+
+    files that were not stored through the pipeline are left alone
+    """
+    if not name:
+        return
+    with transaction.atomic():
+        blob = BookFile.objects.select_for_update().filter(file=name).first()
+        if blob is None:
+            return
+        if blob.ref_count > 1:
+            BookFile.objects.filter(pk=blob.pk).update(ref_count=F("ref_count") - 1)
+            return
+        blob.delete()
+        transaction.on_commit(lambda: delete_unreferenced(name))
+
+
+def delete_unreferenced(name):
+    """
+    delete a released file, unless an upload of
+    the same content has stored it again since
+    """
+    if not BookFile.objects.filter(file=name).exists():
+        book_file_storage().delete(name)
@@ -5,12 +5,21 @@ from .views import (
     UserLoginView,
     BookViewSet,
     PurchaseBookView,
+    PurchaseListView,
     DownloadBookView,
+    DownloadLinkView,
+    SignedDownloadView,
     CategoryViewSet,
     BalanceTopUpView,
+    CheckoutView,
+    RequestMetricsView,
+    BookExportView,
+    PurchaseExportView,
+    SalesAnalyticsView,
 
 )
 from rest_framework_simplejwt.views import TokenBlacklistView
+from . import async_views
 
 router = DefaultRouter()
 router.register(r'users', UserDataViewSet, basename='user')
@@ -21,8 +30,21 @@ urlpatterns = [
     path('api/', include(router.urls)), 
     path('api/login/', UserLoginView.as_view(), name='login'),  
     path('api/purchase/', PurchaseBookView.as_view(), name='purchase'),  
+    path('api/purchases/', PurchaseListView.as_view(), name='purchase_list'),
+    path('api/checkout/', CheckoutView.as_view(), name='checkout'),
     path('api/download/<uuid:book_id>/', DownloadBookView.as_view(), name='download_book'), 
+    path('api/download/<uuid:book_id>/link/', DownloadLinkView.as_view(), name='download_link'),
+    path('api/download/<uuid:book_id>/signed/', SignedDownloadView.as_view(), name='signed_download'),
     path('logout/', TokenBlacklistView.as_view(), name='token_blacklist'),
     path('api/topup/', BalanceTopUpView.as_view(), name='balance_topup'),  
+    path('api/export/books/', BookExportView.as_view(), name='export_books'),
+    path('api/export/purchases/', PurchaseExportView.as_view(), name='export_purchases'),
+    path('api/analytics/sales/', SalesAnalyticsView.as_view(), name='sales_analytics'),
+    path('api/metrics/', RequestMetricsView.as_view(), name='request_metrics'),
+    # * async read paths, served without a thread per connection by the asgi service
+    path('api/async/books/', async_views.book_list, name='async_book_list'),
+    path('api/async/books/<uuid:pk>/', async_views.book_detail, name='async_book_detail'),
+    path('api/async/categories/', async_views.category_list, name='async_category_list'),
+    path('api/async/download/<uuid:book_id>/', async_views.download_book, name='async_download_book'),
 
 ]
@@ -1,39 +1,70 @@
-import random
+import datetime
 import os
+import uuid
 
 from django.shortcuts import get_object_or_404
-from django.http import FileResponse
 from django.contrib.auth import authenticate
 from django.conf import settings
-from django.core.exceptions import ValidationError
+from django.core import signing
+from django.http import StreamingHttpResponse
+from django.urls import reverse
+from django.utils import timezone
 
-from rest_framework import viewsets, status, permissions
+from rest_framework import generics, viewsets, status, permissions
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
 from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework.views import APIView
-from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.permissions import IsAuthenticated
 
+from core.dbstats import connection_stats
+from core.middleware import BUCKETS_MS, view_histograms
 from core.models import UserData, BookData, PurchaseBook, Category
-from core.serializers import UserDataSerializer, BookDataSerializer, PurchaseBookSerializer, CategorySerializer
-
-
-class UserDataViewSet(viewsets.ModelViewSet):
+from core.serializers import (
+    UserDataSerializer,
+    BookDataSerializer,
+    PurchaseBookSerializer,
+    CategorySerializer,
+    CheckoutSerializer,
+)
+from .authentication import CachedJWTAuthentication
+from .cache import CatalogCacheMixin
+from .downloads import deliver_file, sign_download, verify_download
+from .exports import EXPORT_FORMATS, book_rows, encode_rows, purchase_rows
+from .fieldsets import SparseFieldsetMixin
+from .filters import BookFilterBackend
+from .ledger import to_money, valid_topup
+from .otp import OTPError, get_otp_store
+from .permissions import IsSuperUser
+from .reservations import hold_stock
+from .rollups import ORDERINGS, sales_by_day, sales_totals, top_books, top_categories
+from .services import PurchaseError, commit_checkout, commit_purchase, prepare_checkout, top_up_balance
+from .tasks import queue_otp
+from .throttling import LoginIPThrottle, LoginUsernameThrottle, OTPRequestThrottle, OTPVerifyThrottle
+from .uploads import HashingPDFUploadHandler, release_book_file, stored_book_file
+
+
+class UserDataViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     """
     get, create, edit and delete AdminData
     """
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [CachedJWTAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     
     queryset = UserData.objects.all()
     serializer_class = UserDataSerializer
 
+    def get_queryset(self):
+        """
+        users with the relations the serializer renders loaded up front
+        """
+        return self.restrict_queryset(self.queryset)
+
     def list(self, request):
         """
-        get all AdminData
+        get all AdminData, one keyset page at a time
         """
-        admin_serializer = UserDataSerializer(self.queryset, many=True)
-        return Response(admin_serializer.data)
+        return super().list(request)
 
     def createt(self, request):
         print("Incoming data:", request.data)
@@ -58,7 +89,7 @@ class UserDataViewSet(viewsets.ModelViewSet):
         """
         try:
             admin_instance = self.get_object()
-            admin_serializer = self.serializer_class(admin_instance)
+            admin_serializer = self.get_serializer(admin_instance)
             return Response(admin_serializer.data)
         except UserData.DoesNotExist:
             return Response(
@@ -104,6 +135,7 @@ class UserLoginView(APIView):
     """handle login with JWT"""
 
     permission_classes = [permissions.AllowAny]
+    throttle_classes = [LoginIPThrottle, LoginUsernameThrottle]
 
     def post(self, request, *args, **kwargs):
         username = request.data.get("username")
@@ -130,32 +162,35 @@ class UserLoginView(APIView):
                 status=status.HTTP_401_UNAUTHORIZED,
             )
             
-class BookViewSet(viewsets.ModelViewSet):
+class BookViewSet(CatalogCacheMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = BookData.objects.all()
     serializer_class = BookDataSerializer
     permission_classes = [permissions.IsAuthenticated]
+    filter_backends = [BookFilterBackend]
+    # * purchases, holds and the sweeper change stock with .update(), no version bump
+    live_fields = ("book_amount",)
+
+    def uncacheable(self):
+        # * which books match ?in_stock= depends on the stock itself
+        return "in_stock" in self.request.query_params or super().uncacheable()
 
     def get_queryset(self):
         """
+        books visible to the current user, with the relations the serializer renders
         """
-        user = self.request.user
-        if user.is_authenticated:
-            if user.normal_user:
-                # * User has access, return all books
-                return BookData.objects.all()
-            else:
-                # * User does not have access, return only public books (private = False)
-                return BookData.objects.filter(public=True)
-        else:
-            # * If the user is not authenticated, return only public books
-            return BookData.objects.filter(public=True)
-        
+        return self.restrict_queryset(BookData.objects.visible_to(self.request.user))
+
+    def initialize_request(self, request, *args, **kwargs):
+        # * book files are streamed to disk and hashed instead of buffered in memory
+        request.upload_handlers = [HashingPDFUploadHandler(request)]
+        return super().initialize_request(request, *args, **kwargs)
+
     def validate_file_format(self, file):
         """
-        Validate that the uploaded file is a .pdf.
+        Validate that the uploaded file is a PDF by its signature, not its name.
         """
-        if file and not file.name.endswith('.pdf'):
-            raise ValidationError("Only PDF files are allowed for book uploads.")
+        if file and not getattr(file, 'is_pdf', False):
+            raise ValidationError({"file": "Only PDF files are allowed for book uploads."})
         
     def create(self, request, *args, **kwargs):
         """
@@ -166,7 +201,11 @@ class BookViewSet(viewsets.ModelViewSet):
         
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
-            serializer.save()
+            if file:
+                with stored_book_file(file) as name:
+                    serializer.save(file=name)
+            else:
+                serializer.save()
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)         
 
@@ -184,34 +223,39 @@ class BookViewSet(viewsets.ModelViewSet):
 
         serializer = self.get_serializer(instance, data=request.data, partial=partial)
         if serializer.is_valid():
-            serializer.save()
+            old_file = instance.file.name
+            if file:
+                with stored_book_file(file) as name:
+                    serializer.save(file=name)
+                    release_book_file(old_file)
+            else:
+                serializer.save()
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 class PurchaseBookView(APIView):
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [CachedJWTAuthentication]
     permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [OTPRequestThrottle, OTPVerifyThrottle]
 
     def post(self, request, *args, **kwargs):
         user = request.user
         book_id = request.data.get('book')
         quantity = request.data.get('quantity', 1)
+
+        # * JSON true is an int to Python
+        if isinstance(quantity, bool) or not isinstance(quantity, int) or quantity < 1:
+            return Response({"error": "Invalid quantity."}, status=status.HTTP_400_BAD_REQUEST)
         
         book = get_object_or_404(BookData, id=book_id)
         
-        if not user.normal_user and not book.public:
+        if not book.is_visible_to(user):
             return Response({"error": "You are not allowed to purchase this book."}, status=status.HTTP_403_FORBIDDEN)
         
-        if PurchaseBook.objects.filter(user=user, book=book).exists():
+        if PurchaseBook.objects.filter(user_id=user.pk, book=book).exists():
             return Response({"error": "You have already purchased this book."}, status=status.HTTP_400_BAD_REQUEST)
 
-        if quantity > book.book_amount:
-            return Response(
-                {"error": "Requested quantity exceeds available stock."},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-
-        total_price = book.price * quantity
+        total_price = to_money(book.price) * quantity
 
         if user.balance < total_price:
             return Response(
@@ -219,20 +263,26 @@ class PurchaseBookView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
+        # * the copies stay held until the OTP is confirmed or the hold expires,
+        # * hold_stock checks the stock itself since book_amount excludes this user's earlier hold
+        try:
+            hold = hold_stock(user, book, quantity)
+        except PurchaseError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        otp = get_otp_store().issue('purchase', user.pk, {"book": str(book.id), "quantity": quantity})
         if settings.TEST_ENVIRONMENT:
-            otp = random.randint(1000, 9999)
-            request.session['otp'] = otp
-            request.session['otp_used'] = False  # *track OTP 
             return Response(
-                {"message": f"OTP code is {otp}. Use this code to complete your purchase."},
+                {
+                    "message": f"OTP code is {otp}. Use this code to complete your purchase.",
+                    "reserved_until": hold.expires_at,
+                },
                 status=status.HTTP_200_OK
             )
-        else:
-            # * In production
-            pass
+        queue_otp('purchase', user.pk)
 
         return Response(
-            {"message": "OTP sent. Use the OTP to complete the transaction."},
+            {"message": "OTP sent. Use the OTP to complete the transaction.", "reserved_until": hold.expires_at},
             status=status.HTTP_200_OK
         )
 
@@ -243,86 +293,215 @@ class PurchaseBookView(APIView):
         otp_code = request.data.get('otp_code')
         quantity = request.data.get('quantity', 1)
 
+        # * JSON true is an int to Python
+        if isinstance(quantity, bool) or not isinstance(quantity, int) or quantity < 1:
+            return Response({"error": "Invalid quantity."}, status=status.HTTP_400_BAD_REQUEST)
+
         book = get_object_or_404(BookData, id=book_id)
         
-        if not user.normal_user and not book.public:
+        if not book.is_visible_to(user):
             return Response({"error": "You are not allowed to purchase this book."}, status=status.HTTP_403_FORBIDDEN)
 
 
-        if settings.TEST_ENVIRONMENT:
-            if str(request.session.get('otp')) != otp_code:
-                return Response({"error": "Invalid OTP code."}, status=status.HTTP_400_BAD_REQUEST)
-            
-            if request.session.get('otp_used'):
-                return Response({"error": "OTP has already been used."}, status=status.HTTP_400_BAD_REQUEST)
+        # * the code only confirms the book and quantity it was issued for
+        try:
+            get_otp_store().verify('purchase', user.pk, otp_code, {"book": str(book.id), "quantity": quantity})
+        except OTPError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
 
-            request.session['otp_used'] = True
+        try:
+            purchase = commit_purchase(user, book, quantity)
+        except PurchaseError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
 
-            
-        total_price = book.price * quantity
-        if user.balance - total_price < 0:
-            return Response({"error": "Insufficient balance. Balance cannot be negative."}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = PurchaseBookSerializer(purchase)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-        user.balance -= total_price
-        user.save()
-        
-        if book.book_amount - quantity < 0:
+
+class PurchaseListView(SparseFieldsetMixin, generics.ListAPIView):
+    """the current user's purchases, one keyset page at a time"""
+
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = PurchaseBookSerializer
+
+    def get_queryset(self):
+        return self.restrict_queryset(PurchaseBook.objects.filter(user_id=self.request.user.pk))
+
+
+class CheckoutView(APIView):
+    """buy a whole cart with a single OTP"""
+
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [OTPRequestThrottle, OTPVerifyThrottle]
+
+    def post(self, request, *args, **kwargs):
+        """
+        Step 1: validate the cart and request an OTP for it.
+        """
+        serializer = CheckoutSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            lines, total_price = prepare_checkout(request.user, serializer.validated_data['items'])
+        except PurchaseError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # * the confirmation buys exactly the cart the OTP was issued for
+        cart = [[str(book.pk), quantity] for book, quantity in lines]
+        otp = get_otp_store().issue('checkout', request.user.pk, {"items": cart})
+        if settings.TEST_ENVIRONMENT:
             return Response(
-            {"error": "Not enough books in stock. Stock cannot be negative."},
-            status=status.HTTP_400_BAD_REQUEST
+                {
+                    "message": f"OTP code is {otp}. Use this code to complete your purchase.",
+                    "total_price": total_price,
+                },
+                status=status.HTTP_200_OK
             )
-        book.book_amount -= quantity
-        book.save()
+        queue_otp('checkout', request.user.pk)
 
-        purchase = PurchaseBook.objects.create(
-            user=user,
-            book=book,
-            quantity=quantity,
+        return Response(
+            {"message": "OTP sent. Use the OTP to complete the transaction.", "total_price": total_price},
+            status=status.HTTP_200_OK
         )
 
-        serializer = PurchaseBookSerializer(purchase)
+    def put(self, request, *args, **kwargs):
+        """
+        Step 2: confirm the OTP and buy the cart.
+        """
+        otp_code = request.data.get('otp_code')
+        try:
+            cart = get_otp_store().verify('checkout', request.user.pk, otp_code)["items"]
+        except OTPError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        items = [{"book": uuid.UUID(book_id), "quantity": quantity} for book_id, quantity in cart]
+        try:
+            lines, _ = prepare_checkout(request.user, items)
+            purchases = commit_checkout(request.user, lines)
+        except PurchaseError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = PurchaseBookSerializer(purchases, many=True)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
 class DownloadBookView(APIView):
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [CachedJWTAuthentication]
     permission_classes = [permissions.IsAuthenticated]
 
-    def get(self, request, book_id):
+    def get_entitled_file(self, request, book_id):
+        """
+        the book file the user may download, raises PermissionDenied or NotFound
+        """
         user = request.user
-        purchase = PurchaseBook.objects.filter(user=user, book_id=book_id).first()
+        purchase = PurchaseBook.objects.filter(user_id=user.pk, book_id=book_id).select_related("book").first()
+        if not purchase:
+            raise PermissionDenied({"error": "You haven't purchased this book."})
+
+        book = purchase.book
+        # * Check if the book is private and the user doesn't have access
+        if not book.is_visible_to(user):
+            raise PermissionDenied({"error": "You don't have access to download this private book."})
+        if not book.file:
+            raise NotFound({"error": "Book file not available."})
+        return book.file
 
-        if purchase:
-            book = purchase.book
+    def get(self, request, book_id):
+        file = self.get_entitled_file(request, book_id)
+        return deliver_file(request, file.storage, file.name)
 
-            # * Check if the book is public and the user doesn't have access
-            if book.private and not user.allow_access:
-                return Response(
-                    {"error": "You don't have access to download this private book."},
-                    status=status.HTTP_403_FORBIDDEN
-                )
 
-            file = book.file
-            if file:
-                return FileResponse(file.open('rb'), content_type='application/pdf')
-            else:
-                return Response({"error": "Book file not available."}, status=status.HTTP_404_NOT_FOUND)
-        else:
-            return Response({"error": "You haven't purchased this book."}, status=status.HTTP_403_FORBIDDEN)
+class DownloadLinkView(DownloadBookView):
+    """issue a short lived signed download URL after one entitlement check"""
+
+    def get(self, request, book_id):
+        file = self.get_entitled_file(request, book_id)
+        token, expires = sign_download(book_id, file.name, request.user.pk)
+        url = reverse('signed_download', kwargs={'book_id': book_id})
+        return Response(
+            {"url": request.build_absolute_uri(f"{url}?token={token}"), "expires": expires},
+            status=status.HTTP_200_OK
+        )
+
+
+class SignedDownloadView(APIView):
+    """
+    download with a signed URL, the signature is the only check so this path
+    never touches the database. Links are bearer links, valid for anyone
+    until they expire, redemptions are logged with the user they were issued to
+    """
+    authentication_classes = []
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request, book_id):
+        try:
+            name = verify_download(request.query_params.get('token', ''), book_id)
+        except signing.BadSignature:
+            return Response({"error": "Invalid or expired download link."}, status=status.HTTP_403_FORBIDDEN)
+
+        storage = BookData._meta.get_field('file').storage
+        return deliver_file(request, storage, name)
+
+
+class ExportView(APIView):
+    """
+    base for streamed exports, ?output=jsonl (default) for JSON Lines or
+    ?output=json for a single JSON array
+    """
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+    filename = "export"
+
+    def get_rows(self, request):
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        fmt = request.query_params.get('output', 'jsonl')
+        if fmt not in EXPORT_FORMATS:
+            return Response(
+                {"error": f"output must be one of {', '.join(EXPORT_FORMATS)}."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        response = StreamingHttpResponse(encode_rows(self.get_rows(request), fmt), content_type=EXPORT_FORMATS[fmt])
+        response['Content-Disposition'] = f'attachment; filename="{self.filename}.{fmt}"'
+        return response
+
+
+class BookExportView(ExportView):
+    """every book the user can see"""
+    filename = "books"
+
+    def get_rows(self, request):
+        return book_rows(BookData.objects.visible_to(request.user), request)
+
+
+class PurchaseExportView(ExportView):
+    """the user's whole purchase history"""
+    filename = "purchases"
 
+    def get_rows(self, request):
+        return purchase_rows(PurchaseBook.objects.filter(user_id=request.user.pk))
 
-class CategoryViewSet(viewsets.ModelViewSet):
+
+class CategoryViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     """create category
     """
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [CachedJWTAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
 
+    def get_queryset(self):
+        return self.restrict_queryset(self.queryset)
+
 
 class BalanceTopUpView(APIView):
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [CachedJWTAuthentication]
     permission_classes = [IsAuthenticated]
+    throttle_classes = [OTPRequestThrottle, OTPVerifyThrottle]
 
     def post(self, request, *args, **kwargs):
         """
@@ -330,20 +509,19 @@ class BalanceTopUpView(APIView):
         """
         amount = request.data.get("amount", 0)
 
-        if amount <= 0:
-            return Response({"error": "Invalid top-up amount."}, status=status.HTTP_400_BAD_REQUEST)
+        if not valid_topup(amount):
+            return Response(
+                {"error": f"Top-up amount must be a number between 0.01 and {settings.BALANCE_TOPUP_MAX}."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
+        otp = get_otp_store().issue('topup', request.user.pk, {"amount": amount})
         if settings.TEST_ENVIRONMENT:
-            otp = random.randint(1000, 9999)
-            request.session['otp'] = otp
-            request.session['otp_used'] = False
             return Response(
                 {"message": f"OTP code is {otp}. Use this code to complete your top-up."},
                 status=status.HTTP_200_OK
             )
-        else:
-            # *In production
-            pass
+        queue_otp('topup', request.user.pk)
 
         return Response(
             {"message": "OTP sent. Use the OTP to complete the transaction."},
@@ -357,21 +535,81 @@ class BalanceTopUpView(APIView):
         otp_code = request.data.get("otp_code")
         amount = request.data.get("amount", 0)
 
-        if amount <= 0:
-            return Response({"error": "Invalid top-up amount."}, status=status.HTTP_400_BAD_REQUEST)
+        if not valid_topup(amount):
+            return Response(
+                {"error": f"Top-up amount must be a number between 0.01 and {settings.BALANCE_TOPUP_MAX}."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-        if settings.TEST_ENVIRONMENT:
-            if str(request.session.get('otp')) != otp_code:
-                return Response({"error": "Invalid OTP code."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            get_otp_store().verify('topup', request.user.pk, otp_code, {"amount": amount})
+        except OTPError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
 
-            if request.session.get('otp_used'):
-                return Response({"error": "OTP has already been used."}, status=status.HTTP_400_BAD_REQUEST)
-            
-            request.session['otp_used'] = True
-            
-        user = request.user
-        user.balance += amount
-        user.save()
+        top_up_balance(request.user, amount)
 
         return Response({"message": f"Balance successfully charged by {amount} units."}, status=status.HTTP_200_OK)
 
+
+class RequestMetricsView(APIView):
+    """per view timing histograms and connection reuse of the worker process serving the request"""
+
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [IsSuperUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(
+            {
+                "pid": os.getpid(),
+                "buckets_ms": BUCKETS_MS,
+                "views": view_histograms(),
+                "connections": connection_stats(),
+            },
+            status=status.HTTP_200_OK
+        )
+
+
+class SalesAnalyticsView(APIView):
+    """
+    units and revenue read from the daily rollups, superusers only
+
+    ?from= and ?to= bound the days (YYYY-MM-DD, inclusive, default the last 30),
+    ?group=day lists every day, ?group=book or ?group=category ranks the
+    ?top= best sellers by ?order=revenue or units
+    """
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [IsSuperUser]
+    max_top = 100
+
+    def get(self, request, *args, **kwargs):
+        params = request.query_params
+        try:
+            end = datetime.date.fromisoformat(params['to']) if params.get('to') else timezone.localdate()
+            start = datetime.date.fromisoformat(params['from']) if params.get('from') else end - datetime.timedelta(days=29)
+        except ValueError:
+            return Response({"error": "from and to must be YYYY-MM-DD dates."}, status=status.HTTP_400_BAD_REQUEST)
+        if start > end:
+            return Response({"error": "from must not be after to."}, status=status.HTTP_400_BAD_REQUEST)
+
+        group = params.get('group', 'day')
+        order = params.get('order', 'revenue')
+        if order not in ORDERINGS:
+            return Response({"error": "order must be revenue or units."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            top = min(max(int(params.get('top', 10)), 1), self.max_top)
+        except ValueError:
+            return Response({"error": "top must be a number."}, status=status.HTTP_400_BAD_REQUEST)
+
+        if group == 'day':
+            results = sales_by_day(start, end)
+        elif group == 'book':
+            results = top_books(start, end, top, order)
+        elif group == 'category':
+            results = top_categories(start, end, top, order)
+        else:
+            return Response({"error": "group must be day, book or category."}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(
+            {"from": start, "to": end, "group": group, "totals": sales_totals(start, end), "results": results},
+            status=status.HTTP_200_OK
+        )
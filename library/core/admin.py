@@ -1,7 +1,8 @@
 from django.contrib import admin
-from .models import UserData, PurchaseBook, BookData, Category
+from .models import UserData, PurchaseBook, BookData, BookFile, Category
 
 admin.site.register(UserData)
 admin.site.register(PurchaseBook)
 admin.site.register(BookData)
 admin.site.register(Category)
+admin.site.register(BookFile)
@@ -0,0 +1,27 @@
+"""per process database connection reuse statistics
+"""
+import threading
+
+_lock = threading.Lock()
+_counts = {"requests": 0, "connections": 0}
+
+
+def count_request(**kwargs):
+    with _lock:
+        _counts["requests"] += 1
+
+
+def count_connection(**kwargs):
+    with _lock:
+        _counts["connections"] += 1
+
+
+def connection_stats():
+    """requests served, connections opened and the share of requests that reused one"""
+    with _lock:
+        requests, connections = _counts["requests"], _counts["connections"]
+    return {
+        "requests": requests,
+        "connections_opened": connections,
+        "reuse_ratio": round(1 - connections / requests, 4) if requests else 0.0,
+    }
@@ -0,0 +1,257 @@
+"""per request SQL, serializer and total timing
+
+RequestMetricsMiddleware gives every request a RequestMetrics in a context
+variable. Queries are counted and timed by an execute wrapper that is pushed
+on every database connection for the length of the request and popped again
+after it, so it nests with any other execute_wrapper() (contextvars follow
+sync_to_async, so queries of async views are counted too), serializers add
+their to_representation time
+with timed_serialization(). The totals are sent as a Server-Timing header and
+logged as one JSON line on the "core.requests" logger, requests over
+REQUEST_SLOW_MS or REQUEST_SLOW_QUERIES are logged as warnings with their
+slowest statements. Per view histograms of this process back the metrics
+endpoint.
+
+streamed responses are logged and counted once their body is consumed, so the
+queries run while streaming are included. Their Server-Timing header leaves
+before the body and is marked partial.
+"""
+import bisect
+import heapq
+import json
+import logging
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger("core.requests")
+
+_current = ContextVar("request_metrics", default=None)
+
+# * upper bounds of the latency histogram buckets, the last bucket is everything slower
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_lock = threading.Lock()
+_views = {}
+
+
+class RequestMetrics:
+    """what one request spent in the database, in serializers and in total"""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializing = False
+        # * min-heap of (seconds, sql), keeps the
+        # * REQUEST_SLOW_QUERY_SAMPLES slowest statements
+        self.slowest = []
+
+    def record_query(self, sql, elapsed):
+        self.queries += 1
+        self.db_time += elapsed
+        if len(self.slowest) < settings.REQUEST_SLOW_QUERY_SAMPLES:
+            heapq.heappush(self.slowest, (elapsed, sql))
+        else:
+            heapq.heappushpop(self.slowest, (elapsed, sql))
+
+
+def record_query(execute, sql, params, many, context):
+    """execute wrapper pushed by recording(), a pass-through outside of it"""
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.record_query(sql, time.perf_counter() - start)
+
+
+@contextmanager
+def recording(metrics):
+    """count the queries and serializers of the block into metrics"""
+    token = _current.set(metrics)
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(record_query))
+            yield
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def timed_serialization():
+    """
+    count the block as serializer time, nested serializers are part of the outer one
+    """
+    metrics = _current.get()
+    if metrics is None or metrics.serializing:
+        yield
+        return
+    metrics.serializing = True
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.serializer_time += time.perf_counter() - start
+        metrics.serializing = False
+
+
+def record_view(view, total_ms, metrics):
+    with _lock:
+        row = _views.get(view)
+        if row is None:
+            row = _views[view] = {
+                "count": 0,
+                "total_ms": 0.0,
+                "db_ms": 0.0,
+                "serializer_ms": 0.0,
+                "queries": 0,
+                "buckets": [0] * (len(BUCKETS_MS) + 1),
+            }
+        row["count"] += 1
+        row["total_ms"] += total_ms
+        row["db_ms"] += metrics.db_time * 1000
+        row["serializer_ms"] += metrics.serializer_time * 1000
+        row["queries"] += metrics.queries
+        row["buckets"][bisect.bisect_left(BUCKETS_MS, total_ms)] += 1
+
+
+def view_histograms():
+    """per view request counts, mean timings and latency buckets of this process"""
+    labels = [f"le_{bound}" for bound in BUCKETS_MS] + ["inf"]
+    with _lock:
+        rows = {
+            view: dict(row, buckets=list(row["buckets"]))
+            for view, row in _views.items()
+        }
+    return {
+        view: {
+            "count": row["count"],
+            "mean_ms": round(row["total_ms"] / row["count"], 2),
+            "mean_db_ms": round(row["db_ms"] / row["count"], 2),
+            "mean_serializer_ms": round(row["serializer_ms"] / row["count"], 2),
+            "mean_queries": round(row["queries"] / row["count"], 2),
+            "buckets": dict(zip(labels, row["buckets"])),
+        }
+        for view, row in rows.items()
+    }
+
+
+class RequestMetricsMiddleware:
+    """time each request, first in MIDDLEWARE so the total covers the whole stack"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        start = time.perf_counter()
+        with recording(metrics):
+            response = self.get_response(request)
+        return self.finish(request, response, metrics, start)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        start = time.perf_counter()
+        with recording(metrics):
+            response = await self.get_response(request)
+        return self.finish(request, response, metrics, start)
+
+    def finish(self, request, response, metrics, start):
+        total_ms = (time.perf_counter() - start) * 1000
+        db_ms = metrics.db_time * 1000
+        serializer_ms = metrics.serializer_time * 1000
+        # * files handed to wsgi.file_wrapper run no
+        # * queries, wrapping them would lose sendfile
+        streamed = (
+            response.streaming and getattr(response, "file_to_stream", None) is None
+        )
+        queries = f"{metrics.queries} queries{' before streaming' if streamed else ''}"
+        response["Server-Timing"] = (
+            f'db;dur={db_ms:.2f};desc="{queries}", '
+            f"serialize;dur={serializer_ms:.2f}, total;dur={total_ms:.2f}"
+        )
+        if not streamed:
+            self.log(request, response, metrics, total_ms)
+        elif response.is_async:
+            response.streaming_content = self.ametered(
+                response.streaming_content, request, response, metrics, start
+            )
+        else:
+            response.streaming_content = self.metered(
+                response.streaming_content, request, response, metrics, start
+            )
+        return response
+
+    def metered(self, content, request, response, metrics, start):
+        """the response body with its queries counted, logged once consumed or closed"""
+        chunks = iter(content)
+        try:
+            while True:
+                try:
+                    with recording(metrics):
+                        chunk = next(chunks)
+                except StopIteration:
+                    return
+                yield chunk
+        finally:
+            self.log(request, response, metrics, (time.perf_counter() - start) * 1000)
+
+    async def ametered(self, content, request, response, metrics, start):
+        """metered() for async iterators"""
+        chunks = content.__aiter__()
+        try:
+            while True:
+                try:
+                    with recording(metrics):
+                        chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    return
+                yield chunk
+        finally:
+            self.log(request, response, metrics, (time.perf_counter() - start) * 1000)
+
+    def log(self, request, response, metrics, total_ms):
+        db_ms = metrics.db_time * 1000
+        serializer_ms = metrics.serializer_time * 1000
+        match = request.resolver_match
+        view = match.view_name if match else "unresolved"
+        record_view(view, total_ms, metrics)
+
+        line = {
+            "method": request.method,
+            "path": request.path,
+            "view": view,
+            "status": response.status_code,
+            "total_ms": round(total_ms, 2),
+            "db_ms": round(db_ms, 2),
+            "queries": metrics.queries,
+            "serializer_ms": round(serializer_ms, 2),
+        }
+        if (
+            total_ms > settings.REQUEST_SLOW_MS
+            or metrics.queries > settings.REQUEST_SLOW_QUERIES
+        ):
+            line["slow"] = True
+            line["slowest_queries"] = [
+                {"ms": round(seconds * 1000, 2), "sql": sql[:1000]}
+                for seconds, sql in sorted(metrics.slowest, reverse=True)
+            ]
+            logger.warning(json.dumps(line))
+        else:
+            logger.info(json.dumps(line))
@@ -0,0 +1,154 @@
+# Generated by Django 4.2.16 on 2026-10-18 04:31
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserData',
+            fields=[
+                ('last_login', models.DateTimeField(blank=True, null=True, verbose_name='last login')),
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, unique=True)),
+                ('password', models.CharField(max_length=100, null=True)),
+                ('email', models.EmailField(max_length=40, null=True, unique=True)),
+                ('username', models.CharField(max_length=255, unique=True)),
+                ('first_name', models.CharField(blank=True, max_length=30)),
+                ('last_name', models.CharField(max_length=30)),
+                ('date_joined', models.DateTimeField(auto_now_add=True)),
+                ('last_edit', models.DateTimeField(auto_now=True)),
+                ('normal_user', models.BooleanField(default=True)),
+                ('is_superuser', models.BooleanField(default=False)),
+                ('balance', models.FloatField(default=0.0)),
+                ('groups', models.ManyToManyField(blank=True, help_text='The groups this user belongs to. A user will get all permissions granted to each of their groups.', related_name='user_set', related_query_name='user', to='auth.group', verbose_name='groups')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='BookData',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, unique=True)),
+                ('book_name', models.CharField(max_length=150)),
+                ('author_name', models.CharField(max_length=100)),
+                ('book_amount', models.IntegerField()),
+                ('price', models.FloatField()),
+                ('file', models.FileField(null=True, upload_to='books/')),
+                ('public', models.BooleanField(default=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BookFile',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('file', models.FileField(upload_to='books/')),
+                ('size', models.BigIntegerField()),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, unique=True)),
+                ('name', models.CharField(default='all', max_length=100)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PurchaseBook',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, unique=True)),
+                ('purchase_date', models.DateTimeField(auto_now_add=True)),
+                ('quantity', models.PositiveIntegerField(default=1)),
+                ('unit_price', models.FloatField(null=True)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='purchases', to='core.bookdata')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='purchases', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CategorySalesDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('units', models.PositiveIntegerField(default=0)),
+                ('revenue', models.FloatField(default=0.0)),
+                ('category', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='daily_sales', to='core.category')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BookSalesDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('units', models.PositiveIntegerField(default=0)),
+                ('revenue', models.FloatField(default=0.0)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_sales', to='core.bookdata')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='bookdata',
+            name='category',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='category_books', to='core.category'),
+        ),
+        migrations.AddField(
+            model_name='userdata',
+            name='purchased_books',
+            field=models.ManyToManyField(related_name='purchased_by', through='core.PurchaseBook', to='core.bookdata'),
+        ),
+        migrations.AddField(
+            model_name='userdata',
+            name='user_permissions',
+            field=models.ManyToManyField(blank=True, help_text='Specific permissions for this user.', related_name='user_set', related_query_name='user', to='auth.permission', verbose_name='user permissions'),
+        ),
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, unique=True)),
+                ('quantity', models.PositiveIntegerField()),
+                ('expires_at', models.DateTimeField()),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='core.bookdata')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['expires_at'], name='stockreservation_expires_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='stockreservation',
+            constraint=models.UniqueConstraint(fields=('user', 'book'), name='stockreservation_user_book_uniq'),
+        ),
+        migrations.AddIndex(
+            model_name='categorysalesdaily',
+            index=models.Index(fields=['day'], name='categorysalesdaily_day_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='categorysalesdaily',
+            constraint=models.UniqueConstraint(fields=('category', 'day'), name='categorysalesdaily_category_day_uniq'),
+        ),
+        migrations.AddIndex(
+            model_name='booksalesdaily',
+            index=models.Index(fields=['day'], name='booksalesdaily_day_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='booksalesdaily',
+            constraint=models.UniqueConstraint(fields=('book', 'day'), name='booksalesdaily_book_day_uniq'),
+        ),
+        migrations.AddIndex(
+            model_name='bookdata',
+            index=models.Index(fields=['price'], name='bookdata_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bookdata',
+            index=models.Index(fields=['book_amount'], name='bookdata_amount_idx'),
+        ),
+    ]
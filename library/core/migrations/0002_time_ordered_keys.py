@@ -0,0 +1,82 @@
+# Generated by Django 4.2.16 on 2026-10-18 04:31
+
+import core.ids
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def merge_duplicate_purchases(apps, schema_editor):
+    """
+    fold repeated purchases of a book by one user (possible before the unique
+    constraint) into the earliest one, summing their quantities
+    """
+    PurchaseBook = apps.get_model('core', 'PurchaseBook')
+    duplicates = (
+        PurchaseBook.objects.values('user_id', 'book_id')
+        .annotate(rows=models.Count('pk'), total=models.Sum('quantity'))
+        .filter(rows__gt=1)
+    )
+    for row in duplicates.iterator():
+        purchases = PurchaseBook.objects.filter(user_id=row['user_id'], book_id=row['book_id'])
+        first = purchases.order_by('purchase_date', 'pk').values_list('pk', flat=True)[0]
+        purchases.exclude(pk=first).delete()
+        purchases.filter(pk=first).update(quantity=row['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='bookdata',
+            name='id',
+            field=models.UUIDField(default=core.ids.uuid7, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='category',
+            name='id',
+            field=models.UUIDField(default=core.ids.uuid7, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='purchasebook',
+            name='book',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='purchases', to='core.bookdata'),
+        ),
+        migrations.AlterField(
+            model_name='purchasebook',
+            name='id',
+            field=models.UUIDField(default=core.ids.uuid7, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='purchasebook',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='purchases', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='stockreservation',
+            name='id',
+            field=models.UUIDField(default=core.ids.uuid7, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='userdata',
+            name='id',
+            field=models.UUIDField(default=core.ids.uuid7, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.AddIndex(
+            model_name='purchasebook',
+            index=models.Index(fields=['book', 'purchase_date'], name='purchasebook_book_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='purchasebook',
+            index=models.Index(fields=['user', 'purchase_date'], name='purchasebook_user_date_idx'),
+        ),
+        migrations.RunPython(merge_duplicate_purchases, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='purchasebook',
+            constraint=models.UniqueConstraint(fields=('user', 'book'), name='purchasebook_user_book_uniq'),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 4.2.16 on 2026-10-18 04:41
+
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+BATCH_SIZE = 1000
+
+
+def open_ledger(apps, schema_editor):
+    """every non zero float balance becomes an opening entry and a snapshot covering it"""
+    UserData = apps.get_model('core', 'UserData')
+    BalanceEntry = apps.get_model('core', 'BalanceEntry')
+    BalanceSnapshot = apps.get_model('core', 'BalanceSnapshot')
+    balances = UserData.objects.exclude(balance=0).values_list('pk', 'balance').order_by('pk')
+    batch = []
+    for user_id, balance in balances.iterator(chunk_size=BATCH_SIZE):
+        batch.append(BalanceEntry(user_id=user_id, amount=Decimal(str(balance)).quantize(Decimal('0.01')), kind='opening'))
+        if len(batch) >= BATCH_SIZE:
+            BalanceEntry.objects.bulk_create(batch)
+            batch = []
+    BalanceEntry.objects.bulk_create(batch)
+    # * read the ids back, not every backend returns them from bulk_create
+    openings = BalanceEntry.objects.values_list('user_id', 'amount', 'id').order_by('id')
+    BalanceSnapshot.objects.bulk_create(
+        (
+            BalanceSnapshot(user_id=user_id, balance=amount, last_entry_id=entry_id)
+            for user_id, amount, entry_id in openings.iterator(chunk_size=BATCH_SIZE)
+        ),
+        batch_size=BATCH_SIZE,
+    )
+
+
+def close_ledger(apps, schema_editor):
+    """put the ledger sum of every user back into the float balance"""
+    UserData = apps.get_model('core', 'UserData')
+    BalanceEntry = apps.get_model('core', 'BalanceEntry')
+    totals = BalanceEntry.objects.values('user_id').annotate(total=models.Sum('amount')).order_by()
+    for row in totals.iterator(chunk_size=BATCH_SIZE):
+        UserData.objects.filter(pk=row['user_id']).update(balance=float(row['total']))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_time_ordered_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='balance_snapshot', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('balance', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=14)),
+                ('last_entry_id', models.BigIntegerField(default=0)),
+                ('taken_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BalanceEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('kind', models.CharField(choices=[('opening', 'opening'), ('topup', 'top-up'), ('purchase', 'purchase'), ('adjustment', 'adjustment')], max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='balance_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'id'], name='balanceentry_user_id_idx')],
+            },
+        ),
+        migrations.RunPython(open_ledger, close_ledger),
+        migrations.RemoveField(
+            model_name='userdata',
+            name='balance',
+        ),
+    ]
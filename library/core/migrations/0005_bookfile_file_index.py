@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 05:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_job_queue'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='bookfile',
+            name='file',
+            field=models.FileField(db_index=True, upload_to='books/'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.16 on 2026-10-18 05:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_bookfile_file_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bookdata',
+            index=models.Index(fields=['book_name', 'author_name'], name='bookdata_natural_key_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.16 on 2026-10-18 05:19
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_bookdata_natural_key_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='booksalesdaily',
+            name='revenue',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=14),
+        ),
+        migrations.AlterField(
+            model_name='categorysalesdaily',
+            name='revenue',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=14),
+        ),
+        migrations.AlterField(
+            model_name='purchasebook',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, max_digits=14, null=True),
+        ),
+    ]
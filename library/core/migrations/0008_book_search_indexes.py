@@ -0,0 +1,92 @@
+"""indexes behind core.search.search_books, each vendor gets its own
+
+PostgreSQL indexes the UPPER() expressions Django's icontains compares with
+pg_trgm GIN indexes. SQLite gets an FTS5 table with the trigram tokenizer,
+kept in sync by triggers, when the library is new enough to have it
+(3.34+, compiled with FTS5); search_books checks for the table and scans
+without it. Other backends get nothing.
+"""
+from django.db import migrations
+
+FTS_TABLE = "core_bookdata_trigram"
+
+POSTGRES_INDEXES = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    # * django renders icontains as UPPER("col"::text)
+    # * LIKE UPPER(%s), index that expression
+    "CREATE INDEX IF NOT EXISTS core_bookdata_name_trgm "
+    "ON core_bookdata USING gin (UPPER(book_name::text) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS core_bookdata_author_trgm "
+    "ON core_bookdata USING gin (UPPER(author_name::text) gin_trgm_ops)",
+]
+
+POSTGRES_DROP = [
+    "DROP INDEX IF EXISTS core_bookdata_name_trgm",
+    "DROP INDEX IF EXISTS core_bookdata_author_trgm",
+]
+
+SQLITE_INDEXES = [
+    # * the uuid is stored next to the text because rowids of a table without
+    # * an INTEGER PRIMARY KEY are not stable across VACUUM
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+    "USING fts5(id UNINDEXED, book_name, author_name, tokenize='trigram')",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON core_bookdata BEGIN
+        INSERT INTO {FTS_TABLE}(id, book_name, author_name)
+        VALUES (new.id, new.book_name, new.author_name);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON core_bookdata BEGIN
+        DELETE FROM {FTS_TABLE} WHERE id = old.id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au
+    AFTER UPDATE OF book_name, author_name ON core_bookdata BEGIN
+        UPDATE {FTS_TABLE} SET book_name = new.book_name, author_name = new.author_name
+        WHERE id = old.id;
+    END""",
+    f"""INSERT INTO {FTS_TABLE}(id, book_name, author_name)
+        SELECT id, book_name, author_name FROM core_bookdata
+        WHERE NOT EXISTS (SELECT 1 FROM {FTS_TABLE})""",
+]
+
+SQLITE_DROP = [
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ai",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ad",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_au",
+    f"DROP TABLE IF EXISTS {FTS_TABLE}",
+]
+
+
+def sqlite_has_trigrams(connection):
+    if connection.Database.sqlite_version_info < (3, 34):
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA compile_options")
+        return "ENABLE_FTS5" in {row[0] for row in cursor.fetchall()}
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        connection = schema_editor.connection
+        if connection.vendor == "postgresql":
+            sql = statements["postgresql"]
+        elif connection.vendor == "sqlite" and sqlite_has_trigrams(connection):
+            sql = statements["sqlite"]
+        else:
+            return
+        for statement in sql:
+            schema_editor.execute(statement, params=None)
+
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_decimal_sales_amounts'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({"postgresql": POSTGRES_INDEXES, "sqlite": SQLITE_INDEXES}),
+            run({"postgresql": POSTGRES_DROP, "sqlite": SQLITE_DROP}),
+        ),
+    ]
@@ -1,23 +1,53 @@
 """define all models here
 """
+from decimal import Decimal
+
 from django.db import models
-from uuid import uuid4
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 
+from .ids import uuid7
+
+CENT = Decimal('0.01')
+
 
 class Category(models.Model):
-    id = models.UUIDField(default=uuid4, unique=True, primary_key=True, editable=False)
+    id = models.UUIDField(default=uuid7, primary_key=True, editable=False)
     name = models.CharField(max_length=100, default="all")
 
     def __str__(self):
         return self.name
 
+class BookFile(models.Model):
+    """
+    a stored book file, shared by every BookData row uploaded with the same content
+    """
+    digest = models.CharField(max_length=64, primary_key=True)
+    # * release_book_file looks blobs up by the name BookData.file holds
+    file = models.FileField(upload_to='books/', db_index=True)
+    size = models.BigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return self.digest
+
+
+class BookDataQuerySet(models.QuerySet):
+    def visible_to(self, user):
+        """books user may see, normal users the whole catalog and everyone else (anonymous too) only public books"""
+        if getattr(user, 'normal_user', False):
+            return self
+        return self.filter(public=True)
+
+
 class BookData(models.Model):
     """
     Book model
     """
-    id = models.UUIDField(default=uuid4, unique=True, primary_key=True, editable=False)
+    id = models.UUIDField(default=uuid7, primary_key=True, editable=False)
     book_name = models.CharField(max_length=150)
     author_name = models.CharField(max_length=100)
     book_amount = models.IntegerField()
@@ -26,6 +56,21 @@ class BookData(models.Model):
     file = models.FileField(upload_to='books/', null=True)
     public = models.BooleanField(default=True)
 
+    objects = BookDataQuerySet.as_manager()
+
+    def is_visible_to(self, user):
+        """the per book form of BookData.objects.visible_to()"""
+        return self.public or getattr(user, 'normal_user', False)
+
+    class Meta:
+        # * range filters of the catalog, text search indexes live in core.search
+        indexes = [
+            models.Index(fields=['price'], name='bookdata_price_idx'),
+            models.Index(fields=['book_amount'], name='bookdata_amount_idx'),
+            # * natural key of book.catalog_io imports, not unique since existing catalogs may repeat it
+            models.Index(fields=['book_name', 'author_name'], name='bookdata_natural_key_idx'),
+        ]
+
     def __str__(self):
         return self.book_name
     
@@ -39,9 +84,13 @@ class UserDataManager(BaseUserManager):
 
         email = self.normalize_email(email)
         extra_fields.setdefault('normal_user', False)
+        # * the balance lives in the ledger, an opening balance becomes its first entry
+        balance = extra_fields.pop('balance', None)
         user = self.model(username=username, email=email, **extra_fields)
         user.set_password(password)
         user.save(using=self._db)
+        if balance:
+            BalanceEntry.objects.using(self._db).create(user=user, amount=balance, kind=BalanceEntry.OPENING)
         return user
 
     def create_superuser(self, username, email, password=None, **extra_fields):
@@ -56,7 +105,7 @@ class UserData(AbstractBaseUser, PermissionsMixin):
     User model
     """
 
-    id = models.UUIDField(default=uuid4, unique=True, primary_key=True, editable=False)
+    id = models.UUIDField(default=uuid7, primary_key=True, editable=False)
     password = models.CharField(max_length=100, null=True)
     email = models.EmailField(max_length=40, unique=True, null=True)
     username = models.CharField(max_length=255,unique=True)
@@ -69,8 +118,7 @@ class UserData(AbstractBaseUser, PermissionsMixin):
     # is_superuser = models.BooleanField(default=True)  
     is_superuser = models.BooleanField(default=False)
 
-    balance = models.FloatField(default=0.0) 
-    
+
     objects = UserDataManager()
 
     
@@ -87,17 +135,200 @@ class UserData(AbstractBaseUser, PermissionsMixin):
     @property
     def is_anonymous(self):
         return False
+
+    @property
+    def balance(self):
+        """current balance from the ledger, one query per access"""
+        # * SQLite returns computed decimals unrounded
+        return UserData.objects.filter(pk=self.pk).values_list(balance_expression(), flat=True).get().quantize(CENT)
     
     
 class PurchaseBook(models.Model):
     """
     purchase book by user
     """
-    id = models.UUIDField(default=uuid4, unique=True, primary_key=True, editable=False)
-    user = models.ForeignKey(UserData, related_name='purchases', on_delete=models.CASCADE)
-    book = models.ForeignKey(BookData, related_name='purchases', on_delete=models.CASCADE)
+    id = models.UUIDField(default=uuid7, primary_key=True, editable=False)
+    # * the composite indexes below lead with user and book, single column indexes would only slow inserts
+    user = models.ForeignKey(UserData, related_name='purchases', on_delete=models.CASCADE, db_index=False)
+    book = models.ForeignKey(BookData, related_name='purchases', on_delete=models.CASCADE, db_index=False)
     purchase_date = models.DateTimeField(auto_now_add=True)
     quantity = models.PositiveIntegerField(default=1)
-    
+    # * price of one copy when bought, null for purchases made before it was recorded
+    unit_price = models.DecimalField(max_digits=14, decimal_places=2, null=True)
+
+    class Meta:
+        # * a book is bought once per user, the constraint's index also backs the "already purchased" checks
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'book'], name='purchasebook_user_book_uniq'),
+        ]
+        # * purchase history of a user and sales of a book in date order
+        indexes = [
+            models.Index(fields=['book', 'purchase_date'], name='purchasebook_book_date_idx'),
+            models.Index(fields=['user', 'purchase_date'], name='purchasebook_user_date_idx'),
+        ]
+
     def __str__(self):
         return f"{self.user.username} bought {self.book.book_name} (Quantity: {self.quantity})"
+
+
+class StockReservation(models.Model):
+    """
+    copies of a book held for a user between the purchase OTP request and its
+    confirmation. The copies are already taken out of BookData.book_amount, so
+    book_amount is always the stock still available to others
+    """
+    id = models.UUIDField(default=uuid7, primary_key=True, editable=False)
+    user = models.ForeignKey(UserData, related_name='reservations', on_delete=models.CASCADE)
+    book = models.ForeignKey(BookData, related_name='reservations', on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'book'], name='stockreservation_user_book_uniq'),
+        ]
+        # * the sweeper scans expired holds in expiry order
+        indexes = [models.Index(fields=['expires_at'], name='stockreservation_expires_idx')]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.book_id} for {self.user_id} until {self.expires_at}"
+
+class BookSalesDaily(models.Model):
+    """
+    units sold and revenue of one book on one day, kept up to date by the
+    purchase commit and rebuilt from PurchaseBook by rebuild_sales_rollups
+    """
+    book = models.ForeignKey(BookData, related_name='daily_sales', on_delete=models.CASCADE)
+    day = models.DateField()
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0'))
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'day'], name='booksalesdaily_book_day_uniq'),
+        ]
+        indexes = [models.Index(fields=['day'], name='booksalesdaily_day_idx')]
+
+
+class CategorySalesDaily(models.Model):
+    """
+    units sold and revenue of one category on one day, category is null for
+    books without one. Readers always SUM, so a duplicate row for the null
+    category (which the unique constraint cannot prevent) is still counted right
+    """
+    category = models.ForeignKey(Category, related_name='daily_sales', on_delete=models.CASCADE, null=True)
+    day = models.DateField()
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0'))
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'day'], name='categorysalesdaily_category_day_uniq'),
+        ]
+        indexes = [models.Index(fields=['day'], name='categorysalesdaily_day_idx')]
+
+
+class BalanceEntry(models.Model):
+    """
+    one movement of a user's money, positive for credits and negative for
+    debits. Entries are only ever inserted, the balance is the sum of them
+    """
+    OPENING = 'opening'
+    TOPUP = 'topup'
+    PURCHASE = 'purchase'
+    ADJUSTMENT = 'adjustment'
+    KINDS = [(OPENING, 'opening'), (TOPUP, 'top-up'), (PURCHASE, 'purchase'), (ADJUSTMENT, 'adjustment')]
+
+    # * the (user, id) index below leads with user
+    user = models.ForeignKey(UserData, related_name='balance_entries', on_delete=models.CASCADE, db_index=False)
+    amount = models.DecimalField(max_digits=14, decimal_places=2)
+    kind = models.CharField(max_length=20, choices=KINDS)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # * balance reads sum the entries of one user after their snapshot's last_entry_id
+        indexes = [models.Index(fields=['user', 'id'], name='balanceentry_user_id_idx')]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("balance entries are append-only")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError("balance entries are append-only")
+
+    def __str__(self):
+        return f"{self.kind} {self.amount} for {self.user_id}"
+
+
+class BalanceSnapshot(models.Model):
+    """
+    a user's balance folded up to and including entry last_entry_id, so a
+    balance read sums only the entries after it. Debits lock this row, which
+    serializes the spending of one user without touching the user row
+    """
+    user = models.OneToOneField(UserData, related_name='balance_snapshot', on_delete=models.CASCADE, primary_key=True)
+    balance = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0'))
+    last_entry_id = models.BigIntegerField(default=0)
+    taken_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.balance} for {self.user_id} up to entry {self.last_entry_id}"
+
+
+def balance_expression(user='pk'):
+    """
+    current balance of the user referenced by the user field of the queryset
+    it is used on: the snapshot plus a sum over the entries after it
+    """
+    money = models.DecimalField(max_digits=14, decimal_places=2)
+    snapshot = BalanceSnapshot.objects.filter(user_id=OuterRef(user))
+    # * nested one level deeper, so this OuterRef points at the entry's user
+    last_entry = BalanceSnapshot.objects.filter(user_id=OuterRef('user_id')).values('last_entry_id')
+    recent = (
+        BalanceEntry.objects.filter(user_id=OuterRef(user), id__gt=Coalesce(Subquery(last_entry), Value(0)))
+        .order_by()
+        .values('user_id')
+        .annotate(total=Sum('amount'))
+        .values('total')
+    )
+    return Coalesce(Subquery(snapshot.values('balance')), Value(Decimal('0')), output_field=money) + Coalesce(
+        Subquery(recent), Value(Decimal('0')), output_field=money
+    )
+
+
+class Job(models.Model):
+    """
+    a unit of background work for book.jobs, run by the run_jobs workers
+
+    a queued job runs once run_at has passed, a running one belongs to the
+    worker named in locked_by until locked_until and is picked up again after
+    that, so a crashed worker only delays its jobs. idempotency_key makes
+    enqueueing the same work twice return the first job
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(QUEUED, 'queued'), (RUNNING, 'running'), (DONE, 'done'), (FAILED, 'failed')]
+
+    id = models.UUIDField(default=uuid7, primary_key=True, editable=False)
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict)
+    idempotency_key = models.CharField(max_length=200, unique=True, null=True)
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=64, blank=True)
+    locked_until = models.DateTimeField(null=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True)
+
+    class Meta:
+        # * workers dequeue by status in run_at order
+        indexes = [models.Index(fields=['status', 'run_at'], name='job_status_run_at_idx')]
+
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.status})"
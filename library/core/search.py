@@ -0,0 +1,65 @@
+"""full text search over the book catalog
+
+a search matches the books where every word of the term occurs, in any case,
+in book_name or author_name, on every backend. Migration 0008 gives PostgreSQL
+trigram GIN indexes that back the `icontains` lookups and SQLite a trigram FTS5
+table kept in sync by triggers, which narrows the rows before the same
+`icontains` check. Any other backend (or a SQLite build without FTS5 trigrams)
+falls back to a plain `icontains` scan.
+"""
+import re
+
+from asgiref.sync import sync_to_async
+from django.db import connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = "core_bookdata_trigram"
+# * the trigram tokenizer only indexes words of at least this many characters
+FTS_MIN_WORD = 3
+
+# * alias -> whether migration 0008 could create the FTS5 table
+_fts_available = {}
+
+
+def fts_available(using):
+    if using not in _fts_available:
+        with connections[using].cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [FTS_TABLE])
+            _fts_available[using] = cursor.fetchone() is not None
+    return _fts_available[using]
+
+
+async def aprepare_search(using):
+    """
+    resolve the FTS5 check ahead of search_books, which cannot run queries
+    itself when called from an async view
+    """
+    if connections[using].vendor == "sqlite" and using not in _fts_available:
+        await sync_to_async(fts_available)(using)
+
+
+def search_books(queryset, term):
+    """
+    filter a BookData queryset to rows where every word of term occurs in
+    book_name or author_name, a term without words matches nothing
+    """
+    words = re.findall(r"\w+", term)
+    if not words:
+        return queryset.none()
+    using = queryset.db
+    indexed = [word for word in words if len(word) >= FTS_MIN_WORD]
+    if indexed and connections[using].vendor == "sqlite" and fts_available(using):
+        # * quoting keeps FTS5 syntax out of user
+        # * input, the icontains below still decides
+        match = " AND ".join('"%s"' % word for word in indexed)
+        queryset = queryset.filter(
+            id__in=RawSQL(
+                f"SELECT id FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [match]
+            )
+        )
+    for word in words:
+        queryset = queryset.filter(
+            Q(book_name__icontains=word) | Q(author_name__icontains=word)
+        )
+    return queryset
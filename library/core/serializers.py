@@ -1,10 +1,205 @@
 """serializer for users
 """
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
 from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.relations import ManyRelatedField, PrimaryKeyRelatedField, StringRelatedField
 
+from .middleware import timed_serialization
 from .models import UserData, BookData, PurchaseBook, Category
 
-class UserDataSerializer(serializers.ModelSerializer):
+
+class TimedSerializerMixin:
+    """count to_representation as serializer time of the current request"""
+
+    def to_representation(self, instance):
+        with timed_serialization():
+            return super().to_representation(instance)
+
+
+class EagerLoadingMixin:
+    """
+    plan select_related/prefetch_related from the fields a serializer renders
+
+    forward relations rendered through anything other than their primary key
+    are joined, to-many relations are prefetched (only the key column when the
+    field renders primary keys), so a list costs a fixed number of queries
+    """
+
+    @classmethod
+    def setup_eager_loading(cls, queryset, names=None):
+        """names limits the plan to the fields a sparse fieldset renders"""
+        opts = cls.Meta.model._meta
+        select, prefetch = [], []
+        for name, field in cls().fields.items():
+            if names is not None and name not in names:
+                continue
+            if field.write_only or field.source == "*" or "." in field.source:
+                continue
+            try:
+                model_field = opts.get_field(field.source)
+            except FieldDoesNotExist:
+                continue
+            if not model_field.is_relation:
+                continue
+            if model_field.many_to_many or model_field.one_to_many:
+                related = model_field.related_model
+                if isinstance(field, ManyRelatedField) and isinstance(field.child_relation, PrimaryKeyRelatedField):
+                    prefetch.append(Prefetch(field.source, queryset=related.objects.only("pk")))
+                else:
+                    prefetch.append(field.source)
+            elif not isinstance(field, PrimaryKeyRelatedField):
+                select.append(field.source)
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        return queryset
+
+
+# * DRF fields whose to_representation returns database values unchanged, the values plan skips them
+PASSTHROUGH_FIELDS = (
+    serializers.CharField, serializers.IntegerField, serializers.FloatField,
+    serializers.BooleanField, PrimaryKeyRelatedField, StringRelatedField,
+)
+
+
+class ValuesPlan:
+    """
+    render .values() rows in the shape of a serializer without model instances
+
+    compiled once per serializer and fieldset: columns are what to ask
+    .values() for (always including the primary key, which keyset pagination
+    reads), steps are (output key, column, converter) with converter None for
+    values that are rendered as they come from the database
+    """
+
+    def __init__(self, columns, steps, url_columns):
+        self.columns = columns
+        self.steps = steps
+        # * file columns turn into absolute URLs, which need the request
+        self.url_columns = url_columns
+
+    def render(self, rows, request=None):
+        steps = list(self.steps)
+        for index, (key, column, storage) in self.url_columns:
+            build = request.build_absolute_uri if request is not None else (lambda url: url)
+            steps[index] = (key, column, lambda name, storage=storage, build=build: build(storage.url(name)) if name else None)
+        with timed_serialization():
+            return [
+                {key: row[column] if convert is None or row[column] is None else convert(row[column]) for key, column, convert in steps}
+                for row in rows
+            ]
+
+
+class SparseFieldsMixin:
+    """
+    ?fields=a,b renders only those fields and ?omit=a,b drops them (both only
+    on reads), unknown names are a 400
+
+    Meta.values_sources maps a field to the .values() column holding what it
+    renders when that is not the field's own column, e.g. a StringRelatedField
+    to the related model's name column
+    """
+
+    _readable = {}
+    _plans = {}
+
+    @classmethod
+    def readable_fields(cls):
+        if cls not in cls._readable:
+            cls._readable[cls] = tuple(name for name, field in cls().fields.items() if not field.write_only)
+        return cls._readable[cls]
+
+    @classmethod
+    def requested_fields(cls, request):
+        """the readable field names this request asks for, in serializer order, None for all of them"""
+        if request is None or request.method not in SAFE_METHODS:
+            return None
+        # * the async views pass a plain HttpRequest
+        params = getattr(request, "query_params", request.GET)
+        fields = params.get("fields")
+        omit = params.get("omit")
+        if not fields and not omit:
+            return None
+        readable = cls.readable_fields()
+        wanted = {name.strip() for name in (fields or ",".join(readable)).split(",") if name.strip()}
+        unwanted = {name.strip() for name in (omit or "").split(",") if name.strip()}
+        unknown = sorted((wanted | unwanted) - set(readable))
+        if unknown:
+            raise serializers.ValidationError({"fields": f"Unknown field(s): {', '.join(unknown)}."})
+        return tuple(name for name in readable if name in wanted and name not in unwanted)
+
+    @classmethod
+    def field_columns(cls, names=None):
+        """(field name, column) of the rendered fields, column None for what no single column holds"""
+        opts = cls.Meta.model._meta
+        sources = getattr(cls.Meta, "values_sources", {})
+        columns = []
+        for name, field in cls().fields.items():
+            if field.write_only or (names is not None and name not in names):
+                continue
+            column = sources.get(name)
+            if column is None and field.source != "*" and "." not in field.source:
+                try:
+                    model_field = opts.get_field(field.source)
+                except FieldDoesNotExist:
+                    model_field = None
+                if model_field is not None and model_field.concrete and not model_field.many_to_many:
+                    column = field.source
+            columns.append((name, column))
+        return columns
+
+    @classmethod
+    def only_columns(cls, names=None):
+        """arguments for .only(), the primary key plus every column the fieldset reads"""
+        pk = cls.Meta.model._meta.pk.name
+        return [pk] + [column for _, column in cls.field_columns(names) if column is not None and column != pk]
+
+    @classmethod
+    def values_plan(cls, names=None):
+        """the compiled ValuesPlan of the fieldset, None when a field needs a model instance"""
+        key = (cls, names)
+        if key not in cls._plans:
+            cls._plans[key] = cls.compile_plan(names)
+        return cls._plans[key]
+
+    @classmethod
+    def compile_plan(cls, names):
+        fields = cls().fields
+        opts = cls.Meta.model._meta
+        steps, url_columns = [], []
+        for name, column in cls.field_columns(names):
+            field = fields[name]
+            if column is None or isinstance(field, ManyRelatedField) or field.source == "*":
+                return None
+            if isinstance(field, serializers.FileField):
+                url_columns.append((len(steps), (name, column, opts.get_field(column).storage)))
+                convert = None
+            elif isinstance(field, StringRelatedField) and name not in getattr(cls.Meta, "values_sources", {}):
+                # * renders str() of the related instance, which only values_sources can name a column for
+                return None
+            elif isinstance(field, PASSTHROUGH_FIELDS):
+                convert = None
+            elif isinstance(field, serializers.UUIDField) and field.uuid_format == "hex_verbose":
+                convert = str
+            else:
+                convert = field.to_representation
+            steps.append((name, column, convert))
+        pk = opts.pk.name
+        columns = [pk] + [column for _, column, _ in steps if column != pk]
+        return ValuesPlan(columns, steps, url_columns)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        names = self.requested_fields(self.context.get("request"))
+        if names is not None:
+            for name in [name for name, field in self.fields.items() if not field.write_only and name not in names]:
+                self.fields.pop(name)
+
+
+class UserDataSerializer(TimedSerializerMixin, SparseFieldsMixin, EagerLoadingMixin, serializers.ModelSerializer):
     """serializer for UserData"""
     
     password = serializers.CharField(write_only=True, required=True, style={'input_type': 'password'}, max_length=100)
@@ -23,23 +218,44 @@ class UserDataSerializer(serializers.ModelSerializer):
             user.save()  
             return user
 
-class BookDataSerializer(serializers.ModelSerializer):
+class BookDataSerializer(TimedSerializerMixin, SparseFieldsMixin, EagerLoadingMixin, serializers.ModelSerializer):
     class Meta:
         model = BookData
         fields = ['id', 'book_name', 'author_name', 'book_amount', 'price','file','category','public']
 
 
-class PurchaseBookSerializer(serializers.ModelSerializer):
+class PurchaseBookSerializer(TimedSerializerMixin, SparseFieldsMixin, EagerLoadingMixin, serializers.ModelSerializer):
     
     user = serializers.StringRelatedField()  
     book = serializers.StringRelatedField()  
     class Meta:
         model = PurchaseBook
         fields = ['id', 'user', 'book', 'purchase_date', 'quantity']
-        read_only_fields = ['id', 'purchase_date']  
+        read_only_fields = ['id', 'purchase_date']
+        # * the string forms of UserData and BookData
+        values_sources = {'user': 'user__username', 'book': 'book__book_name'}
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(TimedSerializerMixin, SparseFieldsMixin, EagerLoadingMixin, serializers.ModelSerializer):
     
     class Meta:
         model = Category
-        fields = ['id', 'name']
\ No newline at end of file
+        fields = ['id', 'name']
+
+
+class CheckoutItemSerializer(serializers.Serializer):
+    """one line of a cart"""
+
+    book = serializers.UUIDField()
+    quantity = serializers.IntegerField(min_value=1, default=1)
+
+
+class CheckoutSerializer(serializers.Serializer):
+    """a cart of distinct books"""
+
+    items = CheckoutItemSerializer(many=True, allow_empty=False)
+
+    def validate_items(self, items):
+        books = [item['book'] for item in items]
+        if len(set(books)) != len(books):
+            raise serializers.ValidationError("Each book can only appear once in a cart.")
+        return items
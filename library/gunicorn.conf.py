@@ -0,0 +1,59 @@
+"""gunicorn settings for production serving
+
+    cd library && gunicorn -c gunicorn.conf.py library.wsgi
+
+the async views (book.async_views) are served by uvicorn workers instead:
+
+    GUNICORN_WORKER_CLASS=uvicorn_worker.UvicornWorker gunicorn -c gunicorn.conf.py library.asgi
+
+with gthread, prefork workers with a thread pool each, every thread keeps its
+own persistent database connection (CONN_MAX_AGE), so the database sees at
+most GUNICORN_WORKERS * GUNICORN_THREADS connections. Under uvicorn workers the
+queries run on executor threads that come and go, so library.asgi defaults
+DATABASE_CONN_MAX_AGE to 0: one connection per request, closed when it ends,
+and as many connections as requests in flight. `kill -HUP <master>` reloads
+code and settings gracefully: new workers start before the old ones finish
+their in-flight requests. Each worker logs its connection reuse statistics
+every GUNICORN_STATS_EVERY requests and when it exits.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+# * gthread for library.wsgi, uvicorn_worker.UvicornWorker
+# * for library.asgi (threads is then unused)
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+
+# * recycle workers now and then so leaks cannot
+# * accumulate, jitter avoids restarting them all at once
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 10000))
+max_requests_jitter = max_requests // 10
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = "-"
+errorlog = "-"
+
+stats_every = int(os.environ.get("GUNICORN_STATS_EVERY", 1000))
+
+
+def post_request(worker, req, environ, resp):
+    from core.dbstats import connection_stats
+
+    stats = connection_stats()
+    if stats_every and stats["requests"] % stats_every == 0:
+        worker.log.info("worker %s db connections %s", worker.pid, stats)
+
+
+def worker_exit(server, worker):
+    from django.db import connections
+
+    from core.dbstats import connection_stats
+
+    connections.close_all()
+    server.log.info(
+        "worker %s exiting, db connections %s", worker.pid, connection_stats()
+    )
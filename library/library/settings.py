@@ -1,5 +1,6 @@
 
 import os
+import sys
 from pathlib import Path
 from datetime import timedelta
 from dotenv import load_dotenv
@@ -31,6 +32,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -82,6 +84,94 @@ DATABASES = {
     }
 }
 
+# * DATABASE_ENGINE=sqlite runs the project locally without PostgreSQL
+if os.environ.get("DATABASE_ENGINE") == "sqlite":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.environ.get("DATABASE_NAME") or BASE_DIR / "db.sqlite3",
+            # * on disk, the concurrency tests need real file locking
+            "TEST": {"NAME": BASE_DIR / "test_db.sqlite3"},
+        }
+    }
+
+# * persistent connections, checked before reuse. each worker thread holds at most one,
+# * so a gunicorn process is bounded to GUNICORN_THREADS connections
+for database in DATABASES.values():
+    database["CONN_MAX_AGE"] = int(os.environ.get("DATABASE_CONN_MAX_AGE", 60))
+    database["CONN_HEALTH_CHECKS"] = True
+
+
+# * local memory cache by default, set REDIS_URL to share the cache between workers
+if os.environ.get("REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ["REDIS_URL"],
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+# * catalog list/retrieve responses, invalidated by a version bump on every book or category change
+CATALOG_CACHE_ALIAS = "default"
+CATALOG_CACHE_TTL = int(os.environ.get("CATALOG_CACHE_TTL", 300))
+CATALOG_CACHE_LOCK_TIMEOUT = 5
+
+# * per-user snapshot behind CachedJWTAuthentication, dropped whenever the user row changes
+AUTH_SNAPSHOT_CACHE_ALIAS = "default"
+AUTH_SNAPSHOT_TTL = int(os.environ.get("AUTH_SNAPSHOT_TTL", 60))
+
+# * OTPs of purchases, checkouts and top-ups, book.otp.InMemoryOTPStore keeps them in process
+OTP_STORE = os.environ.get("OTP_STORE", "book.otp.CacheOTPStore")
+OTP_CACHE_ALIAS = "default"
+OTP_TTL = int(os.environ.get("OTP_TTL", 300))
+OTP_MAX_ATTEMPTS = 5
+
+# * seconds a purchase OTP request holds the stock it asked for, as long as the code lives by default
+STOCK_RESERVATION_TTL = int(os.environ.get("STOCK_RESERVATION_TTL", OTP_TTL))
+# * copies one user may hold over all books at once
+STOCK_RESERVATION_MAX_COPIES = int(os.environ.get("STOCK_RESERVATION_MAX_COPIES", 10))
+
+# * balance ledger entries younger than this many seconds are left out of snapshots,
+# * so an entry whose transaction is still open can never be skipped
+BALANCE_SNAPSHOT_LAG = int(os.environ.get("BALANCE_SNAPSHOT_LAG", 60))
+# * largest single top-up, balances are DecimalField(max_digits=14) so amounts must stay far below 10**12
+BALANCE_TOPUP_MAX = int(os.environ.get("BALANCE_TOPUP_MAX", 100000))
+
+# * background jobs of book.jobs, run by the run_jobs command
+JOB_MAX_ATTEMPTS = 5
+# * a code is only worth delivering while it is valid, OTP mails give up sooner
+JOB_OTP_MAX_ATTEMPTS = 3
+# * seconds before the first retry, doubled every further attempt up to JOB_RETRY_MAX
+JOB_RETRY_BASE = int(os.environ.get("JOB_RETRY_BASE", 10))
+JOB_RETRY_MAX = int(os.environ.get("JOB_RETRY_MAX", 3600))
+# * seconds a worker owns the jobs it claimed, after that another worker picks them up
+JOB_LEASE = int(os.environ.get("JOB_LEASE", 300))
+# * seconds finished (done or failed) jobs are kept before the workers delete them
+JOB_RETENTION = int(os.environ.get("JOB_RETENTION", 7 * 24 * 3600))
+
+# * OTPs and receipts are mailed from the job workers, printed to the console without EMAIL_HOST
+if os.environ.get("EMAIL_HOST"):
+    EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+    EMAIL_HOST = os.environ["EMAIL_HOST"]
+    EMAIL_PORT = int(os.environ.get("EMAIL_PORT", 587))
+    EMAIL_HOST_USER = os.environ.get("EMAIL_HOST_USER", "")
+    EMAIL_HOST_PASSWORD = os.environ.get("EMAIL_HOST_PASSWORD", "")
+    EMAIL_USE_TLS = os.environ.get("EMAIL_USE_TLS", "true").lower() == "true"
+    EMAIL_TIMEOUT = 10
+else:
+    EMAIL_BACKEND = "django.core.mail.backends.console.EmailBackend"
+DEFAULT_FROM_EMAIL = os.environ.get("DEFAULT_FROM_EMAIL", "webmaster@localhost")
+
+# * where throttle buckets live, book.throttling.LocalBucketStore keeps them per process
+THROTTLE_BUCKET_STORE = os.environ.get("THROTTLE_BUCKET_STORE", "book.throttling.CacheBucketStore")
+THROTTLE_CACHE_ALIAS = "default"
+
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -115,16 +205,66 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# * how book files are sent: "stream" through the worker, or handed to the
+# * front proxy with "x-accel-redirect" (nginx) / "x-sendfile" (Apache, lighttpd)
+BOOK_DOWNLOAD_DELIVERY = os.environ.get("BOOK_DOWNLOAD_DELIVERY", "stream")
+# * internal nginx location that aliases MEDIA_ROOT
+BOOK_DOWNLOAD_ACCEL_PREFIX = os.environ.get("BOOK_DOWNLOAD_ACCEL_PREFIX", "/protected/")
+# * seconds a signed download URL stays valid
+BOOK_DOWNLOAD_URL_LIFETIME = int(os.environ.get("BOOK_DOWNLOAD_URL_LIFETIME", 300))
+
 # * default authentication class means that all API requests will use JWT
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
-    )
+        "book.authentication.CachedJWTAuthentication",
+    ),
+    # * keyset pagination, page size can be changed per request with ?page_size=
+    "DEFAULT_PAGINATION_CLASS": "book.pagination.KeysetPagination",
+    # * orjson when installed, the browsable API stays available
+    "DEFAULT_RENDERER_CLASSES": (
+        "book.renderers.FastJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ),
+    "PAGE_SIZE": int(os.environ.get("PAGINATION_PAGE_SIZE", 50)),
+    # * reverse proxies in front of the app, throttles key on REMOTE_ADDR when 0 and
+    # * otherwise on the X-Forwarded-For entry the outermost proxy added, never on one the client sent
+    "NUM_PROXIES": int(os.environ.get("NUM_PROXIES", 0)),
+    # * token bucket sizes of book.throttling, "n/period" refills n tokens per period
+    "DEFAULT_THROTTLE_RATES": {
+        "login_ip": "30/min",
+        "login_username": "5/min",
+        "otp_request": "5/min",
+        "otp_verify": "10/min",
+    },
     # 'DEFAULT_PERMISSION_CLASSES': (
     #     'rest_framework.permissions.IsAuthenticated',
     # ),
 }
 
+# * requests slower than this or running more queries are logged as warnings with their slowest queries
+REQUEST_SLOW_MS = int(os.environ.get("REQUEST_SLOW_MS", 500))
+REQUEST_SLOW_QUERIES = int(os.environ.get("REQUEST_SLOW_QUERIES", 30))
+REQUEST_SLOW_QUERY_SAMPLES = 5
+
+# * one JSON line per request from core.middleware
+# * the test runner would print a line per request
+TESTING = sys.argv[1:2] == ["test"]
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {
+        "core.requests": {
+            "handlers": ["console"],
+            "level": os.environ.get("REQUEST_LOG_LEVEL", "WARNING" if TESTING else "INFO"),
+            "propagate": False,
+        },
+    },
+}
+
+# * upper bound for ?page_size= on list endpoints
+PAGINATION_MAX_PAGE_SIZE = int(os.environ.get("PAGINATION_MAX_PAGE_SIZE", 500))
+
 # * set epiration time for ACCESS_TOKEN and REFRESH_TOKEN
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=50),